@@ -0,0 +1,67 @@
+"""
+  Carparts segmentation pipeline
+
+  The stages of the carparts demo as an importable package, shared by the Databricks notebooks and the
+  carparts command line:
+
+  * carparts.clustering | bisecting k-means models cut from one fit, needs the spark extra
+  * carparts.local      | single-node ingest, featurize, train and deploy on pandas and scikit-learn
+  * carparts.pipeline   | stage DAG runner skipping stages whose fingerprinted inputs are unchanged
+  * carparts.scoring    | JVM-free vectorized scoring of exported deployment pipelines
+  * carparts.serving    | micro-batching model server and its client
+  * carparts.streaming  | structured streaming segmentation, needs the spark extra
+
+  Submodules are imported on first access, so `import carparts` stays cheap and pyspark, MLflow or
+  scikit-learn are only loaded by the stages that use them.
+"""
+
+import importlib
+from typing import List
+
+__version__ = "0.1.0"
+
+_submodules = ["cli", "clustering", "local", "pipeline", "scoring", "serving", "streaming"]
+
+## public name -> submodule defining it
+_exports = {"BisectingKMeansCutModel" : "clustering",
+            "bisectionTree" : "clustering",
+            "cutBisectionTree" : "clustering",
+            "readOrders" : "local",
+            "cleanOrders" : "local",
+            "fitIndexer" : "local",
+            "applyIndexer" : "local",
+            "featureMatrix" : "local",
+            "localPipeline" : "local",
+            "exportLocalArtifact" : "local",
+            "Stage" : "pipeline",
+            "StageStore" : "pipeline",
+            "Pipeline" : "pipeline",
+            "loadScoringArtifact" : "scoring",
+            "assembleFeatures" : "scoring",
+            "scoreBatch" : "scoring",
+            "artifactScorer" : "serving",
+            "registeredModelScorer" : "serving",
+            "startServer" : "serving",
+            "score_model" : "serving",
+            "orderStream" : "streaming",
+            "segmentationStream" : "streaming"}
+
+__all__ = sorted(_exports)
+
+def __getattr__(name : str):
+  """
+    Import a submodule or the submodule of a public name on first access
+
+    @return Submodule or attribute
+
+    @param name          | attribute of the package
+  """
+
+  if name in _submodules:
+    return importlib.import_module(f"carparts.{name}")
+  if name in _exports:
+    return getattr(importlib.import_module(f"carparts.{_exports[name]}"), name)
+  raise AttributeError(f"module 'carparts' has no attribute '{name}'")
+
+def __dir__() -> List[str]:
+  return sorted(list(globals()) + _submodules + __all__)
@@ -0,0 +1,5 @@
+import sys
+
+from carparts.cli import main
+
+sys.exit(main())
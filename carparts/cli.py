@@ -0,0 +1,353 @@
+"""
+  carparts command line
+
+    carparts ingest    | read and clean landing csv files into a parquet order table
+    carparts featurize | index and assemble the features of an order table
+    carparts train     | run the single-node training pipeline
+    carparts deploy    | export a trained pipeline as a vectorized scoring artifact
+    carparts score     | score order files with a scoring artifact
+    carparts serve     | serve a scoring artifact or a registered model over HTTP
+    carparts stream    | segment new orders with structured streaming
+    carparts report    | daily, weekly or per segment order counts
+
+  Every command imports what it needs when it runs. score and report only load pandas and NumPy,
+  train adds scikit-learn, and pyspark and MLflow are left to the commands and flags that use them.
+  --timing prints the seconds since the process started, interpreter start-up and imports included.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+from typing import Callable, List, Optional
+
+## wall clock time of the import, the process start time where /proc isn't available
+importTime = time.time()
+
+## ----------------------------------------------------------------------------
+## Files : order tables and outputs
+## ----------------------------------------------------------------------------
+
+def readFrames(paths : List[str]):
+  """
+    Read order files, parquet written by carparts ingest or landing csv files
+
+    @return pandas DataFrame of the orders
+
+    @param paths         | parquet or csv files
+  """
+
+  import pandas as pd
+
+  from carparts.local import readOrders
+
+  parquet = [path for path in paths if path.endswith(".parquet")]
+  frames = [pd.read_parquet(path) for path in parquet]
+  if len(parquet) < len(paths):
+    frames.append(readOrders([path for path in paths if not path.endswith(".parquet")]))
+  return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index = True)
+
+def writeFrame(frame, path : Optional[str]) -> None:
+  """
+    Write a pandas DataFrame as parquet or csv, csv to stdout without a path
+
+    @param frame         | rows to write
+    @param path          | .parquet or .csv file, None for stdout
+  """
+
+  if path is None:
+    frame.to_csv(sys.stdout, index = False)
+  elif path.endswith(".parquet"):
+    frame.to_parquet(path, index = False)
+  else:
+    frame.to_csv(path, index = False)
+
+def parseRange(value : str) -> range:
+  """
+    @return range of a start:stop argument, stop excluded
+
+    @param value         | e.g. 2:15
+  """
+
+  start, stop = value.split(":")
+  return range(int(start), int(stop))
+
+## ----------------------------------------------------------------------------
+## Stages : one function per command, called with the parsed arguments
+## ----------------------------------------------------------------------------
+
+def ingestCommand(arguments : argparse.Namespace) -> None:
+  """
+    Read landing csv files, remove censored rows and write the order table
+  """
+
+  from carparts.local import cleanOrders, readOrders
+
+  orders = cleanOrders(readOrders(arguments.files))
+  writeFrame(orders, arguments.output)
+  print(f"{len(orders)} orders written to {arguments.output}", file = sys.stderr)
+
+def featurizeCommand(arguments : argparse.Namespace) -> None:
+  """
+    Index the string columns and write the assembled features with the indexer labels
+  """
+
+  from carparts.local import applyIndexer, cleanOrders, featureMatrix, fitIndexer, indexedColumns
+
+  orders = cleanOrders(readFrames(arguments.files))
+  labels = fitIndexer(orders, list(indexedColumns))
+  indexed = applyIndexer(orders, labels, list(indexedColumns.values()))
+  features, featureNames = featureMatrix(indexed)
+
+  writeFrame(indexed[["ID"] + featureNames], arguments.output)
+  if arguments.labels:
+    with open(arguments.labels, "w") as labelFile:
+      json.dump({"labels" : labels, "features" : featureNames}, labelFile, indent = 2)
+
+  print(f"{features.shape[0]} rows, {features.shape[1]} features written to {arguments.output}", file = sys.stderr)
+
+def trainCommand(arguments : argparse.Namespace) -> None:
+  """
+    Run the single-node clustering and decision tree sweeps and pickle the chosen models
+  """
+
+  from carparts.local import localPipeline
+
+  result = localPipeline(readFrames(arguments.files),
+                         centroids = parseRange(arguments.centroids),
+                         depths = parseRange(arguments.depths),
+                         seed = arguments.seed,
+                         criterion = arguments.criterion,
+                         logToMlflow = arguments.mlflow)
+
+  with open(arguments.output, "wb") as modelFile:
+    pickle.dump(result, modelFile)
+
+  print(json.dumps({key : result[key] for key in ["rows", "k", "cost", "silhouette", "depth", "f1", "seconds"]}))
+
+def deployCommand(arguments : argparse.Namespace) -> None:
+  """
+    Export a trained pipeline as a scoring artifact, optionally logged to MLflow
+  """
+
+  from carparts.local import exportLocalArtifact
+
+  with open(arguments.model, "rb") as modelFile:
+    result = pickle.load(modelFile)
+
+  metadata = exportLocalArtifact(result, arguments.artifact)
+
+  if arguments.mlflow:
+    import mlflow
+    with mlflow.start_run(run_name = "Deploy Scoring Artifact", tags = {"backend" : "local"}):
+      mlflow.log_param("Chosen_Number_Centroids", str(result["k"]))
+      mlflow.log_param("Chosen_Maximum_depth", str(result["depth"]))
+      mlflow.log_artifact(arguments.artifact, artifact_path = "scoring")
+
+  print(json.dumps({"artifact" : arguments.artifact, "model" : metadata["model"], "maxDepth" : metadata["maxDepth"], "features" : metadata["features"]}))
+
+def scoreCommand(arguments : argparse.Namespace) -> None:
+  """
+    Score order files in batches and write the key columns next to the predictions
+  """
+
+  import pandas as pd
+
+  from carparts.local import cleanOrders
+  from carparts.scoring import loadScoringArtifact, scoreBatch
+
+  artifact = loadScoringArtifact(arguments.artifact)
+  orders = cleanOrders(readFrames(arguments.files))
+  keyCols = [c for c in arguments.keys.split(",") if c in orders.columns]
+
+  scored = []
+  for start in range(0, len(orders), arguments.batch_size):
+    batch = orders.iloc[start:start + arguments.batch_size]
+    predictions = scoreBatch(artifact, batch)
+    scored.append(pd.concat([batch.loc[predictions.index, keyCols], predictions], axis = 1))
+
+  writeFrame(pd.concat(scored, ignore_index = True) if scored else pd.DataFrame(columns = keyCols), arguments.output)
+
+def serveCommand(arguments : argparse.Namespace) -> None:
+  """
+    Serve invocations until interrupted
+  """
+
+  import asyncio
+
+  from carparts.serving import artifactScorer, registeredModelScorer, serve
+
+  scorer = artifactScorer(arguments.artifact) if arguments.artifact else registeredModelScorer(arguments.model_uri)
+  try:
+    asyncio.run(serve(scorer,
+                      host = arguments.host,
+                      port = arguments.port,
+                      maxBatchSize = arguments.max_batch_size,
+                      maxLatency = arguments.max_latency_ms / 1000))
+  except KeyboardInterrupt:
+    pass
+
+def streamCommand(arguments : argparse.Namespace) -> None:
+  """
+    Run the streaming segmentation on the active or a new spark session
+  """
+
+  from pyspark.sql import SparkSession
+
+  from carparts.streaming import segmentationStream
+
+  SparkSession.builder.appName("carparts-stream").getOrCreate()
+  segmentationStream(arguments.source,
+                     arguments.sink,
+                     arguments.checkpoint,
+                     sourceFormat = arguments.source_format,
+                     modelUri = arguments.model_uri,
+                     trigger = arguments.trigger,
+                     maxFilesPerTrigger = arguments.max_files).awaitTermination()
+
+def reportCommand(arguments : argparse.Namespace) -> None:
+  """
+    Order counts of the sanity checks, or per segment with a scoring artifact
+  """
+
+  from carparts.local import cleanOrders
+
+  orders = cleanOrders(readFrames(arguments.files))
+
+  if arguments.by == "segment":
+    from carparts.scoring import loadScoringArtifact, scoreBatch
+
+    artifact = loadScoringArtifact(arguments.artifact)
+    predictions = scoreBatch(artifact, orders)
+    orders = orders.loc[predictions.index].assign(segment = predictions[artifact["metadata"]["predictionCol"]].astype(int))
+
+  groupCols = {"daily" : ["Date"],
+               "weekly" : ["Week_Number", "WH_ID", "Order_Type"],
+               "segment" : ["segment"]}[arguments.by]
+
+  report = orders.groupby(groupCols)\
+                 .agg(records = ("ID", "count"), total_count_orders = ("Count_Of_Order_Number", "sum"))\
+                 .reset_index()\
+                 .sort_values(groupCols)
+
+  if arguments.output:
+    writeFrame(report, arguments.output)
+  else:
+    print(report.to_string(index = False))
+
+## ----------------------------------------------------------------------------
+## Entry Point : argument parsing and timing
+## ----------------------------------------------------------------------------
+
+def processStartTime() -> float:
+  """
+    Wall clock time the process started, so a cold start includes the interpreter and the imports
+
+    @return Seconds since the epoch, the import time of this module when /proc isn't available
+  """
+
+  try:
+    with open("/proc/self/stat") as statFile:
+      ## the command name may contain spaces, starttime is the 20th field after it
+      startTicks = int(statFile.read().rsplit(")", 1)[1].split()[19])
+    with open("/proc/uptime") as uptimeFile:
+      uptime = float(uptimeFile.read().split()[0])
+  except (OSError, ValueError, IndexError):
+    return importTime
+
+  return time.time() - uptime + startTicks / os.sysconf("SC_CLK_TCK")
+
+def parser() -> argparse.ArgumentParser:
+  """
+    @return Parser of every command, each with its stage function as `command`
+  """
+
+  root = argparse.ArgumentParser(prog = "carparts", description = "Carparts order segmentation pipeline")
+  commands = root.add_subparsers(dest = "name", required = True)
+
+  def command(name : str, function : Callable[[argparse.Namespace], None], description : str) -> argparse.ArgumentParser:
+    sub = commands.add_parser(name, help = description, description = description)
+    sub.set_defaults(command = function)
+    sub.add_argument("--timing", action = "store_true", help = "print the seconds since the process started to stderr")
+    return sub
+
+  ingest = command("ingest", ingestCommand, "read and clean landing csv files into an order table")
+  ingest.add_argument("files", nargs = "+", help = "landing csv files")
+  ingest.add_argument("--output", "-o", required = True, help = "order table, .parquet or .csv")
+
+  featurize = command("featurize", featurizeCommand, "index and assemble the features of orders")
+  featurize.add_argument("files", nargs = "+", help = "order table or landing csv files")
+  featurize.add_argument("--output", "-o", required = True, help = "feature table, .parquet or .csv")
+  featurize.add_argument("--labels", help = "json file receiving the indexer labels and feature order")
+
+  train = command("train", trainCommand, "run the single-node training pipeline")
+  train.add_argument("files", nargs = "+", help = "order table or landing csv files")
+  train.add_argument("--output", "-o", required = True, help = "pickle receiving the chosen models")
+  train.add_argument("--centroids", default = "2:15", help = "numbers of clusters to sweep, start:stop")
+  train.add_argument("--depths", default = "2:15", help = "tree depths to sweep, start:stop")
+  train.add_argument("--seed", type = int, default = 1)
+  train.add_argument("--criterion", choices = ["silhouette", "knee"], default = "silhouette", help = "k selection criterion")
+  train.add_argument("--mlflow", action = "store_true", help = "log the sweeps as nested MLflow runs")
+
+  deploy = command("deploy", deployCommand, "export a trained pipeline as a scoring artifact")
+  deploy.add_argument("model", help = "pickle written by carparts train")
+  deploy.add_argument("--artifact", "-o", required = True, help = ".npz scoring artifact")
+  deploy.add_argument("--mlflow", action = "store_true", help = "log the artifact to an MLflow run")
+
+  score = command("score", scoreCommand, "score order files with a scoring artifact")
+  score.add_argument("artifact", help = ".npz scoring artifact")
+  score.add_argument("files", nargs = "+", help = "order table or landing csv files")
+  score.add_argument("--output", "-o", help = ".parquet or .csv, csv on stdout when missing")
+  score.add_argument("--keys", default = "ID,Date,WH_ID,Order_Type,Year", help = "input columns copied next to the predictions")
+  score.add_argument("--batch-size", type = int, default = 100000, help = "rows per scored batch")
+
+  serve = command("serve", serveCommand, "serve a scoring artifact or a registered model")
+  serve.add_argument("--artifact", help = "vectorized scoring artifact to serve")
+  serve.add_argument("--model-uri", default = "models:/carparts_demo/latest", help = "registered model to serve without --artifact")
+  serve.add_argument("--host", default = "127.0.0.1")
+  serve.add_argument("--port", type = int, default = 5001)
+  serve.add_argument("--max-batch-size", type = int, default = 4096, help = "maximum rows per micro-batch")
+  serve.add_argument("--max-latency-ms", type = float, default = 5.0, help = "maximum wait for a micro-batch to fill")
+
+  stream = command("stream", streamCommand, "segment new orders with structured streaming")
+  stream.add_argument("source", help = "landing directory for csv, table name or path for delta")
+  stream.add_argument("--sink", required = True, help = "delta table name, or path when it contains a /")
+  stream.add_argument("--checkpoint", required = True, help = "checkpoint directory, one per sink")
+  stream.add_argument("--source-format", choices = ["csv", "delta"], default = "csv")
+  stream.add_argument("--model-uri", default = "models:/carparts_demo/latest", help = "registered deployment model")
+  stream.add_argument("--trigger", default = "1 minute", help = "processing time interval, or availableNow to process the backlog and stop")
+  stream.add_argument("--max-files", type = int, default = 10, help = "maximum new files per micro-batch")
+
+  report = command("report", reportCommand, "order counts per day, week or segment")
+  report.add_argument("files", nargs = "+", help = "order table or landing csv files")
+  report.add_argument("--by", choices = ["daily", "weekly", "segment"], default = "daily")
+  report.add_argument("--artifact", help = "scoring artifact segmenting the orders, needed by --by segment")
+  report.add_argument("--output", "-o", help = ".parquet or .csv, a table on stdout when missing")
+
+  return root
+
+def main(argv : Optional[List[str]] = None) -> int:
+  """
+    Run a carparts command
+
+    @return Exit status
+
+    @param argv          | command line arguments, sys.argv when missing
+  """
+
+  arguments = parser().parse_args(argv)
+
+  if arguments.name == "report" and arguments.by == "segment" and not arguments.artifact:
+    parser().error("report --by segment needs --artifact")
+
+  arguments.command(arguments)
+
+  if arguments.timing:
+    print(f"carparts {arguments.name} took {time.time() - processStartTime():.2f}s since the process started", file = sys.stderr)
+
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+  Bisecting k-means cut models
+
+  BisectingKMeans is divisive, so one fit at the largest number of centroids contains the splits of
+  every smaller fit. bisectionTree reads the tree out of a fitted model, cutBisectionTree replays the
+  order in which Spark splits clusters to cut it into fewer clusters, and BisectingKMeansCutModel
+  assigns points to the clusters of a cut.
+
+  Spark splits level by level and, when a level has more divisible clusters than centroids left to add,
+  only the largest ones. The cut expands the tree in the same order, so a cut model has the same
+  clusters as a direct BisectingKMeans(k) fit with the same seed down to the last level. The clusters
+  split on that last level start from different random centers in a direct fit, so their centers are
+  close to but not exactly those of the cut.
+
+  The model lives in the package rather than in a notebook so that saved and logged cut models load
+  anywhere carparts is installed. Needs pyspark, the carparts[spark] extra.
+"""
+
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+from pyspark.ml import Model
+from pyspark.ml.clustering import BisectingKMeansModel
+from pyspark.ml.functions import vector_to_array
+from pyspark.ml.param import Param, Params, TypeConverters
+from pyspark.ml.param.shared import HasFeaturesCol, HasPredictionCol
+from pyspark.ml.util import DefaultParamsReadable, DefaultParamsWritable
+from pyspark.sql import DataFrame
+from pyspark.sql.functions import pandas_udf
+
+## ----------------------------------------------------------------------------
+## Bisection Tree : read and cut the tree of a fitted model
+## ----------------------------------------------------------------------------
+
+def bisectionTree(model : BisectingKMeansModel) -> Dict[str, np.ndarray]:
+  """
+    Read the bisection tree out of a fitted bisecting k-means model
+
+    @return Dictionary of node centers, sizes, costs, children and leaf cluster indices, root first
+
+    @param model         | fitted bisecting k-means model
+  """
+
+  ## the tree isn't exposed to python, read it from the underlying mllib model
+  centers, sizes, costs, children, leaves = [], [], [], [], []
+
+  def visit(node) -> int:
+    index = len(centers)
+    centers.append(list(node.center().toArray()))
+    sizes.append(node.size())
+    costs.append(node.cost())
+    children.append([-1, -1])
+    leaves.append(node.index())
+
+    nodeChildren = list(node.children())
+    if nodeChildren:
+      children[index] = [visit(child) for child in nodeChildren]
+    return index
+
+  visit(model._java_obj.parentModel().root())
+
+  return {"centers" : np.array(centers),
+          "sizes" : np.array(sizes),
+          "costs" : np.array(costs),
+          "children" : np.array(children),
+          "leaves" : np.array(leaves)}
+
+def cutBisectionTree(tree : Dict[str, np.ndarray],
+                     nCentroids : int) -> np.ndarray:
+  """
+    Cut a bisection tree into a number of clusters in the order Spark splits them
+
+    @return cluster of every cut node, -1 for expanded nodes and nodes below the cut
+
+    @param tree          | bisection tree from bisectionTree
+    @param nCentroids    | number of clusters to cut the tree into
+  """
+
+  children, sizes = tree["children"], tree["sizes"]
+  cut, active = [0], [0]
+  needed = nCentroids - 1
+
+  ## every level splits the clusters created by the level before, the largest first when fewer splits are needed
+  while active and needed > 0:
+    divisible = [node for node in active if children[node, 0] >= 0]
+    if len(divisible) > needed:
+      divisible = sorted(divisible, key = lambda n : -sizes[n])[:needed]
+
+    for node in divisible:
+      cut.remove(node)
+      cut.extend(children[node])
+
+    needed -= len(divisible)
+    active = [child for node in divisible for child in children[node]]
+
+  clusters = np.full(len(sizes), -1)
+  clusters[sorted(cut)] = np.arange(len(cut))
+  return clusters
+
+## ----------------------------------------------------------------------------
+## Cut Model : spark model of a cut bisection tree
+## ----------------------------------------------------------------------------
+
+class BisectingKMeansCutModel(Model, HasFeaturesCol, HasPredictionCol, DefaultParamsReadable, DefaultParamsWritable):
+  """
+    Bisecting k-means model obtained by cutting a bisection tree,
+    points descend the tree towards the closer child until they reach a cut node
+  """
+
+  centers = Param(Params._dummy(), "centers", "center of every tree node", typeConverter = TypeConverters.toList)
+  children = Param(Params._dummy(), "children", "left and right child of every tree node, -1 for leaves", typeConverter = TypeConverters.toList)
+  clusters = Param(Params._dummy(), "clusters", "cluster of every cut node, -1 for expanded nodes", typeConverter = TypeConverters.toListInt)
+  trainingCost = Param(Params._dummy(), "trainingCost", "sum of squared distances of the points to their cluster centers", typeConverter = TypeConverters.toFloat)
+
+  def __init__(self, featuresCol : str = "features", predictionCol : str = "predictions"):
+    super(BisectingKMeansCutModel, self).__init__()
+    self._setDefault(featuresCol = featuresCol, predictionCol = predictionCol)
+
+  def getTrainingCost(self) -> float:
+    return self.getOrDefault(self.trainingCost)
+
+  def _transform(self, dataset : DataFrame) -> DataFrame:
+    centers = np.array(self.getOrDefault(self.centers))
+    children = np.array(self.getOrDefault(self.children))
+    clusters = np.array(self.getOrDefault(self.clusters))
+
+    @pandas_udf("int")
+    def predict(features : pd.Series) -> pd.Series:
+      points = np.stack(features.values)
+      node = np.zeros(len(points), dtype = int)
+
+      ## walk down the tree, ties go to the left child like BisectingKMeansModel
+      active = clusters[node] < 0
+      while active.any():
+        left, right = children[node[active], 0], children[node[active], 1]
+        toLeft = ((points[active] - centers[left]) ** 2).sum(axis = 1) <= ((points[active] - centers[right]) ** 2).sum(axis = 1)
+        node[active] = np.where(toLeft, left, right)
+        active = clusters[node] < 0
+
+      return pd.Series(clusters[node])
+
+    return dataset.withColumn(self.getPredictionCol(), predict(vector_to_array(self.getFeaturesCol())))
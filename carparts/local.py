@@ -0,0 +1,347 @@
+"""
+  Single-node backend
+
+  Runs the carparts training pipeline in-process on pandas and NumPy for datasets that fit comfortably
+  in memory: cleaning, string indexing, feature assembly, the bisecting k-means sweep, the decision tree
+  sweep, their evaluation and the MLflow logging. It mirrors the Spark path:
+
+  * labels are indexed by descending frequency, ties alphabetically, like StringIndexer
+  * features are assembled in the same column order as the VectorAssembler
+  * the clustering cost is the within cluster sum of squared distances and the silhouette uses squared
+    euclidean distances, like ClusteringEvaluator
+  * the classifier F1 is the weighted F1 of MulticlassClassificationEvaluator
+  * runs log the same params and metrics as the Spark trainers, tagged with backend = local
+
+  Reading, cleaning and indexing only need pandas and NumPy. scikit-learn is imported by the training
+  functions and MLflow when logging.
+"""
+
+import json
+import os
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+if TYPE_CHECKING:
+  from sklearn.cluster import BisectingKMeans
+  from sklearn.tree import DecisionTreeClassifier
+
+## ----------------------------------------------------------------------------
+## Load and Clean : read the landing csv files and remove censored rows
+## ----------------------------------------------------------------------------
+
+orderColumns = ["ID", "Count_Of_Order_Number", "Date", "Order_Type", "WH_ID", "Date_2",
+                "Year", "Week_Number", "Days_Until_IRS_Refund", "Days_Until_Stimulus_check"]
+orderTypes = {"ID" : "Int64", "Count_Of_Order_Number" : "Int64", "Order_Type" : str, "WH_ID" : str,
+              "Year" : "Int64", "Week_Number" : "Int64", "Days_Until_IRS_Refund" : "Int64", "Days_Until_Stimulus_check" : "Int64"}
+
+def readOrders(paths : Iterable[str]) -> pd.DataFrame:
+  """
+    Read landing csv files with the carparts schema
+
+    @return pandas DataFrame of the orders
+
+    @param paths         | csv files, their header row is replaced by the schema like the spark ingest
+  """
+
+  return pd.concat([pd.read_csv(path, header = 0, names = orderColumns, dtype = orderTypes, parse_dates = ["Date", "Date_2"])
+                    for path in paths],
+                   ignore_index = True)
+
+def cleanOrders(orders : pd.DataFrame) -> pd.DataFrame:
+  """
+    Remove censored data, same as the spark cleaning
+
+    @return Orders with an ID and no missing values
+
+    @param orders        | raw orders
+  """
+
+  return orders[orders["ID"].notna()].dropna().reset_index(drop = True)
+
+## ----------------------------------------------------------------------------
+## String Indexing and Feature Assembly : reproduce the StringIndexer and VectorAssembler stages
+## ----------------------------------------------------------------------------
+
+metadataColumns = ["ID", "Date", "Date_2", "file_source", "ingested_time", "Order_Type", "WH_ID"]
+indexedColumns = {"Order_Type" : "ORDER_TYPE_CATEGORY", "WH_ID" : "WH_ID_CATEGORY"}
+
+def fitIndexer(orders : pd.DataFrame,
+               inputCols : List[str]) -> Dict[str, List[str]]:
+  """
+    Labels of every string column, most frequent first and ties alphabetically
+
+    @return Dictionary of input column to its labels
+
+    @param orders        | cleaned orders
+    @param inputCols     | string columns to index
+  """
+
+  labels = {}
+  for c in inputCols:
+    counts = orders[c].astype(str).value_counts()
+    labels[c] = sorted(counts.index, key = lambda label : (-counts[label], label))
+  return labels
+
+def applyIndexer(orders : pd.DataFrame,
+                 labels : Dict[str, List[str]],
+                 outputCols : List[str]) -> pd.DataFrame:
+  """
+    Append the index of every string column
+
+    @return Orders with the indexed columns appended
+
+    @param orders        | cleaned orders
+    @param labels        | labels from fitIndexer
+    @param outputCols    | indexed column names, in the order of labels
+  """
+
+  indexed = orders.copy()
+  for (c, columnLabels), outputCol in zip(labels.items(), outputCols):
+    index = {label : float(i) for i, label in enumerate(columnLabels)}
+    indexed[outputCol] = indexed[c].astype(str).map(index)
+    if indexed[outputCol].isna().any():
+      raise ValueError(f"Unseen labels in {c}")
+  return indexed
+
+def featureMatrix(indexed : pd.DataFrame) -> Tuple[np.ndarray, List[str]]:
+  """
+    Assemble every column except the metadata and string columns
+
+    @return Feature matrix and its column names
+
+    @param indexed       | orders with the indexed columns
+  """
+
+  features = [c for c in indexed.columns if c not in metadataColumns]
+  return indexed[features].to_numpy(dtype = np.float64), features
+
+## ----------------------------------------------------------------------------
+## Clustering and Classification : bisecting k-means and decision tree with the spark evaluators' metrics
+## ----------------------------------------------------------------------------
+
+def localKMeans(features : np.ndarray,
+                k : int,
+                seed : int,
+                silhouetteSamples : int = 4000) -> Tuple["BisectingKMeans", float, float]:
+  """
+    Fit a bisecting k-means and evaluate it
+
+    @return Fitted model, within cluster cost and squared euclidean silhouette
+
+    @param features          | feature matrix
+    @param k                 | number of clusters
+    @param seed              | random seed
+    @param silhouetteSamples | rows the silhouette is computed on, exact below it
+  """
+
+  from sklearn.cluster import BisectingKMeans
+  from sklearn.metrics import silhouette_score
+
+  ## spark splits the largest divisible clusters first
+  model = BisectingKMeans(n_clusters = k, random_state = seed, bisecting_strategy = "largest_cluster").fit(features)
+
+  silhouette = -1.0
+  if len(np.unique(model.labels_)) > 1:
+    silhouette = float(silhouette_score(features, model.labels_,
+                                        metric = "sqeuclidean",
+                                        sample_size = silhouetteSamples if len(features) > silhouetteSamples else None,
+                                        random_state = seed))
+
+  return model, float(model.inertia_), silhouette
+
+def localDecisionTree(trainFeatures : np.ndarray,
+                      trainLabels : np.ndarray,
+                      testFeatures : np.ndarray,
+                      testLabels : np.ndarray,
+                      maxDepth : int,
+                      seed : int) -> Tuple["DecisionTreeClassifier", float]:
+  """
+    Fit a decision tree and evaluate it on the test rows
+
+    @return Fitted model and weighted F1
+
+    @param trainFeatures | training feature matrix
+    @param trainLabels   | training cluster labels
+    @param testFeatures  | testing feature matrix
+    @param testLabels    | testing cluster labels
+    @param maxDepth      | maximum depth of the tree
+    @param seed          | random seed
+  """
+
+  from sklearn.metrics import f1_score
+  from sklearn.tree import DecisionTreeClassifier
+
+  model = DecisionTreeClassifier(max_depth = maxDepth, random_state = seed).fit(trainFeatures, trainLabels)
+  return model, float(f1_score(testLabels, model.predict(testFeatures), average = "weighted"))
+
+def localKSelection(evaluated : Dict[int, Tuple["BisectingKMeans", float, float]],
+                    criterion : str = "silhouette") -> int:
+  """
+    Pick the number of clusters like kSelectionScores
+
+    @return Chosen number of clusters
+
+    @param evaluated     | Dictionary of number of clusters to (model, cost, silhouette)
+    @param criterion     | "silhouette" for the silhouette peak, "knee" for the knee of the cost curve
+  """
+
+  if criterion == "silhouette":
+    return max(evaluated, key = lambda k : evaluated[k][2])
+
+  if criterion == "knee":
+    ks = sorted(evaluated)
+    firstK, lastK = ks[0], ks[-1]
+    firstCost, lastCost = evaluated[firstK][1], evaluated[lastK][1]
+
+    ## distance below the chord between the first and last point of the normalized cost curve
+    return max(ks, key = lambda k : 1 - (k - firstK) / max(lastK - firstK, 1) - (evaluated[k][1] - lastCost) / max(firstCost - lastCost, 1e-12))
+
+  raise ValueError(f"Unknown k selection criterion {criterion}")
+
+## ----------------------------------------------------------------------------
+## Local Pipeline : clean, featurize, cluster, label and classify in-process
+## ----------------------------------------------------------------------------
+
+def localPipeline(orders : pd.DataFrame,
+                  centroids : range = range(2, 15),
+                  depths : range = range(2, 15),
+                  seed : int = 1,
+                  splitWeights : List[float] = [0.7, 0.3],
+                  criterion : str = "silhouette",
+                  logToMlflow : bool = True) -> Dict:
+  """
+    Run the training pipeline on a single node
+
+    @return Dictionary with the chosen clustering and tree, their metrics, the indexer labels, the features and the seconds taken
+
+    @param orders        | raw orders, e.g. from readOrders or a small spark table collected to pandas
+    @param centroids     | numbers of clusters to sweep
+    @param depths        | tree depths to sweep
+    @param seed          | random seed of the split, clustering and trees
+    @param splitWeights  | train and test weights
+    @param criterion     | k selection criterion, "silhouette" or "knee"
+    @param logToMlflow   | log the sweeps as nested MLflow runs
+  """
+
+  start = time.time()
+
+  cleaned = cleanOrders(orders)
+  labels = fitIndexer(cleaned, list(indexedColumns))
+  indexed = applyIndexer(cleaned, labels, list(indexedColumns.values()))
+  features, featureNames = featureMatrix(indexed)
+
+  ## k-means needs more rows than clusters
+  ks = [k for k in centroids if k < len(features)]
+  if not ks:
+    raise ValueError(f"The local pipeline needs more cleaned orders than clusters, got {len(features)} orders for centroids {list(centroids)}")
+
+  ## seeded bernoulli split with the weights of randomSplit
+  training = np.random.default_rng(seed).random(len(features)) < splitWeights[0] / sum(splitWeights)
+  if training.all() or not training.any():
+    raise ValueError(f"The split of {len(features)} cleaned orders with weights {splitWeights} left the training or testing rows empty")
+
+  if logToMlflow:
+    import mlflow
+    mlflow.start_run(run_name = "Local Pipeline", tags = {"backend" : "local"})
+    mlflow.log_param("Rows", str(len(cleaned)))
+
+  def childRun(name : str):
+    return mlflow.start_run(run_name = name, nested = True, tags = {"backend" : "local"})
+
+  try:
+    evaluated = {}
+    for k in ks:
+      evaluated[k] = localKMeans(features, k, seed)
+      if logToMlflow:
+        model, cost, silhouette = evaluated[k]
+        with childRun("K-Means"):
+          mlflow.log_param("Number_Centroids", str(k))
+          mlflow.log_param("seed", str(seed))
+          mlflow.log_metric("Training Data Rows", len(features))
+          mlflow.log_metric("Within Cluster Cost", cost)
+          mlflow.log_metric("Silhouette", silhouette)
+
+    optimalK = localKSelection(evaluated, criterion)
+    clusterModel = evaluated[optimalK][0]
+    clusters = clusterModel.labels_
+
+    trees = {}
+    for depth in depths:
+      trees[depth] = localDecisionTree(features[training], clusters[training], features[~training], clusters[~training], depth, seed)
+      if logToMlflow:
+        with childRun("Decision Tree"):
+          mlflow.log_param("Maximum_depth", depth)
+          mlflow.log_metric("Training Data Rows", int(training.sum()))
+          mlflow.log_metric("Test Data Rows", int((~training).sum()))
+          mlflow.log_metric("F1", trees[depth][1])
+
+    optimalDepth = max(trees, key = lambda depth : trees[depth][1])
+    seconds = time.time() - start
+
+    if logToMlflow:
+      mlflow.log_param("Chosen_Number_Centroids", str(optimalK))
+      mlflow.log_param("Chosen_Maximum_depth", str(optimalDepth))
+      mlflow.log_metric("Pipeline Seconds", seconds)
+  finally:
+    if logToMlflow:
+      mlflow.end_run()
+
+  return {"k" : optimalK,
+          "cost" : evaluated[optimalK][1],
+          "silhouette" : evaluated[optimalK][2],
+          "clusterModel" : clusterModel,
+          "depth" : optimalDepth,
+          "f1" : trees[optimalDepth][1],
+          "tree" : trees[optimalDepth][0],
+          "labels" : labels,
+          "features" : featureNames,
+          "rows" : len(cleaned),
+          "seconds" : seconds}
+
+## ----------------------------------------------------------------------------
+## Export : write the chosen tree as a vectorized scoring artifact
+## ----------------------------------------------------------------------------
+
+def exportLocalArtifact(result : Dict,
+                        path : str,
+                        predictionCol : str = "prediction") -> Dict:
+  """
+    Write the indexer labels, feature order and decision tree of a local pipeline run into a scoring artifact
+
+    @return Metadata of the artifact
+
+    @param result        | dictionary returned by localPipeline
+    @param path          | path of the .npz artifact, read by carparts.scoring.loadScoringArtifact
+    @param predictionCol | prediction column of the scored rows
+  """
+
+  tree = result["tree"].tree_
+  leaves = tree.children_left < 0
+
+  metadata = {"model" : "decision_tree",
+              "maxDepth" : int(result["tree"].get_depth()),
+              "indexers" : [{"inputCol" : inputCol,
+                             "outputCol" : indexedColumns[inputCol],
+                             "handleInvalid" : "error",
+                             "labels" : labels}
+                            for inputCol, labels in result["labels"].items()],
+              "features" : result["features"],
+              "assemblerHandleInvalid" : "error",
+              "predictionCol" : predictionCol}
+
+  ## scikit-learn sends values <= threshold left like the spark continuous splits, no categorical splits
+  arrays = {"feature" : np.where(leaves, -1, tree.feature).astype(np.int64),
+            "threshold" : np.where(leaves, 0.0, tree.threshold).astype(np.float64),
+            "categorical" : np.zeros(tree.node_count, dtype = bool),
+            "goesLeft" : np.zeros((tree.node_count, 1), dtype = bool),
+            "left" : tree.children_left.astype(np.int64),
+            "right" : tree.children_right.astype(np.int64),
+            "prediction" : result["tree"].classes_[tree.value[:, 0, :].argmax(axis = 1)].astype(np.float64)}
+
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+  np.savez_compressed(path, metadata = np.array(json.dumps(metadata)), **arrays)
+
+  return metadata
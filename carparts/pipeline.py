@@ -0,0 +1,475 @@
+"""
+  Stage runner
+
+  Runs the pipeline as a DAG of named stages. Every stage declares its inputs explicitly: the outputs of
+  its upstream stages, its params and external inputs resolved when it runs, e.g. the version of a
+  Delta table. The fingerprint of a stage hashes those inputs, the source of its function and of the
+  functions of the same module it calls, with the fingerprints of its upstream stages, so a change
+  anywhere upstream changes every fingerprint downstream of it.
+
+  A run only executes the stages whose fingerprint has no stored result. Stored results are loaded
+  instead, and upstream stages that no executed stage needs are not touched at all. Stages whose
+  upstream stages are done run concurrently on a bounded thread pool, and every stage's status and
+  seconds are kept for the run report.
+
+  Results are stored under <root>/<stage>/<fingerprint>. Spark ML models anywhere in a result are
+  saved with their own writers under sparkRoot, everything else is pickled. Only the standard library
+  is imported.
+"""
+
+import csv
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import pickle
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+## ----------------------------------------------------------------------------
+## Stages : a unit of work with explicit inputs
+## ----------------------------------------------------------------------------
+
+class Stage:
+  """
+    Named function of its upstream outputs, params and external inputs
+  """
+
+  def __init__(self,
+               name : str,
+               function : Callable[..., Any],
+               upstream : Iterable[str] = (),
+               params : Optional[Dict[str, Any]] = None,
+               inputs : Optional[Dict[str, Callable[[], Any]]] = None,
+               persist : bool = True,
+               version : str = "1"):
+    """
+      @param name          | stage name, also the keyword its output is passed to downstream stages under
+      @param function      | called with the upstream outputs, params and resolved inputs as keyword arguments
+      @param upstream      | names of the stages whose outputs the function reads
+      @param params        | JSON serializable arguments of the function
+      @param inputs        | functions resolving external inputs when the stage is fingerprinted, e.g. a table version
+      @param persist       | store the output, False for cheap or unserializable outputs like lazy DataFrames
+      @param version       | bumped by hand when the behaviour of the function changes without its source or the sources of the helpers it calls
+    """
+
+    self.name = name
+    self.function = function
+    self.upstream = list(upstream)
+    self.params = params or {}
+    self.inputs = inputs or {}
+    self.persist = persist
+    self.version = version
+
+def moduleFunctions(function : Callable) -> List[Callable]:
+  """
+    @return Functions of the module of a function that it refers to by global name, in its nested functions and lambdas as well
+
+    @param function      | stage function or one of its helpers
+  """
+
+  code = getattr(function, "__code__", None)
+  if code is None:
+    return []
+
+  names, codes = set(), [code]
+  while codes:
+    current = codes.pop()
+    names.update(current.co_names)
+    codes.extend(constant for constant in current.co_consts if inspect.iscode(constant))
+
+  namespace = getattr(function, "__globals__", {})
+  return [namespace[name] for name in sorted(names)
+          if inspect.isfunction(namespace.get(name)) and namespace[name].__module__ == function.__module__]
+
+def codeDigest(function : Callable) -> str:
+  """
+    @return Hash of the source of a function and of the functions of its module it calls directly or through
+            each other, qualified names stand in for sources that aren't available
+
+    @param function      | stage function
+  """
+
+  ## helpers like the trainers of a sweep are notebook globals next to the stage function
+  sources, pending, seen = [], [function], set()
+  while pending:
+    current = pending.pop(0)
+    if current in seen:
+      continue
+    seen.add(current)
+
+    try:
+      sources.append(inspect.getsource(current))
+    except (OSError, TypeError):
+      sources.append(getattr(current, "__qualname__", repr(current)))
+    pending.extend(moduleFunctions(current))
+
+  return hashlib.sha256("\n".join(sources).encode()).hexdigest()
+
+## ----------------------------------------------------------------------------
+## Result Store : stage outputs keyed by fingerprint
+## ----------------------------------------------------------------------------
+
+def isSparkModel(value : Any) -> bool:
+  """
+    @return Whether a value is saved with its own ML writer, Spark ML stages and models are
+
+    @param value         | part of a stage output
+  """
+
+  return callable(getattr(value, "write", None)) and callable(getattr(type(value), "load", None))
+
+def containsSparkModel(value : Any) -> bool:
+  if isinstance(value, dict):
+    return any(containsSparkModel(v) for v in value.values())
+  if isinstance(value, (list, tuple)):
+    return any(containsSparkModel(v) for v in value)
+  return isSparkModel(value)
+
+def saveOutput(value : Any,
+               path : str,
+               sparkPath : str,
+               name : str = "output") -> Dict:
+  """
+    Save a stage output, containers holding Spark models are walked and the models saved one by one
+
+    @return Manifest node describing how to load the output
+
+    @param value         | stage output
+    @param path          | local directory for pickles
+    @param sparkPath     | same directory as spark sees it, e.g. dbfs:/ for /dbfs/
+    @param name          | file name of this part of the output
+  """
+
+  if isSparkModel(value):
+    value.write().overwrite().save(f"{sparkPath}/{name}")
+    return {"kind" : "spark", "class" : f"{type(value).__module__}:{type(value).__qualname__}", "name" : name}
+
+  if isinstance(value, dict) and containsSparkModel(value):
+    return {"kind" : "dict",
+            "items" : [[key, saveOutput(item, path, sparkPath, f"{name}_{i}")] for i, (key, item) in enumerate(value.items())]}
+
+  if isinstance(value, (list, tuple)) and containsSparkModel(value):
+    return {"kind" : type(value).__name__,
+            "items" : [saveOutput(item, path, sparkPath, f"{name}_{i}") for i, item in enumerate(value)]}
+
+  with open(os.path.join(path, f"{name}.pkl"), "wb") as part:
+    pickle.dump(value, part)
+  return {"kind" : "pickle", "name" : name}
+
+def loadOutput(node : Dict,
+               path : str,
+               sparkPath : str) -> Any:
+  """
+    Load a stage output saved by saveOutput
+
+    @return Stage output
+
+    @param node          | manifest node from saveOutput
+    @param path          | local directory of the pickles
+    @param sparkPath     | same directory as spark sees it
+  """
+
+  if node["kind"] == "spark":
+    moduleName, className = node["class"].split(":")
+    cls = importlib.import_module(moduleName)
+    for attribute in className.split("."):
+      cls = getattr(cls, attribute)
+    return cls.load(f"{sparkPath}/{node['name']}")
+
+  if node["kind"] == "dict":
+    return {key : loadOutput(item, path, sparkPath) for key, item in node["items"]}
+
+  if node["kind"] in ("list", "tuple"):
+    items = [loadOutput(item, path, sparkPath) for item in node["items"]]
+    return tuple(items) if node["kind"] == "tuple" else items
+
+  with open(os.path.join(path, f"{node['name']}.pkl"), "rb") as part:
+    return pickle.load(part)
+
+class StageStore:
+  """
+    Directory of stage results, one sub directory per stage and fingerprint
+  """
+
+  def __init__(self,
+               root : str,
+               sparkRoot : Optional[str] = None):
+    """
+      @param root          | local directory, e.g. /dbfs/tmp/carparts_pipeline
+      @param sparkRoot     | the same directory as spark sees it, e.g. dbfs:/tmp/carparts_pipeline, root when missing
+    """
+
+    self.root = root
+    self.sparkRoot = sparkRoot or root
+
+  def paths(self, stage : str, fingerprint : str):
+    return os.path.join(self.root, stage, fingerprint), f"{self.sparkRoot}/{stage}/{fingerprint}"
+
+  def exists(self, stage : str, fingerprint : str) -> bool:
+    """
+      @return Whether a finished result is stored, the manifest is written last
+    """
+
+    return os.path.exists(os.path.join(self.paths(stage, fingerprint)[0], "manifest.json"))
+
+  def save(self,
+           stage : str,
+           fingerprint : str,
+           value : Any,
+           description : Dict) -> None:
+    """
+      Store the output of a stage
+
+      @param stage         | stage name
+      @param fingerprint   | fingerprint of the inputs the output was computed from
+      @param value         | stage output
+      @param description   | inputs and timing recorded next to the output
+    """
+
+    path, sparkPath = self.paths(stage, fingerprint)
+    os.makedirs(path, exist_ok = True)
+    manifest = {**description, "output" : saveOutput(value, path, sparkPath)}
+
+    ## the manifest marks the result as complete, a failed save leaves no result behind
+    with open(os.path.join(path, "manifest.json.tmp"), "w") as manifestFile:
+      json.dump(manifest, manifestFile, default = str, indent = 2)
+    os.replace(os.path.join(path, "manifest.json.tmp"), os.path.join(path, "manifest.json"))
+
+  def load(self, stage : str, fingerprint : str) -> Any:
+    """
+      @return Stored output of a stage
+    """
+
+    path, sparkPath = self.paths(stage, fingerprint)
+    with open(os.path.join(path, "manifest.json")) as manifestFile:
+      manifest = json.load(manifestFile)
+    return loadOutput(manifest["output"], path, sparkPath)
+
+## ----------------------------------------------------------------------------
+## Pipeline : fingerprint, plan and run the stages
+## ----------------------------------------------------------------------------
+
+class Pipeline:
+  """
+    DAG of stages run with skip-if-unchanged and concurrent independent stages
+  """
+
+  def __init__(self,
+               store : StageStore,
+               maxWorkers : int = 2,
+               force : bool = False):
+    """
+      @param store         | stored stage results
+      @param maxWorkers    | most stages running at the same time
+      @param force         | run every needed stage even when a result is stored
+    """
+
+    self.store = store
+    self.maxWorkers = maxWorkers
+    self.force = force
+    self.stages : Dict[str, Stage] = {}
+    self.outputs : Dict[str, tuple] = {} ## stage name to (fingerprint, output) of this session
+    self.report : List[Dict] = []
+    self.runId = time.strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:6]
+    self.lock = threading.Lock()
+
+  def add(self, stage : Stage) -> Stage:
+    """
+      Declare or redeclare a stage, its upstream stages have to be declared first
+
+      @return The stage
+
+      @param stage         | stage to add
+    """
+
+    missing = [name for name in stage.upstream if name not in self.stages]
+    if missing:
+      raise ValueError(f"Stage {stage.name} reads undeclared stages {missing}")
+    self.stages[stage.name] = stage
+    return stage
+
+  def fingerprints(self, targets : Iterable[str]) -> Dict[str, Dict]:
+    """
+      Resolve the inputs and fingerprint the targets and everything upstream of them
+
+      @return Dictionary of stage name to its fingerprint and resolved inputs
+
+      @param targets       | stage names
+    """
+
+    resolved : Dict[str, Dict] = {}
+
+    def visit(name : str) -> str:
+      if name not in resolved:
+        stage = self.stages[name]
+        inputs = {key : resolve() for key, resolve in stage.inputs.items()}
+        content = {"stage" : name,
+                   "version" : stage.version,
+                   "code" : codeDigest(stage.function),
+                   "params" : stage.params,
+                   "inputs" : inputs,
+                   "upstream" : {upstream : visit(upstream) for upstream in stage.upstream}}
+        resolved[name] = {"fingerprint" : hashlib.sha256(json.dumps(content, sort_keys = True, default = str).encode()).hexdigest(),
+                          "inputs" : inputs}
+      return resolved[name]["fingerprint"]
+
+    for target in targets:
+      visit(target)
+    return resolved
+
+  def plan(self,
+           targets : Iterable[str],
+           resolved : Optional[Dict[str, Dict]] = None) -> Dict[str, str]:
+    """
+      Decide how every stage a run needs gets its output
+
+      @return Dictionary of stage name to "memory" (computed earlier in this session), "hit" (loaded from the store)
+              or "run", stages upstream of a memory or hit stage are left out
+
+      @param targets       | stage names whose outputs are wanted
+      @param resolved      | fingerprints from fingerprints, computed when missing
+    """
+
+    targets = list(targets)
+    resolved = resolved or self.fingerprints(targets)
+    steps : Dict[str, str] = {}
+
+    def need(name : str) -> None:
+      if name in steps:
+        return
+      stage, fingerprint = self.stages[name], resolved[name]["fingerprint"]
+      if name in self.outputs and self.outputs[name][0] == fingerprint:
+        steps[name] = "memory"
+      elif stage.persist and not self.force and self.store.exists(name, fingerprint):
+        steps[name] = "hit"
+      else:
+        steps[name] = "run"
+        for upstream in stage.upstream:
+          need(upstream)
+
+    for target in targets:
+      need(target)
+    return steps
+
+  def run(self, targets : Iterable[str]) -> Dict[str, Any]:
+    """
+      Compute or load the outputs of the target stages
+
+      @return Dictionary of target name to its output
+
+      @param targets       | stage names
+    """
+
+    targets = list(targets)
+    resolved = self.fingerprints(targets)
+    steps = self.plan(targets, resolved)
+    values = {name : self.outputs[name][1] for name, step in steps.items() if step == "memory"}
+    start = time.time()
+
+    def execute(name : str) -> Any:
+      stage, fingerprint = self.stages[name], resolved[name]["fingerprint"]
+      if steps[name] == "hit":
+        return self.store.load(name, fingerprint)
+
+      stageStart = time.time()
+      value = stage.function(**{upstream : values[upstream] for upstream in stage.upstream},
+                             **stage.params,
+                             **resolved[name]["inputs"])
+      if stage.persist:
+        self.store.save(name, fingerprint, value, {"stage" : name,
+                                                   "fingerprint" : fingerprint,
+                                                   "params" : stage.params,
+                                                   "inputs" : resolved[name]["inputs"],
+                                                   "upstream" : {u : resolved[u]["fingerprint"] for u in stage.upstream},
+                                                   "seconds" : time.time() - stageStart,
+                                                   "created" : time.strftime("%Y-%m-%dT%H:%M:%S")})
+      return value
+
+    def record(name : str, status : str, started : float, seconds : float) -> None:
+      with self.lock:
+        self.report.append({"run" : self.runId,
+                            "stage" : name,
+                            "fingerprint" : resolved[name]["fingerprint"][:16],
+                            "status" : status,
+                            "started" : round(started - start, 3),
+                            "seconds" : round(seconds, 3)})
+
+    for name, step in steps.items():
+      if step == "memory":
+        record(name, "memory", start, 0.0)
+
+    ## stored results are loaded right away, stages to run wait for the stages they read to run or load
+    waiting = {name : [u for u in self.stages[name].upstream if steps[u] != "memory"] if step == "run" else []
+               for name, step in steps.items() if step != "memory"}
+    running, failures = {}, {}
+
+    with ThreadPoolExecutor(max_workers = self.maxWorkers) as pool:
+      while waiting or running:
+        for name in [name for name, blockers in waiting.items() if not blockers]:
+          del waiting[name]
+          running[pool.submit(execute, name)] = (name, time.time())
+
+        if not running:
+          break
+
+        done, _ = wait(running, return_when = FIRST_COMPLETED)
+        for future in done:
+          name, started = running.pop(future)
+          try:
+            values[name] = future.result()
+            self.outputs[name] = (resolved[name]["fingerprint"], values[name])
+            record(name, "hit" if steps[name] == "hit" else "ran", started, time.time() - started)
+          except Exception as error:
+            failures[name] = error
+            record(name, "failed", started, time.time() - started)
+
+          for blockers in waiting.values():
+            if name in blockers:
+              blockers.remove(name)
+
+        ## stages reading a failed stage never start
+        for name in [name for name in waiting if any(u in failures for u in self.stages[name].upstream)]:
+          del waiting[name]
+          failures.setdefault(name, None)
+          record(name, "cancelled", time.time(), 0.0)
+
+    if failures:
+      first = next(name for name, error in failures.items() if error is not None)
+      raise RuntimeError(f"Stages failed: {sorted(failures)}") from failures[first]
+
+    return {name : values[name] for name in targets}
+
+  def writeReport(self, name : Optional[str] = None) -> Dict:
+    """
+      Write the timing and cache hits of every stage this session touched, declared stages that were never
+      needed are reported as skipped
+
+      @return Dictionary with the report rows, totals and the paths written
+
+      @param name          | report file name without extension, the run id when missing
+    """
+
+    touched = {row["stage"] for row in self.report}
+    rows = self.report + [{"run" : self.runId, "stage" : stage, "fingerprint" : "", "status" : "skipped", "started" : 0.0, "seconds" : 0.0}
+                          for stage in self.stages if stage not in touched]
+
+    totals = {status : sum(1 for row in rows if row["status"] == status) for status in ["ran", "hit", "memory", "skipped", "failed", "cancelled"]}
+    totals["seconds"] = round(sum(row["seconds"] for row in rows if row["status"] in ("ran", "hit")), 3)
+
+    directory = os.path.join(self.store.root, "reports")
+    os.makedirs(directory, exist_ok = True)
+    base = os.path.join(directory, name or self.runId)
+
+    with open(f"{base}.json", "w") as reportFile:
+      json.dump({"run" : self.runId, "totals" : totals, "stages" : rows}, reportFile, indent = 2)
+    with open(f"{base}.csv", "w", newline = "") as reportFile:
+      writer = csv.DictWriter(reportFile, fieldnames = ["run", "stage", "fingerprint", "status", "started", "seconds"])
+      writer.writeheader()
+      writer.writerows(rows)
+
+    return {"stages" : rows, "totals" : totals, "paths" : [f"{base}.json", f"{base}.csv"]}
@@ -0,0 +1,210 @@
+"""
+  Vectorized scoring engine
+
+  Scores the carparts deployment pipeline without Spark. The pipeline is exported into a compact .npz
+  artifact holding the string indexer dictionaries, the feature order and the tree or ensemble node
+  arrays. The scorer evaluates whole pandas or Arrow batches with NumPy array operations.
+
+  Only NumPy and pandas are imported, the scoring command of the cli starts on this module alone.
+"""
+
+import json
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+## ----------------------------------------------------------------------------
+## Load a Scoring Artifact : read an exported deployment pipeline
+## ----------------------------------------------------------------------------
+
+def loadScoringArtifact(path : str) -> Dict:
+  """
+    Load a scoring artifact written by exportScoringArtifact or exportLocalArtifact
+
+    @return Dictionary with the pipeline metadata and node arrays
+
+    @param path          | path of the .npz artifact
+  """
+
+  with np.load(path, allow_pickle = False) as content:
+    artifact = {name : content[name] for name in content.files if name != "metadata"}
+    artifact["metadata"] = json.loads(str(content["metadata"]))
+
+  ## category lookups for the string indexers
+  artifact["indexers"] = [{"inputCol" : indexer["inputCol"],
+                           "outputCol" : indexer["outputCol"],
+                           "handleInvalid" : indexer["handleInvalid"],
+                           "index" : {label : float(i) for i, label in enumerate(indexer["labels"])},
+                           "size" : len(indexer["labels"])}
+                          for indexer in artifact["metadata"]["indexers"]]
+
+  return artifact
+
+## ----------------------------------------------------------------------------
+## Feature Assembly : reproduce the StringIndexer and VectorAssembler stages
+## ----------------------------------------------------------------------------
+
+def assembleFeatures(artifact : Dict,
+                     batch : pd.DataFrame,
+                     indexed : bool = False) -> np.ndarray:
+  """
+    Index the string columns and assemble the feature matrix
+
+    @return Feature matrix, one row per input row in the feature order of the artifact
+
+    @param artifact      | artifact from loadScoringArtifact
+    @param batch         | pandas DataFrame with the raw input columns
+    @param indexed       | batch already holds the index columns, e.g. rows of the feature table
+  """
+
+  columns = {}
+
+  for indexer in ([] if indexed else artifact["indexers"]):
+    values = batch[indexer["inputCol"]]
+    indices = values.map(indexer["index"])
+
+    unseen = indices.isna()
+    if unseen.any():
+      if indexer["handleInvalid"] == "keep":
+        indices = indices.fillna(float(indexer["size"]))
+      elif indexer["handleInvalid"] == "error":
+        raise ValueError(f"Unseen labels in {indexer['inputCol']}: {sorted(set(values[unseen].astype(str)))[:5]}")
+
+    columns[indexer["outputCol"]] = indices.to_numpy(dtype = np.float64)
+
+  features = np.column_stack([columns[c] if c in columns else batch[c].to_numpy(dtype = np.float64)
+                              for c in artifact["metadata"]["features"]])
+
+  if artifact["metadata"]["assemblerHandleInvalid"] == "error" and np.isnan(features).any():
+    raise ValueError("Null or NaN values in the assembled features")
+
+  return features
+
+## ----------------------------------------------------------------------------
+## Tree Evaluation : evaluate the decision tree or boosted trees with array operations
+## ----------------------------------------------------------------------------
+
+def decisionTreePredict(artifact : Dict,
+                        features : np.ndarray) -> np.ndarray:
+  """
+    Walk every row down a Spark decision tree at once
+
+    @return Predicted label per row
+
+    @param artifact      | artifact from loadScoringArtifact
+    @param features      | assembled feature matrix
+  """
+
+  feature, threshold = artifact["feature"], artifact["threshold"]
+  categorical, goesLeft = artifact["categorical"], artifact["goesLeft"]
+  left, right = artifact["left"], artifact["right"]
+
+  rows = np.arange(len(features))
+  node = np.zeros(len(features), dtype = np.int64)
+
+  for depth in range(artifact["metadata"]["maxDepth"]):
+    internal = left[node] >= 0
+    if not internal.any():
+      break
+    values = features[rows, np.maximum(feature[node], 0)]
+
+    ## categories no split sends left, like the unseen index of handleInvalid keep, go right as in spark
+    known = (values >= 0) & (values < goesLeft.shape[1])
+    categories = np.where(known, values, 0).astype(np.int64)
+
+    ## continuous splits send values <= threshold left, categorical splits their left categories
+    toLeft = np.where(categorical[node], known & goesLeft[node, categories], values <= threshold[node])
+    node = np.where(internal, np.where(toLeft, left[node], right[node]), node)
+
+  return artifact["prediction"][node]
+
+def boostedTreesMargins(artifact : Dict,
+                        features : np.ndarray) -> np.ndarray:
+  """
+    Sum the XGBoost leaf values of every row per class
+
+    @return Margins, shape (rows, number of tree groups)
+
+    @param artifact      | artifact from loadScoringArtifact
+    @param features      | assembled feature matrix
+  """
+
+  metadata = artifact["metadata"]
+
+  ## xgboost4j-spark reads sparse vectors, so zeros of rows VectorAssembler compresses are missing
+  values = features.astype(np.float32)
+  nonZeros = (features != 0).sum(axis = 1)
+  sparse = 1.5 * (nonZeros + 1.0) < features.shape[1]
+  values[sparse[:, None] & (features == 0)] = np.nan
+
+  feature, threshold = artifact["feature"], artifact["threshold"]
+  yes, no, missing = artifact["yes"], artifact["no"], artifact["missing"]
+
+  rows = np.arange(len(features))[:, None]
+  node = np.broadcast_to(artifact["roots"], (len(features), len(artifact["roots"]))).copy()
+
+  for depth in range(metadata["maxDepth"]):
+    internal = yes[node] >= 0
+    if not internal.any():
+      break
+    x = values[rows, np.maximum(feature[node], 0)]
+    nextNode = np.where(np.isnan(x), missing[node], np.where(x < threshold[node], yes[node], no[node]))
+    node = np.where(internal, nextNode, node)
+
+  leaves = artifact["leaf"][node]
+  groups = metadata["numGroups"]
+
+  ## accumulate tree by tree in float32, in the same order as xgboost
+  margins = np.zeros((len(features), groups), dtype = np.float32) + np.array(metadata["baseMargin"], dtype = np.float32)
+  for tree in range(leaves.shape[1]):
+    margins[:, tree % groups] += leaves[:, tree]
+
+  return margins
+
+## ----------------------------------------------------------------------------
+## Score a Batch : score a pandas or Arrow batch with the exported pipeline
+## ----------------------------------------------------------------------------
+
+def scoreBatch(artifact : Dict,
+               batch,
+               indexed : bool = False) -> pd.DataFrame:
+  """
+    Score every row of a batch
+
+    @return pandas DataFrame with the prediction column, and the probability column for boosted trees
+
+    @param artifact      | artifact from loadScoringArtifact
+    @param batch         | pandas DataFrame or Arrow table / record batch with the raw input columns
+    @param indexed       | batch already holds the index columns, e.g. rows of the feature table
+  """
+
+  if not isinstance(batch, pd.DataFrame):
+    batch = batch.to_pandas()
+
+  ## indexers that skip invalid labels drop their rows like StringIndexerModel
+  for indexer in ([] if indexed else artifact["indexers"]):
+    if indexer["handleInvalid"] == "skip":
+      batch = batch[batch[indexer["inputCol"]].isin(indexer["index"].keys())]
+
+  metadata = artifact["metadata"]
+  features = assembleFeatures(artifact, batch, indexed)
+  result = pd.DataFrame(index = batch.index)
+
+  if metadata["model"] == "decision_tree":
+    result[metadata["predictionCol"]] = decisionTreePredict(artifact, features)
+    return result
+
+  margins = boostedTreesMargins(artifact, features)
+
+  if metadata["numGroups"] == 1:
+    positive = 1 / (1 + np.exp(-margins[:, 0]))
+    probability = np.column_stack([1 - positive, positive])
+  else:
+    shifted = np.exp(margins - margins.max(axis = 1, keepdims = True))
+    probability = shifted / shifted.sum(axis = 1, keepdims = True)
+
+  result[metadata["predictionCol"]] = probability.argmax(axis = 1).astype(np.float64)
+  result["probability"] = list(probability.astype(np.float64))
+
+  return result
@@ -0,0 +1,499 @@
+"""
+  Micro-batching model server
+
+  Serves the carparts deployment model from a local process. The model is loaded once and an asyncio
+  front end accepts POST /invocations requests on keep-alive connections. Requests that arrive together
+  are coalesced into micro-batches, bounded by a maximum batch size in rows and a maximum wait, and every
+  batch is scored in a single call.
+
+  Payloads are Arrow IPC streams (application/vnd.apache.arrow.stream) when both sides have pyarrow,
+  negotiated through the Content-Type and Accept headers, with the MLflow JSON formats as fallback.
+
+  The server can run in a background thread of a notebook (startServer) or as its own process
+  (carparts serve --artifact <path>). The matching client sends batches concurrently over a pooled
+  requests session.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from carparts.scoring import loadScoringArtifact, scoreBatch
+
+## optional, payloads fall back to json without it
+try:
+  import pyarrow as pa
+except ImportError:
+  pa = None
+
+if TYPE_CHECKING:
+  import requests
+
+## ----------------------------------------------------------------------------
+## Scorers : scoring functions the server calls once per micro-batch
+## ----------------------------------------------------------------------------
+
+def artifactScorer(path : str) -> Callable[[pd.DataFrame], pd.DataFrame]:
+  """
+    Score with the vectorized scoring artifact, no JVM needed
+
+    @return Function scoring a pandas DataFrame
+
+    @param path          | path of the .npz artifact written by exportScoringArtifact
+  """
+
+  artifact = loadScoringArtifact(path)
+  return lambda frame : scoreBatch(artifact, frame)
+
+def registeredModelScorer(modelUri : str = "models:/carparts_demo/latest") -> Callable[[pd.DataFrame], pd.DataFrame]:
+  """
+    Score with a model from the MLflow registry, loaded once
+
+    @return Function scoring a pandas DataFrame
+
+    @param modelUri      | MLflow model URI of the registered model
+  """
+
+  import mlflow
+
+  model = mlflow.pyfunc.load_model(modelUri)
+
+  def score(frame : pd.DataFrame) -> pd.DataFrame:
+    predictions = model.predict(frame)
+    if isinstance(predictions, pd.DataFrame):
+      return predictions.set_index(frame.index)
+    return pd.DataFrame({"predictions" : np.asarray(predictions)}, index = frame.index)
+
+  return score
+
+## ----------------------------------------------------------------------------
+## Micro-Batcher : coalesce concurrent requests into micro-batches
+## ----------------------------------------------------------------------------
+
+class MicroBatcher:
+  """
+    Queue of pending requests scored together once the batch is full or the oldest request waited long enough
+  """
+
+  def __init__(self,
+               scorer : Callable[[pd.DataFrame], pd.DataFrame],
+               maxBatchSize : int = 4096,
+               maxLatency : float = 0.005):
+    """
+      @param scorer        | function scoring a pandas DataFrame
+      @param maxBatchSize  | maximum number of rows per batch
+      @param maxLatency    | maximum seconds a request waits for more requests to join its batch
+    """
+
+    self.scorer = scorer
+    self.maxBatchSize = maxBatchSize
+    self.maxLatency = maxLatency
+    self.queue : asyncio.Queue = asyncio.Queue()
+    self.batches = 0
+    self.requests = 0
+
+  async def submit(self, frame : pd.DataFrame) -> pd.DataFrame:
+    """
+      Score a request as part of the next micro-batch
+
+      @return Scored rows of the request
+
+      @param frame         | rows of the request
+    """
+
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((frame, future))
+    return await future
+
+  async def run(self) -> None:
+    """
+      Collect and score micro-batches until cancelled
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+      pending : List[Tuple[pd.DataFrame, asyncio.Future]] = [await self.queue.get()]
+      rows = len(pending[0][0])
+      deadline = time.monotonic() + self.maxLatency
+
+      ## keep adding requests until the batch is full or the oldest request waited long enough
+      while rows < self.maxBatchSize:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+          break
+        try:
+          pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+        rows += len(pending[-1][0])
+
+      frames = [frame.reset_index(drop = True) for frame, future in pending]
+
+      try:
+        ## score off the event loop so new requests keep queueing
+        scored = await loop.run_in_executor(None, self.scorer, pd.concat(frames, ignore_index = True))
+      except Exception as error:
+        for frame, future in pending:
+          if not future.done():
+            future.set_exception(error)
+        continue
+
+      self.batches += 1
+      self.requests += len(pending)
+
+      ## hand every request its own rows of the batch, scorers may drop invalid rows but keep the index
+      offset = 0
+      for frame, future in pending:
+        if not future.done():
+          future.set_result(scored[(scored.index >= offset) & (scored.index < offset + len(frame))])
+        offset += len(frame)
+
+## ----------------------------------------------------------------------------
+## Payload Formats : Arrow IPC stream payloads, with the MLflow JSON formats as fallback
+## ----------------------------------------------------------------------------
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+JSON = "application/json"
+
+def encodeArrow(frame : pd.DataFrame) -> bytes:
+  """
+    Write a pandas DataFrame as an Arrow IPC stream
+
+    @return Stream bytes
+
+    @param frame         | rows to send
+  """
+
+  table = pa.Table.from_pandas(frame, preserve_index = False)
+  sink = pa.BufferOutputStream()
+  with pa.ipc.new_stream(sink, table.schema) as writer:
+    writer.write_table(table)
+  return sink.getvalue().to_pybytes()
+
+def decodeArrow(body : bytes) -> pd.DataFrame:
+  """
+    Read an Arrow IPC stream, numeric columns stay views on the received buffer
+
+    @return pandas DataFrame
+
+    @param body          | stream bytes
+  """
+
+  table = pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+  return table.to_pandas(split_blocks = True, self_destruct = True)
+
+def parsePayload(body : bytes,
+                 contentType : str = JSON) -> pd.DataFrame:
+  """
+    Read an invocation payload into a pandas DataFrame
+
+    @return Rows to score
+
+    @param body          | Arrow IPC stream, or JSON MLflow dataframe_split / dataframe_records or a pandas "split" document
+    @param contentType   | content type of the body
+  """
+
+  if contentType.startswith(ARROW_STREAM):
+    return decodeArrow(body)
+
+  payload = json.loads(body)
+
+  ## the notebook used to post the pandas json string itself
+  if isinstance(payload, str):
+    payload = json.loads(payload)
+  if "dataframe_records" in payload:
+    return pd.DataFrame(payload["dataframe_records"])
+
+  split = payload.get("dataframe_split", payload)
+  return pd.DataFrame(split["data"], columns = split["columns"])
+
+def formatPredictions(scored : pd.DataFrame,
+                      accept : str = JSON) -> Tuple[str, bytes]:
+  """
+    Write scored rows as an Arrow IPC stream when accepted, otherwise in the MLflow JSON response format
+
+    @return Content type and body
+
+    @param scored        | scored rows of one request
+    @param accept        | Accept header of the request
+  """
+
+  if pa is not None and ARROW_STREAM in accept:
+    return ARROW_STREAM, encodeArrow(scored)
+
+  ## always records, so the column names survive like in the Arrow stream
+  predictions = json.loads(scored.to_json(orient = "records"))
+
+  return JSON, json.dumps({"predictions" : predictions}).encode()
+
+def decodePredictions(contentType : str,
+                      body : bytes) -> pd.DataFrame:
+  """
+    Read an invocation response of either format
+
+    @return Scored rows
+
+    @param contentType   | content type of the response
+    @param body          | response body
+  """
+
+  if contentType.startswith(ARROW_STREAM):
+    return decodeArrow(body)
+
+  predictions = json.loads(body)["predictions"]
+  if predictions and isinstance(predictions[0], dict):
+    return pd.DataFrame(predictions)
+
+  ## MLflow model servers answer a single column as a plain list without its name
+  return pd.DataFrame({"predictions" : predictions})
+
+## ----------------------------------------------------------------------------
+## HTTP Front End : minimal HTTP/1.1 front end with keep-alive connections
+## ----------------------------------------------------------------------------
+
+async def handleConnection(batcher : MicroBatcher,
+                           reader : asyncio.StreamReader,
+                           writer : asyncio.StreamWriter) -> None:
+  """
+    Answer the requests of one keep-alive connection
+
+    @param batcher       | micro-batcher scoring the invocations
+    @param reader        | connection input stream
+    @param writer        | connection output stream
+  """
+
+  try:
+    while True:
+      requestLine = await reader.readline()
+      if not requestLine:
+        break
+      method, target = requestLine.decode("latin-1").split()[:2]
+
+      headers = {}
+      while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+          break
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+      body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+      contentType = headers.get("content-type", JSON)
+      responseType = JSON
+
+      if method == "GET" and target == "/ping":
+        status, response = "200 OK", b"{}"
+      elif method == "POST" and target == "/invocations" and contentType.startswith(ARROW_STREAM) and pa is None:
+        ## lets clients fall back to json
+        status, response = "415 Unsupported Media Type", json.dumps({"error" : "pyarrow is not installed"}).encode()
+      elif method == "POST" and target == "/invocations":
+        try:
+          scored = await batcher.submit(parsePayload(body, contentType))
+          responseType, response = formatPredictions(scored, headers.get("accept", JSON))
+          status = "200 OK"
+        except Exception as error:
+          status, response = "400 Bad Request", json.dumps({"error" : str(error)}).encode()
+      else:
+        status, response = "404 Not Found", b"{}"
+
+      keepAlive = headers.get("connection", "").lower() != "close"
+      writer.write(f"HTTP/1.1 {status}\r\n"
+                   f"Content-Type: {responseType}\r\n"
+                   f"Content-Length: {len(response)}\r\n"
+                   f"Connection: {'keep-alive' if keepAlive else 'close'}\r\n\r\n".encode() + response)
+      await writer.drain()
+
+      if not keepAlive:
+        break
+  except (asyncio.IncompleteReadError, ConnectionResetError):
+    pass
+  finally:
+    writer.close()
+
+async def serve(scorer : Callable[[pd.DataFrame], pd.DataFrame],
+                host : str = "127.0.0.1",
+                port : int = 5001,
+                maxBatchSize : int = 4096,
+                maxLatency : float = 0.005,
+                started : Optional[threading.Event] = None) -> None:
+  """
+    Serve invocations until cancelled
+
+    @param scorer        | function scoring a pandas DataFrame, loaded once
+    @param host          | interface to listen on
+    @param port          | port to listen on
+    @param maxBatchSize  | maximum number of rows per micro-batch
+    @param maxLatency    | maximum seconds a request waits for more requests to join its batch
+    @param started       | event set once the server accepts connections
+  """
+
+  batcher = MicroBatcher(scorer, maxBatchSize = maxBatchSize, maxLatency = maxLatency)
+  batching = asyncio.ensure_future(batcher.run())
+  server = await asyncio.start_server(lambda reader, writer : handleConnection(batcher, reader, writer), host, port)
+
+  if started is not None:
+    started.set()
+
+  try:
+    async with server:
+      await server.serve_forever()
+  finally:
+    batching.cancel()
+
+def startServer(scorer : Callable[[pd.DataFrame], pd.DataFrame],
+                host : str = "127.0.0.1",
+                port : int = 5001,
+                maxBatchSize : int = 4096,
+                maxLatency : float = 0.005) -> Callable[[], None]:
+  """
+    Run the server on a background thread, e.g. next to a notebook
+
+    @return Function stopping the server
+
+    @param scorer        | function scoring a pandas DataFrame, loaded once
+    @param host          | interface to listen on
+    @param port          | port to listen on
+    @param maxBatchSize  | maximum number of rows per micro-batch
+    @param maxLatency    | maximum seconds a request waits for more requests to join its batch
+  """
+
+  loop = asyncio.new_event_loop()
+  started = threading.Event()
+  task : Dict = {}
+
+  def run() -> None:
+    asyncio.set_event_loop(loop)
+    task["serve"] = loop.create_task(serve(scorer, host, port, maxBatchSize, maxLatency, started))
+    try:
+      loop.run_until_complete(task["serve"])
+    except asyncio.CancelledError:
+      pass
+
+  threading.Thread(target = run, daemon = True).start()
+  started.wait()
+
+  return lambda : loop.call_soon_threadsafe(task["serve"].cancel)
+
+## ----------------------------------------------------------------------------
+## Scoring Client : pooled keep-alive client submitting batches concurrently
+## ----------------------------------------------------------------------------
+
+def scoringSession(poolSize : int = 16) -> "requests.Session":
+  """
+    Session reusing up to poolSize keep-alive connections per host
+
+    @return requests session
+
+    @param poolSize      | number of pooled connections
+  """
+
+  import requests
+  from requests.adapters import HTTPAdapter
+
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections = poolSize, pool_maxsize = poolSize)
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  return session
+
+def score_model(frames : List[pd.DataFrame],
+                url : str = "http://127.0.0.1:5001/invocations",
+                headers : Optional[Dict[str, str]] = None,
+                concurrency : int = 8,
+                session : Optional["requests.Session"] = None,
+                payloadFormat : str = "arrow") -> List[pd.DataFrame]:
+  """
+    Score batches concurrently against an invocations endpoint
+
+    @return Scored rows of every batch, in the order of frames
+
+    @param frames        | pandas DataFrames to score, one request each
+    @param url           | invocations endpoint
+    @param headers       | extra request headers, e.g. the bearer token of a remote endpoint
+    @param concurrency   | number of requests in flight
+    @param session       | pooled session from scoringSession, created when missing
+    @param payloadFormat | arrow sends Arrow IPC streams and falls back to json when the endpoint refuses them
+  """
+
+  session = session or scoringSession(concurrency)
+  arrow = {"enabled" : payloadFormat == "arrow" and pa is not None}
+
+  def post(frame : pd.DataFrame) -> pd.DataFrame:
+    if arrow["enabled"]:
+      response = session.post(url,
+                              data = encodeArrow(frame),
+                              headers = {**(headers or {}), "Content-Type" : ARROW_STREAM, "Accept" : f"{ARROW_STREAM}, {JSON}"})
+      if response.status_code != 415:
+        return checkedPredictions(response)
+      arrow["enabled"] = False
+
+    payload = {"dataframe_split" : json.loads(frame.to_json(orient = "split", date_format = "iso"))}
+    return checkedPredictions(session.post(url, json = payload, headers = headers))
+
+  with ThreadPoolExecutor(max_workers = concurrency) as pool:
+    return list(pool.map(post, frames))
+
+def checkedPredictions(response : "requests.Response") -> pd.DataFrame:
+  """
+    Decode a successful invocation response
+
+    @return Scored rows
+
+    @param response      | invocation response
+  """
+
+  if response.status_code != 200:
+    raise Exception(f'Request failed with status {response.status_code}, {response.text}')
+  return decodePredictions(response.headers.get("Content-Type", JSON), response.content)
+
+## ----------------------------------------------------------------------------
+## Payload Benchmark : compare wire size and serialization time of the payload formats
+## ----------------------------------------------------------------------------
+
+def payloadBenchmark(sample : pd.DataFrame,
+                     sizes : List[int] = [100, 10000, 1000000],
+                     repeats : int = 3) -> pd.DataFrame:
+  """
+    Encode and decode request payloads of growing size in both formats
+
+    @return pandas DataFrame with the bytes and best encode / decode seconds per format and size
+
+    @param sample        | rows to score, resampled to every size
+    @param sizes         | payload sizes in rows
+    @param repeats       | timing repetitions, the fastest is kept
+  """
+
+  formats = {JSON : lambda frame : json.dumps({"dataframe_split" : json.loads(frame.to_json(orient = "split", date_format = "iso"))}).encode()}
+  if pa is not None:
+    formats[ARROW_STREAM] = encodeArrow
+
+  report = []
+  for size in sizes:
+    frame = sample.sample(n = size, replace = len(sample) < size, random_state = 1).reset_index(drop = True)
+
+    for contentType, encode in formats.items():
+      encodeSeconds, decodeSeconds = [], []
+      for repeat in range(repeats):
+        start = time.perf_counter()
+        body = encode(frame)
+        encodeSeconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        parsePayload(body, contentType)
+        decodeSeconds.append(time.perf_counter() - start)
+
+      report.append({"rows" : size,
+                     "format" : contentType,
+                     "bytes" : len(body),
+                     "encode_seconds" : min(encodeSeconds),
+                     "decode_seconds" : min(decodeSeconds)})
+
+  return pd.DataFrame(report)
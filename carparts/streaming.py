@@ -0,0 +1,236 @@
+"""
+  Streaming segmentation
+
+  Segments newly arriving orders with Structured Streaming instead of re-running the batch transform after
+  every ingest. The stream reads either the raw CSV landing directory or the carparts_data Delta table.
+  Every micro-batch goes through the same cleaning filter as the batch notebook and the registered
+  deployment pipeline, and its predictions are upserted into a Delta sink keyed on ID.
+
+  The checkpoint tracks the source offsets, and the keyed upsert makes a replayed micro-batch a no-op, so
+  every order lands in the sink exactly once. trigger and maxFilesPerTrigger control latency and
+  micro-batch size. localSegmentationCheck runs the whole stream against a local CSV directory standing in
+  for the landing zone.
+
+  Needs pyspark, delta-spark and MLflow, the carparts[spark] extra.
+"""
+
+import os
+import tempfile
+from typing import Callable, List, Optional
+
+from delta.tables import DeltaTable
+from pyspark.ml import PipelineModel
+from pyspark.ml.functions import vector_to_array
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql.functions import current_timestamp, input_file_name
+from pyspark.sql.streaming import StreamingQuery
+from pyspark.sql.types import IntegerType, StringType, StructField, StructType, TimestampType
+
+## ----------------------------------------------------------------------------
+## Stream Sources : landing directory and Delta table sources of new orders
+## ----------------------------------------------------------------------------
+
+carpartsSchema = StructType([StructField("ID", IntegerType()),
+                             StructField("Count_Of_Order_Number", IntegerType()),
+                             StructField("Date", TimestampType()),
+                             StructField("Order_Type", StringType()),
+                             StructField("WH_ID", StringType()),
+                             StructField("Date_2", TimestampType()),
+                             StructField("Year", IntegerType()),
+                             StructField("Week_Number", IntegerType()),
+                             StructField("Days_Until_IRS_Refund", IntegerType()),
+                             StructField("Days_Until_Stimulus_check", IntegerType())])
+
+def orderStream(source : str,
+                sourceFormat : str = "csv",
+                maxFilesPerTrigger : int = 10) -> DataFrame:
+  """
+    Stream the orders of a landing directory or a Delta table
+
+    @return Streaming dataframe of cleaned orders
+
+    @param source             | landing directory for csv, table name or path for delta
+    @param sourceFormat       | csv or delta
+    @param maxFilesPerTrigger | maximum number of new files per micro-batch
+  """
+
+  spark = SparkSession.getActiveSession()
+
+  if sourceFormat == "csv":
+    orders = spark.readStream\
+                  .format("csv")\
+                  .option("header", "true")\
+                  .option("maxFilesPerTrigger", maxFilesPerTrigger)\
+                  .schema(carpartsSchema)\
+                  .load(source)\
+                  .withColumn("file_source", input_file_name())\
+                  .withColumn("ingested_time", current_timestamp())
+  else:
+    ## the ingest merges into carparts_data, rewritten files are replayed and deduplicated by the sink
+    reader = spark.readStream\
+                  .format("delta")\
+                  .option("maxFilesPerTrigger", maxFilesPerTrigger)\
+                  .option("ignoreChanges", "true")
+    orders = reader.load(source) if "/" in source else reader.table(source)
+
+  ## same cleaning as the batch notebook
+  return orders.filter(orders.ID.isNotNull())\
+               .na.drop()
+
+## ----------------------------------------------------------------------------
+## Segment a Micro-Batch : score every micro-batch with the deployment pipeline and upsert it into the sink
+## ----------------------------------------------------------------------------
+
+def deltaTable(spark : SparkSession,
+               sink : str) -> DeltaTable:
+  """
+    @return Delta table of a table name or path
+
+    @param spark         | spark session
+    @param sink          | table name, or path when it contains a /
+  """
+
+  return DeltaTable.forPath(spark, sink) if "/" in sink else DeltaTable.forName(spark, sink)
+
+def segmentBatch(pipelineModel : PipelineModel,
+                 sink : str,
+                 keyCols : List[str] = ["ID", "Date", "WH_ID", "Order_Type", "Year"],
+                 predictionCol : str = "prediction") -> Callable[[DataFrame, int], None]:
+  """
+    foreachBatch function segmenting a micro-batch
+
+    @return Function of the micro-batch and its id
+
+    @param pipelineModel | fitted deployment pipeline
+    @param sink          | delta table name, or path when it contains a /
+    @param keyCols       | order columns kept next to the predictions
+    @param predictionCol | prediction column of the pipeline
+  """
+
+  def segment(batch : DataFrame, batchId : int) -> None:
+    scored = pipelineModel.transform(batch.dropDuplicates(["ID"]))
+    columns = keyCols + [predictionCol]
+
+    if "probability" in scored.columns:
+      scored = scored.withColumn("probability", vector_to_array("probability"))
+      columns.append("probability")
+
+    segments = scored.select(*columns)\
+                     .withColumn("segmented_time", current_timestamp())
+
+    spark = batch.sparkSession
+    sinkExists = DeltaTable.isDeltaTable(spark, sink) if "/" in sink else spark.catalog.tableExists(sink)
+
+    ## the first micro-batch creates the sink
+    if not sinkExists:
+      writer = segments.write.format("delta").mode("append").partitionBy("Year")
+      if "/" in sink:
+        writer.save(sink)
+      else:
+        writer.saveAsTable(sink)
+      return
+
+    ## keyed upsert, a replayed micro-batch rewrites the same rows
+    deltaTable(spark, sink).alias("t")\
+                           .merge(segments.alias("s"), "t.ID = s.ID")\
+                           .whenMatchedUpdateAll()\
+                           .whenNotMatchedInsertAll()\
+                           .execute()
+
+  return segment
+
+## ----------------------------------------------------------------------------
+## Start the Segmentation Stream : continuously segment new orders
+## ----------------------------------------------------------------------------
+
+def segmentationStream(source : str,
+                       sink : str,
+                       checkpointLocation : str,
+                       sourceFormat : str = "csv",
+                       pipelineModel : Optional[PipelineModel] = None,
+                       modelUri : str = "models:/carparts_demo/latest",
+                       trigger : str = "1 minute",
+                       maxFilesPerTrigger : int = 10) -> StreamingQuery:
+  """
+    Start the streaming segmentation of new orders
+
+    @return Running streaming query
+
+    @param source             | landing directory for csv, table name or path for delta
+    @param sink               | delta table name, or path when it contains a /
+    @param checkpointLocation | checkpoint directory of the query, one per sink
+    @param sourceFormat       | csv or delta
+    @param pipelineModel      | deployment pipeline, loaded from modelUri when missing
+    @param modelUri           | registered deployment model
+    @param trigger            | processing time interval, or availableNow to process the backlog and stop
+    @param maxFilesPerTrigger | maximum number of new files per micro-batch
+  """
+
+  if pipelineModel is None:
+    import mlflow
+    pipelineModel = mlflow.spark.load_model(modelUri)
+
+  writer = orderStream(source, sourceFormat, maxFilesPerTrigger).writeStream\
+                                                                .foreachBatch(segmentBatch(pipelineModel, sink))\
+                                                                .option("checkpointLocation", checkpointLocation)\
+                                                                .queryName(f"segmentation_{sink.replace('/', '_')}")
+
+  writer = writer.trigger(availableNow = True) if trigger == "availableNow" else writer.trigger(processingTime = trigger)
+
+  return writer.start()
+
+## ----------------------------------------------------------------------------
+## Local File-Source Check : run the stream end to end against a local csv landing directory
+## ----------------------------------------------------------------------------
+
+def localSegmentationCheck(pipelineModel : PipelineModel,
+                           orders : DataFrame,
+                           drops : int = 3,
+                           workDir : Optional[str] = None) -> dict:
+  """
+    Drop order files one at a time into a local landing directory and check every order is segmented exactly once
+
+    @return Dictionary with the orders, segmented rows and distinct segmented IDs
+
+    @param pipelineModel | deployment pipeline
+    @param orders        | raw orders with the carparts schema, split into the file drops
+    @param drops         | number of files dropped into the landing directory
+    @param workDir       | local directory for the landing zone, sink and checkpoint, a temporary one when missing
+  """
+
+  workDir = workDir or tempfile.mkdtemp(prefix = "carparts_streaming_")
+  landing, sink, checkpoint = [os.path.join(workDir, name) for name in ["landing", "sink", "checkpoint"]]
+
+  orders = orders.select(*carpartsSchema.fieldNames())
+  parts = orders.randomSplit([1.0] * drops, seed = 1)
+
+  os.makedirs(landing, exist_ok = True)
+
+  for i, part in enumerate(parts):
+    ## write next to the landing directory and move in, the stream never sees a partial file
+    staged = os.path.join(workDir, f"drop_{i}.csv")
+    part.toPandas().to_csv(staged, index = False)
+    os.replace(staged, os.path.join(landing, f"drop_{i}.csv"))
+
+    ## one availableNow run per drop, each picks up only the files it has not seen
+    segmentationStream(landing, sink, checkpoint,
+                       pipelineModel = pipelineModel,
+                       trigger = "availableNow",
+                       maxFilesPerTrigger = 1).awaitTermination()
+
+  ## a restart without new files must not change the sink
+  segmentationStream(landing, sink, checkpoint,
+                     pipelineModel = pipelineModel,
+                     trigger = "availableNow").awaitTermination()
+
+  segments = SparkSession.getActiveSession().read.format("delta").load(sink)
+  cleaned = orders.filter(orders.ID.isNotNull()).na.drop()
+
+  report = {"orders" : cleaned.select("ID").distinct().count(),
+            "segmented_rows" : segments.count(),
+            "segmented_ids" : segments.select("ID").distinct().count()}
+
+  if not report["segmented_rows"] == report["segmented_ids"] == report["orders"]:
+    raise RuntimeError(f"Streaming segmentation lost or duplicated orders: {report}")
+
+  return report
@@ -107,25 +107,32 @@
 # MAGIC %md
 # MAGIC 
 # MAGIC # Install libraries
+# MAGIC 
+# MAGIC The pipeline code lives in the `carparts` package at the root of this repository, and Spark XGBoost comes from `sparkxgb`. Install both once as cluster or job libraries instead of on every run:
+# MAGIC 
+# MAGIC * build the wheel with `pip wheel --no-deps .` from the repository root and attach it to the cluster, or attach the repository itself
+# MAGIC * attach `git+https://github.com/sllynn/spark-xgboost.git` as a PyPI library, the `carparts[xgboost]` extra pins the same source
+# MAGIC * MLflow 2.12 or later, the sweeps start runs from worker threads and need its thread-local active run stack
+# MAGIC 
+# MAGIC The same package runs outside of Databricks with the `carparts` command line, e.g. `carparts train`, `carparts score` or `carparts report`.
 
 # COMMAND ----------
 
-# DBTITLE 1,Grab Spark XGBoost Library
-# MAGIC %sh
-# MAGIC git clone https://github.com/sllynn/spark-xgboost.git;
-# MAGIC cd spark-xgboost;
-# MAGIC pip install -e .;
-
-# COMMAND ----------
-
-# DBTITLE 1,Restart Python Instance
+# DBTITLE 1,Check the Cluster Libraries
 # MAGIC %python
 # MAGIC 
 # MAGIC """
-# MAGIC Restart Python to avoid an import error
+# MAGIC   Fail early when the cluster libraries are missing
 # MAGIC """
 # MAGIC 
-# MAGIC dbutils.library.restartPython()
+# MAGIC import importlib.util
+# MAGIC import mlflow
+# MAGIC from packaging.version import Version
+# MAGIC 
+# MAGIC missingLibraries = [name for name in ["carparts", "sparkxgb"] if importlib.util.find_spec(name) is None]
+# MAGIC 
+# MAGIC assert not missingLibraries, f"Attach {missingLibraries} as cluster libraries, see Install libraries"
+# MAGIC assert Version(mlflow.__version__) >= Version("2.12"), f"MLflow {mlflow.__version__} shares one active run between threads, attach mlflow>=2.12"
 
 # COMMAND ----------
 
@@ -172,24 +179,43 @@
 
 # MAGIC %md
 # MAGIC ### Ingest Data into Delta
+# MAGIC 
+# MAGIC By default the ingest runs incrementally: csv files already listed in `carparts_ingest_manifest` are skipped, new files are merged into `carparts_data` on `ID` and the table is compacted afterwards. Set `ingest_mode` to `full` to rebuild the table from every file.
+# MAGIC 
+# MAGIC The table is partitioned by `Year`, or by `WH_ID` when there are few warehouses with enough rows each, and Z-ordered on `Date` and `Order_Type` inside every partition. Queries filtering on a warehouse or a date range then skip files on the partition values and the per-file min/max stats. Incremental ingests only re-cluster the partitions they touched. An existing table with a different layout is rewritten once.
 
 # COMMAND ----------
 
 # DBTITLE 1,Ingest Data into Delta
 # MAGIC %scala
 # MAGIC 
-# MAGIC import org.apache.spark.sql.functions.{input_file_name, current_timestamp, regexp_extract, to_date};
+# MAGIC import org.apache.spark.sql.functions.{input_file_name, current_timestamp, regexp_extract, to_date, count, min};
 # MAGIC import org.apache.spark.sql.DataFrame;
 # MAGIC import org.apache.spark.sql.types.{StructType, StructField, IntegerType, StringType, TimestampType, FloatType, DateType};
+# MAGIC import io.delta.tables.DeltaTable;
 # MAGIC 
 # MAGIC /*
 # MAGIC 
 # MAGIC   Load the Caparts data into a dataframe
 # MAGIC 
+# MAGIC   ingest_mode:
+# MAGIC     "full"        | re-read every csv and overwrite carparts_data
+# MAGIC     "incremental" | only read csv files missing from the ingest manifest and MERGE them on ID
+# MAGIC 
+# MAGIC   partition_column:
+# MAGIC     "Year"  | one partition per year
+# MAGIC     "WH_ID" | one partition per warehouse, only worth it with few large warehouses
+# MAGIC     "auto"  | WH_ID when every warehouse fills a partition of min_partition_rows, Year otherwise
+# MAGIC 
 # MAGIC */
 # MAGIC 
+# MAGIC var ingest_mode : String = "incremental"; // full or incremental
+# MAGIC var partition_column : String = "auto"; // Year, WH_ID or auto
+# MAGIC var zorder_columns : String = "Date, Order_Type"; // clustered inside every partition, both have file level min/max stats
+# MAGIC var max_warehouse_partitions : Long = 200; // most WH_ID partitions before falling back to Year
+# MAGIC var min_partition_rows : Long = 1000000; // fewest rows per WH_ID partition before falling back to Year
 # MAGIC var data_source : String = "dbfs:/tmp/data/"; // sample data directory
-# MAGIC var data_files : Seq[String] = dbutils.fs.ls(data_source).filter(_.path.contains(".csv")).map(_.path); // covid csv paths
+# MAGIC var manifest_table : String = "carparts_ingest_manifest"; // files that have already been ingested
 # MAGIC var basename_regexp : String= "[^/]*(?=\\.[^.]+($|\\?))" // regex to extract the basename from a file (which contains the date)
 # MAGIC 
 # MAGIC /* specify the schema for the dataframe to ensure proper types */
@@ -205,24 +231,242 @@
 # MAGIC                       StructField("Days_Until_IRS_Refund", IntegerType),
 # MAGIC                       StructField("Days_Until_Stimulus_check", IntegerType)));
 # MAGIC 
+# MAGIC /* listing of the landing directory, (path, size) identifies a file drop */
+# MAGIC var df_listing : DataFrame = dbutils.fs.ls(data_source)
+# MAGIC                                    .filter(_.path.contains(".csv"))
+# MAGIC                                    .map(f => (f.path, f.size))
+# MAGIC                                    .toDF("file_source", "file_size");
+# MAGIC 
+# MAGIC var incremental : Boolean = ingest_mode == "incremental" && spark.catalog.tableExists("carparts_data") && spark.catalog.tableExists(manifest_table);
+# MAGIC 
+# MAGIC /* only keep the files that have not been ingested yet */
+# MAGIC var df_new_files : DataFrame = if (incremental) {
+# MAGIC                                  df_listing.join(spark.table(manifest_table).select("file_source", "file_size"),
+# MAGIC                                                  Seq("file_source", "file_size"),
+# MAGIC                                                  "left_anti")
+# MAGIC                                } else df_listing;
+# MAGIC 
+# MAGIC var new_files : Seq[String] = df_new_files.select("file_source").as[String].collect().toSeq;
+# MAGIC 
 # MAGIC var df_data : DataFrame = spark.read
 # MAGIC                               .format("csv") // files are in csv format
 # MAGIC                               .option("header", "true") // there's a header for each file
 # MAGIC                               .schema(data_schema) // specify schema to enforce types
-# MAGIC                               .load(data_files : _*) // load specified files using splat operator
+# MAGIC                               .load(new_files : _*) // load specified files using splat operator
 # MAGIC                               .withColumn("file_source", input_file_name) // append the source file path
 # MAGIC                               .withColumn("ingested_time", current_timestamp) // append the ingested time
 # MAGIC 
-# MAGIC df_data.write
-# MAGIC         .format("delta")
-# MAGIC         .mode("overwrite")
-# MAGIC         .option("overwriteSchema", "true")
-# MAGIC         .saveAsTable("carparts_data");
+# MAGIC /* partition by warehouse only when there are few warehouses with enough rows each */
+# MAGIC var layout_column : String = if (partition_column != "auto") partition_column else {
+# MAGIC   val warehouses = (if (incremental) spark.table("carparts_data") else df_data).groupBy("WH_ID").count()
+# MAGIC                                                                                .agg(count("*"), min("count"))
+# MAGIC                                                                                .first();
+# MAGIC   if (!warehouses.isNullAt(1) && warehouses.getLong(0) <= max_warehouse_partitions && warehouses.getLong(1) >= min_partition_rows) "WH_ID" else "Year"
+# MAGIC };
+# MAGIC 
+# MAGIC /* an existing table with another layout is rewritten once, delta reads the snapshot it replaces */
+# MAGIC if (incremental && spark.sql("DESCRIBE DETAIL carparts_data").select("partitionColumns").as[Seq[String]].first() != Seq(layout_column)) {
+# MAGIC   spark.table("carparts_data")
+# MAGIC        .write
+# MAGIC        .format("delta")
+# MAGIC        .mode("overwrite")
+# MAGIC        .option("overwriteSchema", "true")
+# MAGIC        .partitionBy(layout_column)
+# MAGIC        .saveAsTable("carparts_data");
+# MAGIC 
+# MAGIC   spark.sql(s"OPTIMIZE carparts_data ZORDER BY ($zorder_columns)");
+# MAGIC }
+# MAGIC 
+# MAGIC if (!incremental) {
+# MAGIC   df_data.write
+# MAGIC           .format("delta")
+# MAGIC           .mode("overwrite")
+# MAGIC           .option("overwriteSchema", "true")
+# MAGIC           .partitionBy(layout_column)
+# MAGIC           .saveAsTable("carparts_data");
+# MAGIC 
+# MAGIC   /* let delta bin-pack the files it writes for every later merge, record row changes for the rollups */
+# MAGIC   spark.sql("""ALTER TABLE carparts_data SET TBLPROPERTIES (delta.autoOptimize.optimizeWrite = true,
+# MAGIC                                                            delta.autoOptimize.autoCompact = true,
+# MAGIC                                                            delta.enableChangeDataFeed = true)""");
+# MAGIC 
+# MAGIC   /* cluster every partition so date and order type filters skip files on their min/max stats */
+# MAGIC   spark.sql(s"OPTIMIZE carparts_data ZORDER BY ($zorder_columns)");
+# MAGIC } else if (new_files.nonEmpty) {
+# MAGIC   /*
+# MAGIC     MERGE on ID so a replayed file updates rows rather than duplicating them,
+# MAGIC     rows without an ID are removed during cleaning and can't be merged on,
+# MAGIC     an order keeps its year and warehouse so the partition column prunes the target files
+# MAGIC   */
+# MAGIC   DeltaTable.forName(spark, "carparts_data")
+# MAGIC             .as("t")
+# MAGIC             .merge(df_data.filter($"ID".isNotNull).dropDuplicates("ID").as("s"), s"t.ID = s.ID AND t.$layout_column = s.$layout_column")
+# MAGIC             .whenMatched.updateAll()
+# MAGIC             .whenNotMatched.insertAll()
+# MAGIC             .execute();
+# MAGIC 
+# MAGIC   /* compact and cluster only the partitions the daily drops touched */
+# MAGIC   var touched : String = df_data.filter(df_data(layout_column).isNotNull)
+# MAGIC                                 .select(df_data(layout_column).cast("string"))
+# MAGIC                                 .distinct()
+# MAGIC                                 .as[String]
+# MAGIC                                 .collect()
+# MAGIC                                 .map(v => s"'${v.replace("'", "''")}'")
+# MAGIC                                 .mkString(", ");
+# MAGIC 
+# MAGIC   if (touched.nonEmpty) {
+# MAGIC     spark.sql(s"OPTIMIZE carparts_data WHERE $layout_column IN ($touched) ZORDER BY ($zorder_columns)");
+# MAGIC   }
+# MAGIC }
+# MAGIC 
+# MAGIC /* record the processed files in the manifest */
+# MAGIC df_new_files.withColumn("ingested_time", current_timestamp)
+# MAGIC             .write
+# MAGIC             .format("delta")
+# MAGIC             .mode(if (incremental) "append" else "overwrite")
+# MAGIC             .option("overwriteSchema", (!incremental).toString)
+# MAGIC             .saveAsTable(manifest_table);
+# MAGIC 
+# MAGIC println(s"ingest mode: ${if (incremental) "incremental" else "full"}, files read: ${new_files.size}, partitioned by: $layout_column");
 # MAGIC 
 # MAGIC display(df_data); // display the dataframe
 
 # COMMAND ----------
 
+# DBTITLE 1,Maintain Rollup Tables
+# MAGIC %python
+# MAGIC 
+# MAGIC from delta.tables import DeltaTable
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.functions import coalesce, col, lit, sum as sum_, when
+# MAGIC from typing import Dict, List
+# MAGIC 
+# MAGIC """
+# MAGIC   Keep the reporting aggregates of carparts_data up to date from its change data feed
+# MAGIC """
+# MAGIC 
+# MAGIC rollupSource : str = "carparts_data"
+# MAGIC rollupStateTable : str = "carparts_rollup_state" ## last source version folded into every rollup
+# MAGIC rollupKeys : Dict[str, List[str]] = {"carparts_rollup_daily" : ["date"],
+# MAGIC                                      "carparts_rollup_weekly" : ["week_number", "wh_id", "order_type"]}
+# MAGIC 
+# MAGIC ## operations whose row changes the change data feed describes, anything else rebuilds the rollups
+# MAGIC incrementalOperations = {"MERGE", "UPDATE", "DELETE", "OPTIMIZE", "SET TBLPROPERTIES"}
+# MAGIC 
+# MAGIC def rollupMeasures(rows : DataFrame,
+# MAGIC                    keys : List[str]) -> DataFrame:
+# MAGIC   """
+# MAGIC     Aggregate signed rows per rollup key
+# MAGIC     
+# MAGIC     @return Spark DataFrame with the keys, the number of records and the total count of orders
+# MAGIC     
+# MAGIC     @param rows          | carparts rows with a sign column, +1 for added and -1 for removed rows
+# MAGIC     @param keys          | rollup keys
+# MAGIC   """
+# MAGIC   
+# MAGIC   return rows.groupBy(*keys)\
+# MAGIC              .agg(sum_("sign").alias("records"),
+# MAGIC                   sum_(col("sign") * coalesce(col("Count_Of_Order_Number"), lit(0))).alias("total_count_orders"))
+# MAGIC 
+# MAGIC def rollupStartVersion(table : str) -> int:
+# MAGIC   """
+# MAGIC     First source version a rollup has not seen, -1 when it has to be rebuilt
+# MAGIC     
+# MAGIC     @return Delta version of the source table
+# MAGIC     
+# MAGIC     @param table         | rollup table
+# MAGIC   """
+# MAGIC   
+# MAGIC   if not spark.catalog.tableExists(table) or not spark.catalog.tableExists(rollupStateTable):
+# MAGIC     return -1
+# MAGIC   
+# MAGIC   state = spark.table(rollupStateTable).where(col("rollup") == table).first()
+# MAGIC   if state is None:
+# MAGIC     return -1
+# MAGIC   
+# MAGIC   startVersion = state["source_version"] + 1
+# MAGIC   operations = DeltaTable.forName(spark, rollupSource).history()\
+# MAGIC                                                      .where(col("version") >= startVersion)\
+# MAGIC                                                      .select("operation", "operationParameters")\
+# MAGIC                                                      .collect()
+# MAGIC   
+# MAGIC   for operation in operations:
+# MAGIC     appended = operation["operation"] == "WRITE" and operation["operationParameters"].get("mode") == "Append"
+# MAGIC     if operation["operation"] not in incrementalOperations and not appended:
+# MAGIC       return -1
+# MAGIC   
+# MAGIC   return startVersion
+# MAGIC 
+# MAGIC def updateRollups() -> Dict[str, Dict]:
+# MAGIC   """
+# MAGIC     Fold the rows changed since the last update into every rollup table
+# MAGIC     
+# MAGIC     @return Dictionary of rollup table to how it was updated and the number of changed rows it read
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## without the change data feed the next ingest could only rebuild
+# MAGIC   if spark.sql(f"SHOW TBLPROPERTIES {rollupSource}").where("key = 'delta.enableChangeDataFeed' AND value = 'true'").count() == 0:
+# MAGIC     spark.sql(f"ALTER TABLE {rollupSource} SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+# MAGIC   
+# MAGIC   sourceVersion = DeltaTable.forName(spark, rollupSource).history(1).first()["version"]
+# MAGIC   report = {}
+# MAGIC   
+# MAGIC   for table, keys in rollupKeys.items():
+# MAGIC     startVersion = rollupStartVersion(table)
+# MAGIC     
+# MAGIC     if startVersion < 0:
+# MAGIC       rows = spark.read.format("delta").option("versionAsOf", sourceVersion).table(rollupSource).withColumn("sign", lit(1))
+# MAGIC       rollupMeasures(rows, keys).write\
+# MAGIC                                 .format("delta")\
+# MAGIC                                 .mode("overwrite")\
+# MAGIC                                 .option("overwriteSchema", "true")\
+# MAGIC                                 .saveAsTable(table)
+# MAGIC       report[table] = {"mode" : "rebuild", "rows" : rows.count()}
+# MAGIC     
+# MAGIC     elif startVersion <= sourceVersion:
+# MAGIC       ## an updated row shows up as its pre image taken away and its post image added
+# MAGIC       changes = spark.read\
+# MAGIC                      .format("delta")\
+# MAGIC                      .option("readChangeFeed", "true")\
+# MAGIC                      .option("startingVersion", startVersion)\
+# MAGIC                      .option("endingVersion", sourceVersion)\
+# MAGIC                      .table(rollupSource)\
+# MAGIC                      .withColumn("sign", when(col("_change_type").isin("insert", "update_postimage"), 1).otherwise(-1))
+# MAGIC       
+# MAGIC       update = rollupMeasures(changes, keys)
+# MAGIC       matched = " AND ".join(f"t.{k} <=> s.{k}" for k in keys)
+# MAGIC       
+# MAGIC       ## delta skips a retried merge of the same source version
+# MAGIC       spark.conf.set("spark.databricks.delta.write.txnAppId", table)
+# MAGIC       spark.conf.set("spark.databricks.delta.write.txnVersion", str(sourceVersion))
+# MAGIC       try:
+# MAGIC         DeltaTable.forName(spark, table).alias("t")\
+# MAGIC                   .merge(update.alias("s"), matched)\
+# MAGIC                   .whenMatchedDelete(condition = "t.records + s.records = 0")\
+# MAGIC                   .whenMatchedUpdate(set = {"records" : "t.records + s.records",
+# MAGIC                                             "total_count_orders" : "t.total_count_orders + s.total_count_orders"})\
+# MAGIC                   .whenNotMatchedInsertAll(condition = "s.records <> 0")\
+# MAGIC                   .execute()
+# MAGIC       finally:
+# MAGIC         spark.conf.unset("spark.databricks.delta.write.txnAppId")
+# MAGIC         spark.conf.unset("spark.databricks.delta.write.txnVersion")
+# MAGIC       
+# MAGIC       report[table] = {"mode" : "incremental", "rows" : changes.count()}
+# MAGIC     
+# MAGIC     else:
+# MAGIC       report[table] = {"mode" : "unchanged", "rows" : 0}
+# MAGIC     
+# MAGIC     spark.createDataFrame([(table, sourceVersion)], "rollup STRING, source_version LONG").createOrReplaceTempView("rollup_progress")
+# MAGIC     spark.sql(f"CREATE TABLE IF NOT EXISTS {rollupStateTable} (rollup STRING, source_version LONG) USING DELTA")
+# MAGIC     spark.sql(f"""MERGE INTO {rollupStateTable} t USING rollup_progress s ON t.rollup = s.rollup
+# MAGIC                   WHEN MATCHED THEN UPDATE SET * WHEN NOT MATCHED THEN INSERT *""")
+# MAGIC   
+# MAGIC   return report
+# MAGIC 
+# MAGIC print(updateRollups())
+
+# COMMAND ----------
+
 # DBTITLE 1,Retrieve Data from Delta Lake
 # MAGIC %scala
 # MAGIC 
@@ -262,6 +506,8 @@
 # MAGIC %md
 # MAGIC 
 # MAGIC ## Sanity Checks
+# MAGIC 
+# MAGIC The checks read the `carparts_rollup_daily` and `carparts_rollup_weekly` rollup tables. After every ingest, "Maintain Rollup Tables" folds in only the rows the ingest changed, read from the change data feed of `carparts_data`. It rebuilds the rollups after a full overwrite.
 
 # COMMAND ----------
 
@@ -271,9 +517,9 @@
 # MAGIC -- look at the amount of records added to the data set over time
 # MAGIC 
 # MAGIC SELECT date,
-# MAGIC        count(date) as record_counts
-# MAGIC FROM carparts_data
-# MAGIC GROUP BY date
+# MAGIC        records as record_counts
+# MAGIC FROM carparts_rollup_daily
+# MAGIC WHERE date IS NOT NULL
 # MAGIC ORDER BY date asc;
 
 # COMMAND ----------
@@ -284,9 +530,8 @@
 # MAGIC -- look at the total number of count orders per date
 # MAGIC 
 # MAGIC SELECT date,
-# MAGIC        sum(Count_Of_Order_Number) as total_numer_of_count_orders
-# MAGIC FROM carparts_data
-# MAGIC GROUP BY date
+# MAGIC        total_count_orders as total_numer_of_count_orders
+# MAGIC FROM carparts_rollup_daily
 # MAGIC ORDER BY date asc;
 
 # COMMAND ----------
@@ -299,98 +544,374 @@
 # MAGIC SELECT week_number,
 # MAGIC        wh_id,
 # MAGIC        order_type,
-# MAGIC        sum(Count_Of_Order_Number) as total_numer_of_count_orders
-# MAGIC FROM carparts_data
-# MAGIC GROUP BY week_number,
-# MAGIC          wh_id,
-# MAGIC          order_type
+# MAGIC        total_count_orders as total_numer_of_count_orders
+# MAGIC FROM carparts_rollup_weekly
 # MAGIC ORDER BY week_number asc;
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ## Setup Dataframes for ML
 # MAGIC 
-# MAGIC Dataframes need to be featurized and split into train and test partitions for machine learning.
-
-# COMMAND ----------
-
-# MAGIC %md 
-# MAGIC ### Clean the data
+# MAGIC ### Layout Benchmark
+# MAGIC 
+# MAGIC Files and bytes the scans of typical filtered queries read from the current `carparts_data` layout, compared with the version before it was partitioned and Z-ordered. The old version is read through Delta time travel, so the comparison needs no copy of the table.
 
 # COMMAND ----------
 
-# DBTITLE 1,Remove Data That Doesn't Contain an ID
-# MAGIC %scala
+# DBTITLE 1,Bytes Read Before and After the Layout Change
+# MAGIC %python
 # MAGIC 
-# MAGIC /*
-# MAGIC   Remove censored data and cast data to proper data types
-# MAGIC */
+# MAGIC from delta.tables import DeltaTable
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.functions import col, date_sub, lit, max as max_, sum as sum_
+# MAGIC from typing import Callable, Dict, Optional
+# MAGIC import json
+# MAGIC import pandas as pd
 # MAGIC 
-# MAGIC val cleaned_df : DataFrame = df.filter($"ID".isNotNull)
-# MAGIC                                .na.drop()
+# MAGIC """
+# MAGIC   Measure what partition pruning and data skipping save
+# MAGIC """
 # MAGIC 
-# MAGIC cleaned_df.createOrReplaceTempView("cleaned_df")
+# MAGIC def scanMetrics(query : DataFrame) -> Dict[str, int]:
+# MAGIC   """
+# MAGIC     Run a query and sum the file scan metrics of its physical plan
+# MAGIC     
+# MAGIC     @return Dictionary with the number of files and bytes the scans read after pruning and skipping
+# MAGIC     
+# MAGIC     @param query         | dataframe reading a delta table
+# MAGIC   """
+# MAGIC   
+# MAGIC   query.collect()
+# MAGIC   
+# MAGIC   metrics = {"files" : 0, "bytes" : 0}
+# MAGIC   nodes = [query._jdf.queryExecution().executedPlan()]
+# MAGIC   
+# MAGIC   while nodes:
+# MAGIC     node = nodes.pop()
+# MAGIC     nodeMetrics = node.metrics()
+# MAGIC     if nodeMetrics.contains("filesSize"):
+# MAGIC       metrics["files"] += nodeMetrics.apply("numFiles").value()
+# MAGIC       metrics["bytes"] += nodeMetrics.apply("filesSize").value()
+# MAGIC     children = node.children()
+# MAGIC     nodes.extend(children.apply(i) for i in range(children.size()))
+# MAGIC   
+# MAGIC   return metrics
 # MAGIC 
-# MAGIC display(cleaned_df)
+# MAGIC def previousLayoutVersion(table : str) -> Optional[int]:
+# MAGIC   """
+# MAGIC     Latest version of the table partitioned differently from the current version
+# MAGIC     
+# MAGIC     @return Delta version, None when the retained history only has the current partitioning
+# MAGIC     
+# MAGIC     @param table         | name of the delta table
+# MAGIC   """
+# MAGIC   
+# MAGIC   current = list(spark.sql(f"DESCRIBE DETAIL {table}").first()["partitionColumns"])
+# MAGIC   layout, previous = None, None
+# MAGIC   
+# MAGIC   ## only creating or overwriting the table sets its partitioning, appends, merges and optimizes keep it
+# MAGIC   for change in DeltaTable.forName(spark, table).history().orderBy(col("version")).collect():
+# MAGIC     parameters = change["operationParameters"] or {}
+# MAGIC     if "partitionBy" in parameters and (parameters.get("mode") == "Overwrite" or change["operation"].startswith(("CREATE", "REPLACE"))):
+# MAGIC       layout = json.loads(parameters["partitionBy"])
+# MAGIC     if layout is not None and layout != current:
+# MAGIC       previous = change["version"]
+# MAGIC   
+# MAGIC   return previous
+# MAGIC 
+# MAGIC def layoutBenchmark(table : str,
+# MAGIC                     queries : Dict[str, Callable[[DataFrame], DataFrame]],
+# MAGIC                     beforeVersion : int) -> pd.DataFrame:
+# MAGIC   """
+# MAGIC     Compare the bytes read by the same queries on two versions of a table
+# MAGIC     
+# MAGIC     @return pandas DataFrame with the files and bytes read per query before and after
+# MAGIC     
+# MAGIC     @param table         | name of the delta table
+# MAGIC     @param queries       | query name to a function building the query on the table
+# MAGIC     @param beforeVersion | delta version with the old layout
+# MAGIC   """
+# MAGIC   
+# MAGIC   layouts = {"before" : spark.read.format("delta").option("versionAsOf", beforeVersion).table(table),
+# MAGIC              "after" : spark.table(table)}
+# MAGIC   
+# MAGIC   ## adaptive execution hides the scans behind query stages
+# MAGIC   adaptive = spark.conf.get("spark.sql.adaptive.enabled")
+# MAGIC   spark.conf.set("spark.sql.adaptive.enabled", "false")
+# MAGIC   
+# MAGIC   report = []
+# MAGIC   try:
+# MAGIC     for name, query in queries.items():
+# MAGIC       scans = {layout : scanMetrics(query(frame)) for layout, frame in layouts.items()}
+# MAGIC       report.append({"query" : name,
+# MAGIC                      "files_before" : scans["before"]["files"],
+# MAGIC                      "files_after" : scans["after"]["files"],
+# MAGIC                      "bytes_before" : scans["before"]["bytes"],
+# MAGIC                      "bytes_after" : scans["after"]["bytes"],
+# MAGIC                      "bytes_saved" : 1 - scans["after"]["bytes"] / max(scans["before"]["bytes"], 1)})
+# MAGIC   finally:
+# MAGIC     spark.conf.set("spark.sql.adaptive.enabled", adaptive)
+# MAGIC   
+# MAGIC   return pd.DataFrame(report)
+# MAGIC 
+# MAGIC benchmarkWarehouse, benchmarkOrderType = spark.table("carparts_data").select("WH_ID", "Order_Type").first()
+# MAGIC benchmarkLastDate = spark.table("carparts_data").agg(max_("Date")).first()[0]
+# MAGIC 
+# MAGIC layoutQueries = {"one warehouse" : lambda df : df.where(col("WH_ID") == benchmarkWarehouse).agg(sum_("Count_Of_Order_Number")),
+# MAGIC                  "last 30 days" : lambda df : df.where(col("Date") >= date_sub(lit(benchmarkLastDate), 30)).groupBy("Date").count(),
+# MAGIC                  "one warehouse, one order type, last 90 days" : lambda df : df.where((col("WH_ID") == benchmarkWarehouse)
+# MAGIC                                                                                      & (col("Order_Type") == benchmarkOrderType)
+# MAGIC                                                                                      & (col("Date") >= date_sub(lit(benchmarkLastDate), 90))).groupBy().count()}
+# MAGIC 
+# MAGIC layoutVersion = previousLayoutVersion("carparts_data")
+# MAGIC 
+# MAGIC if layoutVersion is not None:
+# MAGIC   display(layoutBenchmark("carparts_data", layoutQueries, beforeVersion = layoutVersion))
+# MAGIC else:
+# MAGIC   print("carparts_data has no earlier layout to compare with")
 
 # COMMAND ----------
 
 # MAGIC %md
+# MAGIC ## Setup Dataframes for ML
 # MAGIC 
-# MAGIC ### Featurize the Dataset
+# MAGIC Dataframes need to be featurized and split into train and test partitions for machine learning.
 
 # COMMAND ----------
 
-# DBTITLE 1,Create a ML Dataset
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Stage Pipeline
+# MAGIC 
+# MAGIC The training stages run through a `carparts.pipeline` stage DAG. Every stage declares its inputs: the `carparts_data` Delta version, its params and the outputs of its upstream stages. A stage is fingerprinted from those inputs, its code together with the notebook functions it calls, and the fingerprints upstream of it. When a stored result has the same fingerprint it is loaded from `pipelineStore` instead of recomputed, and the stages that only feed it are skipped. The k-means sweep, both tree sweeps, the cross validation, the deployment pipeline, its export and its registration are stored, so rerunning the notebook on unchanged data and params only rebuilds the lazy dataframes. The XGBoost and decision tree sweeps don't depend on each other and run concurrently. The last cell writes the per-stage timings and cache hits to `pipelineStore/reports`. Set `pipelineRerun = True` to recompute every stage.
+
+# COMMAND ----------
+
+# DBTITLE 1,Import the Stage Runner
+"""
+Fingerprinted stage DAG, from the carparts cluster library
+"""
+
+from carparts.pipeline import Pipeline, Stage, StageStore
+
+# COMMAND ----------
+
+# DBTITLE 1,Stage Pipeline
 # MAGIC %python
 # MAGIC 
-# MAGIC from pyspark.ml.feature import StandardScaler, VectorAssembler, OneHotEncoder, StringIndexer
+# MAGIC from delta.tables import DeltaTable
+# MAGIC from pyspark.sql.functions import col
+# MAGIC from typing import Dict
 # MAGIC 
 # MAGIC """
+# MAGIC   Declare the stage pipeline and its source data
+# MAGIC """
 # MAGIC 
-# MAGIC   Setup the datasets that will be used for this training example
+# MAGIC pipelineStore : str = "/dbfs/tmp/carparts_pipeline" ## stage results and reports, the same path as dbfs:/tmp/carparts_pipeline for spark
+# MAGIC pipelineRerun : bool = False ## True recomputes every stage instead of loading stored results
 # MAGIC 
-# MAGIC """
+# MAGIC ## operations that don't change the rows of a table
+# MAGIC layoutOperations = ["OPTIMIZE", "VACUUM START", "VACUUM END", "SET TBLPROPERTIES", "ZORDER BY"]
+# MAGIC 
+# MAGIC def dataVersion(table : str) -> int:
+# MAGIC   """
+# MAGIC     Latest Delta version that changed the rows of a table
+# MAGIC     
+# MAGIC     @return Delta version, layout changes and merges that matched nothing don't count
+# MAGIC     
+# MAGIC     @param table         | name of the delta table
+# MAGIC   """
+# MAGIC   
+# MAGIC   for change in DeltaTable.forName(spark, table).history().orderBy(col("version").desc()).collect():
+# MAGIC     metrics = change["operationMetrics"] or {}
+# MAGIC     if change["operation"] in layoutOperations:
+# MAGIC       continue
+# MAGIC     if change["operation"] == "MERGE" and all(int(metrics.get(m, 0)) == 0 for m in ["numTargetRowsInserted", "numTargetRowsUpdated", "numTargetRowsDeleted"]):
+# MAGIC       continue
+# MAGIC     return change["version"]
+# MAGIC   
+# MAGIC   return 0
 # MAGIC 
-# MAGIC df_cleaned = spark.sql("SELECT * FROM CLEANED_DF")
+# MAGIC def ingestStage(carparts_data : int) -> Dict:
+# MAGIC   """
+# MAGIC     Source stage, the ingest itself is incremental and runs above
+# MAGIC     
+# MAGIC     @return Dictionary with the source table and the version the pipeline reads
+# MAGIC     
+# MAGIC     @param carparts_data | Delta version of carparts_data
+# MAGIC   """
+# MAGIC   
+# MAGIC   return {"table" : "carparts_data", "version" : carparts_data}
+# MAGIC 
+# MAGIC stagePipeline = Pipeline(StageStore(pipelineStore, sparkRoot = pipelineStore.replace("/dbfs/", "dbfs:/", 1)),
+# MAGIC                          maxWorkers = 2,
+# MAGIC                          force = pipelineRerun)
 # MAGIC 
-# MAGIC indexer = StringIndexer(inputCols=["Order_Type", "WH_ID"],
-# MAGIC                         outputCols=["ORDER_TYPE_CATEGORY", "WH_ID_CATEGORY"]) ## encode text into indices for k-means calculations
+# MAGIC stagePipeline.add(Stage("ingest", ingestStage, inputs = {"carparts_data" : lambda : dataVersion("carparts_data")}, persist = False))
+# MAGIC print(stagePipeline.run(["ingest"])["ingest"])
+
+# COMMAND ----------
+
+# MAGIC %md 
+# MAGIC ### Clean the data
+
+# COMMAND ----------
+
+# DBTITLE 1,Remove Data That Doesn't Contain an ID
+# MAGIC %scala
 # MAGIC 
-# MAGIC df_indexed = indexer.fit(df_cleaned)\
-# MAGIC                     .transform(df_cleaned) ## generate the indexed dataframe
+# MAGIC /*
+# MAGIC   Remove censored data and cast data to proper data types
+# MAGIC */
 # MAGIC 
-# MAGIC features = [x for x in df_indexed.columns if x not in ["ID", "Date", "Date_2", "file_source", "ingested_time", "Order_Type", "WH_ID"]] ## use all features except metadata or those string indexed
+# MAGIC val cleaned_df : DataFrame = df.filter($"ID".isNotNull)
+# MAGIC                                .na.drop()
 # MAGIC 
-# MAGIC assembler = VectorAssembler(inputCols = features,
-# MAGIC                             outputCol = "features")
+# MAGIC cleaned_df.createOrReplaceTempView("cleaned_df")
+# MAGIC 
+# MAGIC display(cleaned_df)
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Setup the 70:30 train:test split
+# MAGIC 
+# MAGIC ### Calendar and Lag Features
+# MAGIC 
+# MAGIC With `calendarFeatureMode = "computed"` the calendar and lag features are derived in Spark instead of being read from the CSV. Days until and since every event of the `carparts_event_calendar` table come from a broadcast join of the distinct order dates with the calendar. The calendar is bootstrapped from the precomputed `Days_Until_*` columns, and new events are new rows. Lags and rolling means of `Count_Of_Order_Number` per `WH_ID` and `Order_Type` use range windows that share one partitioning and ordering, so they cost a single shuffle and sort however many horizons are configured. The lags need the order history of every series and a scored batch doesn't carry it, so models trained on computed features are for experiments only: the deployment cells refuse to build, export or register them.
 
 # COMMAND ----------
 
-# DBTITLE 1,Create the train and test datasets
+# DBTITLE 1,Calendar and Lag Features
 # MAGIC %python
 # MAGIC 
-# MAGIC from pyspark.sql import DataFrame;
+# MAGIC from pyspark.sql import DataFrame, Window
+# MAGIC from pyspark.sql.functions import avg, broadcast, col, date_add, datediff, dayofweek, lit, max as max_, min as min_, month, to_date, when
+# MAGIC from typing import Dict, List
 # MAGIC 
 # MAGIC """
-# MAGIC   Separate the training and testing dataset into two dataframes
+# MAGIC   Compute the calendar and lag features in the engine
 # MAGIC """
 # MAGIC 
-# MAGIC dfDataset = assembler.transform(df_indexed)
-# MAGIC trainingDF, testingDF = dfDataset.randomSplit([0.7, 0.3])
-
-# COMMAND ----------
-
-# MAGIC %md
-# MAGIC # Model Training
+# MAGIC calendarFeatureMode : str = "source" ## source keeps the csv columns, computed derives them here
+# MAGIC calendarFeatureConfig : Dict = {"calendarTable" : "carparts_event_calendar",
+# MAGIC                                 "bootstrapEvents" : {"IRS_Refund" : "Days_Until_IRS_Refund", ## event to the csv column it was precomputed in
+# MAGIC                                                      "Stimulus_check" : "Days_Until_Stimulus_check"},
+# MAGIC                                 "keys" : ["WH_ID", "Order_Type"],
+# MAGIC                                 "lagDays" : [1, 7, 28],
+# MAGIC                                 "rollingDays" : [7, 28]}
+# MAGIC 
+# MAGIC def eventCalendar(dataset : DataFrame,
+# MAGIC                   table : str,
+# MAGIC                   bootstrapEvents : Dict[str, str]) -> DataFrame:
+# MAGIC   """
+# MAGIC     Event calendar, created from the precomputed days-until columns the first time
+# MAGIC     
+# MAGIC     @return Spark DataFrame of (event, event_date)
+# MAGIC     
+# MAGIC     @param dataset         | cleaned carparts rows
+# MAGIC     @param table           | delta table of the calendar, add rows to add events
+# MAGIC     @param bootstrapEvents | event name to its days-until column in the csv
+# MAGIC   """
+# MAGIC   
+# MAGIC   if not spark.catalog.tableExists(table):
+# MAGIC     ## every order date plus its days until the event lands on an event date
+# MAGIC     events = [dataset.select(lit(event).alias("event"), date_add(to_date("Date"), col(column)).alias("event_date"))
+# MAGIC               for event, column in bootstrapEvents.items()]
+# MAGIC     
+# MAGIC     calendar = events[0]
+# MAGIC     for other in events[1:]:
+# MAGIC       calendar = calendar.unionByName(other)
+# MAGIC     
+# MAGIC     calendar.where(col("event_date").isNotNull())\
+# MAGIC             .distinct()\
+# MAGIC             .write\
+# MAGIC             .format("delta")\
+# MAGIC             .saveAsTable(table)
+# MAGIC   
+# MAGIC   return spark.table(table).select("event", to_date("event_date").alias("event_date"))
+# MAGIC 
+# MAGIC def calendarFeatures(dataset : DataFrame,
+# MAGIC                      calendar : DataFrame) -> DataFrame:
+# MAGIC   """
+# MAGIC     Days until the next and since the last date of every event, plus the day of week and month
+# MAGIC     
+# MAGIC     @return dataset with a Days_Until_<event> and Days_Since_<event> column per event, -1 without such a date
+# MAGIC     
+# MAGIC     @param dataset       | carparts rows
+# MAGIC     @param calendar      | event calendar of (event, event_date)
+# MAGIC   """
+# MAGIC   
+# MAGIC   events = sorted(row["event"] for row in calendar.select("event").distinct().collect())
+# MAGIC   
+# MAGIC   ## only the distinct order dates meet the calendar, both sides are small
+# MAGIC   days = dataset.select(to_date("Date").alias("day")).distinct()
+# MAGIC   offsets = days.crossJoin(broadcast(calendar))\
+# MAGIC                 .groupBy("day")\
+# MAGIC                 .pivot("event", events)\
+# MAGIC                 .agg(min_(when(col("event_date") >= col("day"), datediff("event_date", "day"))).alias("until"),
+# MAGIC                      min_(when(col("event_date") <= col("day"), datediff("day", "event_date"))).alias("since"))
+# MAGIC   
+# MAGIC   offsets = offsets.select("day", *[col(f"{event}_{direction}").alias(f"Days_{direction.capitalize()}_{event}")
+# MAGIC                                     for event in events for direction in ["until", "since"]])
+# MAGIC   
+# MAGIC   computed = [c for c in offsets.columns if c != "day"]
+# MAGIC   
+# MAGIC   return dataset.drop(*computed)\
+# MAGIC                 .join(broadcast(offsets), to_date(dataset["Date"]) == offsets["day"], "left")\
+# MAGIC                 .drop("day")\
+# MAGIC                 .na.fill(-1, subset = computed)\
+# MAGIC                 .withColumn("Day_Of_Week", dayofweek("Date"))\
+# MAGIC                 .withColumn("Month", month("Date"))
+# MAGIC 
+# MAGIC def lagFeatures(dataset : DataFrame,
+# MAGIC                 keys : List[str],
+# MAGIC                 lagDays : List[int],
+# MAGIC                 rollingDays : List[int]) -> DataFrame:
+# MAGIC   """
+# MAGIC     Lagged and rolling mean order counts per series
+# MAGIC     
+# MAGIC     @return dataset with a Count_Lag_<n>d column per lag and a Count_Mean_<n>d column per rolling window, 0 without earlier orders
+# MAGIC     
+# MAGIC     @param dataset       | carparts rows
+# MAGIC     @param keys          | columns identifying a series
+# MAGIC     @param lagDays       | lag horizons in days
+# MAGIC     @param rollingDays   | rolling window lengths in days, ending the day before
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## one partitioning and ordering for every window, spark shuffles and sorts once
+# MAGIC   day = datediff(to_date("Date"), lit("1970-01-01"))
+# MAGIC   series = Window.partitionBy(*keys).orderBy(day)
+# MAGIC   
+# MAGIC   lags = {f"Count_Lag_{n}d" : max_("Count_Of_Order_Number").over(series.rangeBetween(-n, -n)) for n in lagDays}
+# MAGIC   rolling = {f"Count_Mean_{n}d" : avg("Count_Of_Order_Number").over(series.rangeBetween(-n, -1)) for n in rollingDays}
+# MAGIC   
+# MAGIC   return dataset.select("*", *[column.alias(name) for name, column in {**lags, **rolling}.items()])\
+# MAGIC                 .na.fill(0, subset = list(lags) + list(rolling))
+# MAGIC 
+# MAGIC def engineeredFeatures(dataset : DataFrame,
+# MAGIC                        config : Dict = calendarFeatureConfig) -> DataFrame:
+# MAGIC   """
+# MAGIC     Calendar and lag featurization stage
+# MAGIC     
+# MAGIC     @return dataset with the computed features
+# MAGIC     
+# MAGIC     @param dataset       | cleaned carparts rows
+# MAGIC     @param config        | calendar table, events, series keys and horizons
+# MAGIC   """
+# MAGIC   
+# MAGIC   calendar = eventCalendar(dataset, config["calendarTable"], config["bootstrapEvents"])
+# MAGIC   return lagFeatures(calendarFeatures(dataset, calendar), config["keys"], config["lagDays"], config["rollingDays"])
 # MAGIC 
-# MAGIC For the purposes of this experiment, we will use MLFLOW to persist results and save models
+# MAGIC def checkDeployable(calendarFeatureMode : str) -> None:
+# MAGIC   """
+# MAGIC     Refuse to deploy models trained on computed features, the scoring paths only see the raw columns of a batch
+# MAGIC     
+# MAGIC     @param calendarFeatureMode | source keeps the csv columns, computed derives them
+# MAGIC   """
+# MAGIC   
+# MAGIC   if calendarFeatureMode == "computed":
+# MAGIC     raise ValueError("Models trained with calendarFeatureMode = 'computed' can't be deployed, "
+# MAGIC                      "their lag features need the order history the scored batches don't carry")
 
 # COMMAND ----------
 
@@ -410,594 +931,3313 @@
 
 # MAGIC %md
 # MAGIC 
-# MAGIC ## K-Means Model Training
+# MAGIC ### Training Backend
+# MAGIC 
+# MAGIC Small datasets don't need Spark. The `carparts_training` notebook is the entry point of training jobs: with its default `trainingBackend = "auto"` it trains at most `localBackendMaxRows` cleaned orders in-process with `carparts.local`, logged to this notebook's MLflow experiment, and runs this notebook as a child job for larger data. Running this notebook directly always trains on Spark, so Run All reaches the deployment and serving cells.
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Training Function
+# MAGIC 
+# MAGIC ### Featurize the Dataset
 
 # COMMAND ----------
 
-# DBTITLE 1,K-Means Training Function
+# DBTITLE 1,Create a ML Dataset
 # MAGIC %python
 # MAGIC 
-# MAGIC from pyspark.ml.clustering import BisectingKMeans, BisectingKMeansModel
-# MAGIC from pyspark.ml.evaluation import ClusteringEvaluator
+# MAGIC from pyspark.ml.feature import StandardScaler, VectorAssembler, OneHotEncoder, StringIndexer
 # MAGIC from pyspark.sql import DataFrame
-# MAGIC import mlflow
-# MAGIC from typing import Tuple
+# MAGIC from typing import Dict
 # MAGIC 
 # MAGIC """
-# MAGIC   Setup K-Means modeling
+# MAGIC 
+# MAGIC   Setup the datasets that will be used for this training example
+# MAGIC 
 # MAGIC """
 # MAGIC 
-# MAGIC def kMeansTrain(nCentroids : int,
-# MAGIC                 seed : int,
-# MAGIC                 dataset : DataFrame,
-# MAGIC                 featuresCol : str = "features") -> Tuple[BisectingKMeansModel,float]:
+# MAGIC def cleanStage(ingest : Dict,
+# MAGIC                calendarFeatureMode : str,
+# MAGIC                calendarFeatureConfig : Dict) -> DataFrame:
 # MAGIC   """
-# MAGIC     Setup K-Means modeling
+# MAGIC     Cleaned rows with the configured calendar and lag features
 # MAGIC     
-# MAGIC     @return Trained model
-# MAGIC     @return Silhouete with squared euclidean distance 
+# MAGIC     @return lazy Spark DataFrame
 # MAGIC     
-# MAGIC     @param nCentroids   | number of centroids to cluster around
-# MAGIC     @param seed          | random number seed
-# MAGIC     @param dataset       | Spark DataFrame containing features
-# MAGIC     @param featuresCol   | Name of the vectorized column
+# MAGIC     @param ingest                | source table and version
+# MAGIC     @param calendarFeatureMode   | source keeps the csv columns, computed derives them
+# MAGIC     @param calendarFeatureConfig | calendar table, events, series keys and horizons
 # MAGIC   """
 # MAGIC   
-# MAGIC   with mlflow.start_run() as run:
+# MAGIC   cleaned = spark.sql("SELECT * FROM CLEANED_DF")
 # MAGIC   
-# MAGIC     mlflow.log_param("Number_Centroids", str(nCentroids))
-# MAGIC     mlflow.log_metric("Training Data Rows", dataset.count())
-# MAGIC     mlflow.log_param("seed", str(seed))
-# MAGIC 
-# MAGIC     ## Start up the bisecting k-means model
-# MAGIC     bkm = BisectingKMeans()\
-# MAGIC                       .setFeaturesCol(featuresCol)\
-# MAGIC                       .setK(nCentroids)\
-# MAGIC                       .setSeed(seed)\
-# MAGIC                       .setPredictionCol("predictions")
-# MAGIC 
-# MAGIC     ## Start up the evaluator
-# MAGIC     evaluator = ClusteringEvaluator()\
-# MAGIC                       .setPredictionCol("predictions")
-# MAGIC 
-# MAGIC     ## Train a model
-# MAGIC     model = bkm.fit(dataset)
+# MAGIC   if calendarFeatureMode == "computed":
+# MAGIC     cleaned = engineeredFeatures(cleaned, config = calendarFeatureConfig) ## calendar and lag features from the event calendar and the order history
+# MAGIC   
+# MAGIC   return cleaned
 # MAGIC 
-# MAGIC     ## Make some predictions
-# MAGIC     predictions = model.transform(dataset)
+# MAGIC indexerColumns = {"Order_Type" : "ORDER_TYPE_CATEGORY", "WH_ID" : "WH_ID_CATEGORY"}
 # MAGIC 
-# MAGIC     ## Evaluate the clusters
-# MAGIC     silhouette = evaluator.evaluate(predictions)
+# MAGIC indexer = StringIndexer(inputCols=list(indexerColumns),
+# MAGIC                         outputCols=list(indexerColumns.values())) ## encode text into indices for k-means calculations
 # MAGIC 
-# MAGIC     ## Log some modeling metrics
-# MAGIC     mlflow.log_metric("Silhouette", silhouette)
-# MAGIC     mlflow.spark.log_model(model, f"K-Means_{nCentroids}")
+# MAGIC ## the dataframe is lazy, rebuilding it is cheaper than storing it
+# MAGIC stagePipeline.add(Stage("clean", cleanStage, ["ingest"],
+# MAGIC                         params = {"calendarFeatureMode" : calendarFeatureMode, "calendarFeatureConfig" : calendarFeatureConfig},
+# MAGIC                         persist = False))
 # MAGIC 
-# MAGIC   
-# MAGIC     ## Return the class and silhouette
-# MAGIC     return (model, silhouette)
+# MAGIC df_cleaned = stagePipeline.run(["clean"])["clean"]
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Train the K-Means Model
+# MAGIC 
+# MAGIC ### Feature Table
+# MAGIC 
+# MAGIC The indexed features are written once per `carparts_data` version to the `carparts_features` Delta table, next to the order keys (`ID`, `Date`, `WH_ID`, `Order_Type`) so scores read from it can be keyed like the streamed ones. The columns are typed, category indices are stored as `SMALLINT` with their StringIndexer metadata, and the parquet files are zstd compressed. Every row records the source table version and a fingerprint of the encoder (indexer labels and feature order), and the commit metadata keeps the full encoder. Only the newest `featureTableRetention` source versions are kept. Training sweeps and cross validation read the pruned feature columns of the current version and only run the VectorAssembler on top, instead of replaying the cleaning and indexing lineage.
+
+# COMMAND ----------
+
+# DBTITLE 1,Feature Table
+# MAGIC %python
+# MAGIC 
+# MAGIC from delta.tables import DeltaTable
+# MAGIC from pyspark.ml.feature import StringIndexer, StringIndexerModel, VectorAssembler
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.functions import col, lit
+# MAGIC from pyspark.sql.types import ShortType
+# MAGIC from typing import Dict, List
+# MAGIC import hashlib
+# MAGIC import json
+# MAGIC 
+# MAGIC """
+# MAGIC   Write the indexed features once per data version
+# MAGIC """
+# MAGIC 
+# MAGIC featureTable : str = "carparts_features"
+# MAGIC featureTableCodec : str = "zstd"
+# MAGIC featureTableRetention : int = 3 ## newest source versions kept in the feature table
+# MAGIC featureTableKeys : List[str] = ["ID", "Date", "WH_ID", "Order_Type"] ## order columns stored next to the features
+# MAGIC 
+# MAGIC def encoderDescription(indexerModel : StringIndexerModel,
+# MAGIC                        features : List[str]) -> Dict:
+# MAGIC   """
+# MAGIC     Everything that decides the feature values besides the data
+# MAGIC     
+# MAGIC     @return Dictionary with the labels of every indexed column and the feature order
+# MAGIC     
+# MAGIC     @param indexerModel  | fitted StringIndexerModel
+# MAGIC     @param features      | feature columns in assembly order
+# MAGIC   """
+# MAGIC   
+# MAGIC   return {"indexer" : dict(zip(indexerModel.getOutputCols(), indexerModel.labelsArray)),
+# MAGIC           "features" : features}
+# MAGIC 
+# MAGIC def encoderFingerprint(encoder : Dict) -> str:
+# MAGIC   """
+# MAGIC     Short digest of an encoder description
+# MAGIC     
+# MAGIC     @return Hex fingerprint
+# MAGIC     
+# MAGIC     @param encoder       | result of encoderDescription
+# MAGIC   """
+# MAGIC   
+# MAGIC   return hashlib.sha256(json.dumps(encoder, sort_keys = True).encode()).hexdigest()[:16]
+# MAGIC 
+# MAGIC def writeFeatureTable(dataset : DataFrame,
+# MAGIC                       indexerModel : StringIndexerModel,
+# MAGIC                       features : List[str],
+# MAGIC                       table : str = featureTable,
+# MAGIC                       sourceTable : str = "carparts_data",
+# MAGIC                       retention : int = featureTableRetention,
+# MAGIC                       keyColumns : List[str] = featureTableKeys) -> Dict:
+# MAGIC   """
+# MAGIC     Store the indexed features of the current source version, unless they are already stored
+# MAGIC     
+# MAGIC     @return Dictionary with the feature table, source version, encoder fingerprint and whether it was written
+# MAGIC     
+# MAGIC     @param dataset       | cleaned dataframe read from the source table
+# MAGIC     @param indexerModel  | fitted StringIndexerModel
+# MAGIC     @param features      | feature columns in assembly order
+# MAGIC     @param table         | delta feature table, partitioned by source version
+# MAGIC     @param sourceTable   | delta table the dataset was read from
+# MAGIC     @param retention     | newest source versions kept, older partitions are deleted after a write
+# MAGIC     @param keyColumns    | dataset columns stored next to the features, starting with the ID
+# MAGIC   """
+# MAGIC   
+# MAGIC   sourceVersion = DeltaTable.forName(spark, sourceTable).history(1).first()["version"]
+# MAGIC   encoder = encoderDescription(indexerModel, features)
+# MAGIC   encoderId = encoderFingerprint(encoder)
+# MAGIC   version = f"source_version = {sourceVersion} AND encoder = '{encoderId}'"
+# MAGIC   
+# MAGIC   ## versions written before a key column was stored have it null and are written again
+# MAGIC   stored = spark.catalog.tableExists(table)\
+# MAGIC            and set(keyColumns) <= set(spark.table(table).columns)\
+# MAGIC            and spark.table(table).where(version).where(" AND ".join(f"{c} IS NOT NULL" for c in keyColumns)).limit(1).count() > 0
+# MAGIC   
+# MAGIC   if not stored:
+# MAGIC     indexed = indexerModel.transform(dataset)
+# MAGIC     categorical = set(indexerModel.getOutputCols())
+# MAGIC     
+# MAGIC     ## category indices fit a smallint, the nominal metadata keeps them categorical for the trees
+# MAGIC     columns = [col(c) for c in keyColumns]\
+# MAGIC               + [col(c).cast(ShortType()).alias(c, metadata = indexed.schema[c].metadata) if c in categorical else col(c) for c in features if c not in keyColumns]\
+# MAGIC               + [lit(sourceVersion).alias("source_version"), lit(encoderId).alias("encoder")]
+# MAGIC     
+# MAGIC     previousCodec = spark.conf.get("spark.sql.parquet.compression.codec")
+# MAGIC     spark.conf.set("spark.sql.parquet.compression.codec", featureTableCodec)
+# MAGIC     
+# MAGIC     try:
+# MAGIC       indexed.select(*columns)\
+# MAGIC              .write\
+# MAGIC              .format("delta")\
+# MAGIC              .mode("overwrite")\
+# MAGIC              .option("replaceWhere", version)\
+# MAGIC              .option("mergeSchema", "true")\
+# MAGIC              .option("userMetadata", json.dumps({"source_table" : sourceTable, "source_version" : sourceVersion, "encoder" : encoder}))\
+# MAGIC              .partitionBy("source_version")\
+# MAGIC              .saveAsTable(table)
+# MAGIC     finally:
+# MAGIC       spark.conf.set("spark.sql.parquet.compression.codec", previousCodec)
+# MAGIC     
+# MAGIC     ## every ingest adds a partition, drop the ones older than the retention, VACUUM frees their files
+# MAGIC     kept = [row["source_version"] for row in spark.table(table).select("source_version").distinct().orderBy(col("source_version").desc()).limit(retention).collect()]
+# MAGIC     DeltaTable.forName(spark, table).delete(col("source_version") < min(kept))
+# MAGIC   
+# MAGIC   return {"table" : table, "source_version" : sourceVersion, "encoder" : encoderId, "written" : not stored}
+# MAGIC 
+# MAGIC def readFeatureTable(featureVersion : Dict,
+# MAGIC                      columns : List[str]) -> DataFrame:
+# MAGIC   """
+# MAGIC     Read the features of one source version and encoder
+# MAGIC     
+# MAGIC     @return Spark DataFrame with the ID and the requested columns
+# MAGIC     
+# MAGIC     @param featureVersion | result of writeFeatureTable
+# MAGIC     @param columns        | feature or key columns to read, the others are pruned
+# MAGIC   """
+# MAGIC   
+# MAGIC   return spark.table(featureVersion["table"])\
+# MAGIC               .where((col("source_version") == featureVersion["source_version"]) & (col("encoder") == featureVersion["encoder"]))\
+# MAGIC               .select("ID", *columns)
+# MAGIC 
+# MAGIC def featurizeStage(clean : DataFrame,
+# MAGIC                    indexerColumns : Dict[str, str],
+# MAGIC                    excludedColumns : List[str]) -> Dict:
+# MAGIC   """
+# MAGIC     Fit the indexer, choose the features and store them in the feature table
+# MAGIC     
+# MAGIC     @return Dictionary with the fitted indexer, the feature columns in assembly order and the feature table version
+# MAGIC     
+# MAGIC     @param clean           | cleaned dataframe
+# MAGIC     @param indexerColumns  | text column to its index column
+# MAGIC     @param excludedColumns | metadata and string indexed columns left out of the features
+# MAGIC   """
+# MAGIC   
+# MAGIC   indexerModel = StringIndexer(inputCols = list(indexerColumns), outputCols = list(indexerColumns.values())).fit(clean)
+# MAGIC   features = [x for x in indexerModel.transform(clean).columns if x not in excludedColumns] ## use all features except metadata or those string indexed
+# MAGIC   
+# MAGIC   return {"indexerModel" : indexerModel,
+# MAGIC           "features" : features,
+# MAGIC           "featureVersion" : writeFeatureTable(clean, indexerModel, features)}
+# MAGIC 
+# MAGIC stagePipeline.add(Stage("featurize", featurizeStage, ["clean"],
+# MAGIC                         params = {"indexerColumns" : indexerColumns,
+# MAGIC                                   "excludedColumns" : ["ID", "Date", "Date_2", "file_source", "ingested_time", "Order_Type", "WH_ID"]}))
+# MAGIC 
+# MAGIC featurized = stagePipeline.run(["featurize"])["featurize"]
+# MAGIC indexerModel, features, featureVersion = featurized["indexerModel"], featurized["features"], featurized["featureVersion"] ## keep the fitted indexer for the deployment pipeline
+# MAGIC 
+# MAGIC assembler = VectorAssembler(inputCols = features,
+# MAGIC                             outputCol = "features")
+# MAGIC print(featureVersion)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Materialize the ML Dataframes
+# MAGIC 
+# MAGIC The featurized and split dataframes are lazy, so every training call would otherwise replay the Delta read, cleaning, indexing, assembly and split. The frames are cached once under a temp view name with a configurable storage level, or checkpointed to truncate the lineage, and released once the sweeps finish.
+
+# COMMAND ----------
+
+# DBTITLE 1,Materialization Stage
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from typing import Dict, Iterable, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Compute the featurized and split dataframes once per pipeline run
+# MAGIC """
+# MAGIC 
+# MAGIC materializationStorageLevel : str = "MEMORY_AND_DISK" ## any pyspark StorageLevel name
+# MAGIC materializationCheckpoint : bool = False ## checkpoint to truncate the lineage before caching
+# MAGIC materializationCheckpointDir : str = "dbfs:/tmp/carparts_checkpoints"
+# MAGIC featureBinningCache : Dict[Tuple[str, int], DataFrame] = {} ## (view name, max bins) to the cached binned frame of the current labels
+# MAGIC 
+# MAGIC def materializeFrames(frames : Dict[str, DataFrame],
+# MAGIC                       storageLevel : str = materializationStorageLevel,
+# MAGIC                       checkpoint : bool = materializationCheckpoint) -> Dict[str, DataFrame]:
+# MAGIC   """
+# MAGIC     Cache dataframes under temp view names
+# MAGIC     
+# MAGIC     @return Dictionary of view name to the materialized dataframe
+# MAGIC     
+# MAGIC     @param frames        | Dictionary of view name to dataframe
+# MAGIC     @param storageLevel  | Storage level used to cache the dataframes
+# MAGIC     @param checkpoint    | Checkpoint the dataframes before caching them
+# MAGIC   """
+# MAGIC   
+# MAGIC   if checkpoint:
+# MAGIC     sc.setCheckpointDir(materializationCheckpointDir)
+# MAGIC   
+# MAGIC   materialized = {}
+# MAGIC   
+# MAGIC   for name, frame in frames.items():
+# MAGIC     ## cut the lineage so later stages never replay the upstream plan
+# MAGIC     if checkpoint:
+# MAGIC       frame = frame.checkpoint(eager = True)
+# MAGIC     
+# MAGIC     frame.createOrReplaceTempView(name)
+# MAGIC     
+# MAGIC     ## CACHE TABLE is eager, the frame is computed here exactly once
+# MAGIC     spark.sql(f"CACHE TABLE {name} OPTIONS ('storageLevel' '{storageLevel}')")
+# MAGIC     materialized[name] = spark.table(name)
+# MAGIC   
+# MAGIC   return materialized
+# MAGIC 
+# MAGIC def releaseFrames(names : Iterable[str]) -> None:
+# MAGIC   """
+# MAGIC     Unpersist dataframes cached by materializeFrames
+# MAGIC     
+# MAGIC     @param names         | temp view names of the cached dataframes
+# MAGIC   """
+# MAGIC   
+# MAGIC   for name in names:
+# MAGIC     spark.sql(f"UNCACHE TABLE IF EXISTS {name}")
+# MAGIC 
+# MAGIC def releaseBinnedFeatures() -> None:
+# MAGIC   """
+# MAGIC     Unpersist every cached binned frame
+# MAGIC   """
+# MAGIC   
+# MAGIC   releaseFrames([f"{name}_bins_{maxBins}" for name, maxBins in featureBinningCache])
+# MAGIC   featureBinningCache.clear()
+# MAGIC 
+# MAGIC def materializedFramesReport(names : Iterable[str]) -> DataFrame:
+# MAGIC   """
+# MAGIC     Report how much memory and disk the cached dataframes use
+# MAGIC     
+# MAGIC     @return Spark DataFrame with the storage used per cached view
+# MAGIC     
+# MAGIC     @param names         | temp view names of the cached dataframes
+# MAGIC   """
+# MAGIC   
+# MAGIC   cacheManager = spark._jsparkSession.sharedState().cacheManager()
+# MAGIC   
+# MAGIC   ## the cache manager knows which rdd holds the cached columns of each view
+# MAGIC   rddIds = {}
+# MAGIC   for name in names:
+# MAGIC     if spark.catalog.tableExists(name) and spark.catalog.isCached(name):
+# MAGIC       cached = cacheManager.lookupCachedData(spark.table(name)._jdf)
+# MAGIC       if cached.isDefined():
+# MAGIC         rddIds[cached.get().cachedRepresentation().cacheBuilder().cachedColumnBuffers().id()] = name
+# MAGIC   
+# MAGIC   report = [(rddIds[info.id()], info.memSize(), info.diskSize(), info.numCachedPartitions())
+# MAGIC             for info in sc._jsc.sc().getRDDStorageInfo() if info.id() in rddIds]
+# MAGIC   
+# MAGIC   return spark.createDataFrame(report, "view STRING, memory_bytes LONG, disk_bytes LONG, cached_partitions INT")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Setup the 70:30 train:test split
+
+# COMMAND ----------
+
+# DBTITLE 1,Create the train and test datasets
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml.feature import VectorAssembler
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from typing import Dict, List
+# MAGIC 
+# MAGIC """
+# MAGIC   Separate the training and testing dataset into two dataframes
+# MAGIC """
+# MAGIC 
+# MAGIC splitWeights = [0.7, 0.3]
+# MAGIC splitSeed = 1 ## fixed so reruns see the same split
+# MAGIC 
+# MAGIC def splitStage(featurize : Dict,
+# MAGIC                weights : List[float],
+# MAGIC                seed : int) -> Dict[str, DataFrame]:
+# MAGIC   """
+# MAGIC     Assemble the stored features and split them into cached training and testing frames
+# MAGIC     
+# MAGIC     @return Dictionary with the dataset, training and testing dataframes
+# MAGIC     
+# MAGIC     @param featurize     | feature columns and feature table version
+# MAGIC     @param weights       | split weights
+# MAGIC     @param seed          | split seed
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## assemble the stored features, the cleaning and indexing lineage is not replayed
+# MAGIC   dataset = materializeFrames({"ml_dataset" : VectorAssembler(inputCols = featurize["features"], outputCol = "features")\
+# MAGIC                                                   .transform(readFeatureTable(featurize["featureVersion"], featurize["features"]))})["ml_dataset"]
+# MAGIC   training, testing = dataset.randomSplit(weights, seed = seed)
+# MAGIC   
+# MAGIC   ## cache the split so every trainer sees the same partitions
+# MAGIC   splitFrames = materializeFrames({"training_df" : training, "testing_df" : testing})
+# MAGIC   
+# MAGIC   return {"dataset" : dataset, "training" : splitFrames["training_df"], "testing" : splitFrames["testing_df"]}
+# MAGIC 
+# MAGIC ## cached frames only live as long as the cluster, the split is redone every run
+# MAGIC stagePipeline.add(Stage("split", splitStage, ["featurize"], params = {"weights" : splitWeights, "seed" : splitSeed}, persist = False))
+# MAGIC 
+# MAGIC splitFrames = stagePipeline.run(["split"])["split"]
+# MAGIC dfDataset, trainingDF, testingDF = splitFrames["dataset"], splitFrames["training"], splitFrames["testing"]
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Model Training
+# MAGIC 
+# MAGIC For the purposes of this experiment, we will use MLFLOW to persist results and save models, in the experiment set up before the training backend is selected
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Training Cache
+# MAGIC 
+# MAGIC Trained models are cached by content. Each training run is tagged with a key hashed from the `carparts_data` Delta version, the featurization and split config, the labeling cluster model and the effective estimator params. A later call with the same key loads the cached MLflow model instead of fitting again, and every run logs the running hit and miss counts. The context is rebuilt at the start of every notebook run. The default `hierarchical` k-means and `truncated` decision tree sweeps fit a single model each and don't go through this cache, the stage pipeline stores their results instead.
+
+# COMMAND ----------
+
+# DBTITLE 1,Training Cache
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml import Model, PipelineModel
+# MAGIC from pyspark.ml.param import Params
+# MAGIC import hashlib
+# MAGIC import json
+# MAGIC import mlflow
+# MAGIC import pandas as pd
+# MAGIC import threading
+# MAGIC from typing import Dict, Optional, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Content addressed cache of trained models
+# MAGIC """
+# MAGIC 
+# MAGIC trainingCacheContext : Dict = {} ## data version, featurization and labeling config shared by every trainer
+# MAGIC trainingCacheStats : Dict[str, int] = {"hits" : 0, "misses" : 0}
+# MAGIC trainingCacheLock = threading.Lock()
+# MAGIC cachedTrainingCosts : Dict[str, float] = {} ## model uid to the training cost of models loaded from the cache
+# MAGIC 
+# MAGIC def tableVersion(table : str) -> int:
+# MAGIC   """
+# MAGIC     Current version of a Delta table
+# MAGIC     
+# MAGIC     @return Latest Delta version
+# MAGIC     
+# MAGIC     @param table         | name of the Delta table
+# MAGIC   """
+# MAGIC   
+# MAGIC   return spark.sql(f"DESCRIBE HISTORY {table} LIMIT 1").first()["version"]
+# MAGIC 
+# MAGIC def paramsFingerprint(params : Params) -> Dict[str, str]:
+# MAGIC   """
+# MAGIC     Effective params of an estimator or model, independent of its uid
+# MAGIC     
+# MAGIC     @return Dictionary of param name to its value
+# MAGIC     
+# MAGIC     @param params        | Spark ML estimator or model
+# MAGIC   """
+# MAGIC   
+# MAGIC   return {param.name : str(value) for param, value in params.extractParamMap().items()}
+# MAGIC 
+# MAGIC def modelFingerprint(model : Model) -> str:
+# MAGIC   """
+# MAGIC     Hash of a fitted model's params and cluster centers
+# MAGIC     
+# MAGIC     @return Hex digest identifying the model
+# MAGIC     
+# MAGIC     @param model         | fitted Spark ML model
+# MAGIC   """
+# MAGIC   
+# MAGIC   content = {"model" : type(model).__name__, "params" : paramsFingerprint(model)}
+# MAGIC   if hasattr(model, "clusterCenters"):
+# MAGIC     content["centers"] = [center.tolist() for center in model.clusterCenters()]
+# MAGIC   
+# MAGIC   return hashlib.sha256(json.dumps(content, sort_keys = True, default = str).encode()).hexdigest()
+# MAGIC 
+# MAGIC def trainingCacheKey(estimator : Params,
+# MAGIC                      extra : Optional[Dict] = None) -> str:
+# MAGIC   """
+# MAGIC     Cache key of a training run
+# MAGIC     
+# MAGIC     @return Hex digest of the data context, estimator and params
+# MAGIC     
+# MAGIC     @param estimator     | configured Spark ML estimator
+# MAGIC     @param extra         | anything else that changes the training result or metrics
+# MAGIC   """
+# MAGIC   
+# MAGIC   content = {"context" : trainingCacheContext,
+# MAGIC              "estimator" : type(estimator).__name__,
+# MAGIC              "params" : paramsFingerprint(estimator),
+# MAGIC              "extra" : extra or {}}
+# MAGIC   
+# MAGIC   return hashlib.sha256(json.dumps(content, sort_keys = True, default = str).encode()).hexdigest()
+# MAGIC 
+# MAGIC def cachedTraining(cacheKey : str) -> Optional[Tuple[Model, pd.Series]]:
+# MAGIC   """
+# MAGIC     Look up a finished training run with the same cache key
+# MAGIC     
+# MAGIC     @return Cached model and its MLflow run, None on a miss
+# MAGIC     
+# MAGIC     @param cacheKey      | key from trainingCacheKey
+# MAGIC   """
+# MAGIC   
+# MAGIC   runs = mlflow.search_runs(filter_string = f"tags.training_cache_key = '{cacheKey}'",
+# MAGIC                             order_by = ["attributes.start_time DESC"],
+# MAGIC                             max_results = 1)
+# MAGIC   if runs.empty:
+# MAGIC     return None
+# MAGIC   
+# MAGIC   cachedRun = runs.iloc[0]
+# MAGIC   model = mlflow.spark.load_model(f"runs:/{cachedRun['run_id']}/{cachedRun['tags.training_cache_artifact']}")
+# MAGIC   
+# MAGIC   ## single models are logged wrapped in a pipeline
+# MAGIC   if isinstance(model, PipelineModel) and len(model.stages) == 1:
+# MAGIC     model = model.stages[0]
+# MAGIC   
+# MAGIC   return (model, cachedRun)
+# MAGIC 
+# MAGIC def recordTrainingCache(hit : bool) -> None:
+# MAGIC   """
+# MAGIC     Count a cache hit or miss and log the running totals to the active run
+# MAGIC     
+# MAGIC     @param hit           | whether the model came from the cache
+# MAGIC   """
+# MAGIC   
+# MAGIC   with trainingCacheLock:
+# MAGIC     trainingCacheStats["hits" if hit else "misses"] += 1
+# MAGIC     stats = dict(trainingCacheStats)
+# MAGIC   
+# MAGIC   mlflow.log_metrics({"Training Cache Hits" : stats["hits"], "Training Cache Misses" : stats["misses"]})
+
+# COMMAND ----------
+
+# DBTITLE 1,Training Cache Context
+# MAGIC %python
+# MAGIC 
+# MAGIC """
+# MAGIC   Describe the data every trainer sees
+# MAGIC """
+# MAGIC 
+# MAGIC ## start from an empty context every run, the cluster model of an earlier run must not leak into the k-means keys
+# MAGIC trainingCacheContext.clear()
+# MAGIC with trainingCacheLock:
+# MAGIC   trainingCacheStats.update({"hits" : 0, "misses" : 0})
+# MAGIC 
+# MAGIC trainingCacheContext.update({"table_version" : tableVersion("carparts_data"),
+# MAGIC                              "featurization" : {"indexer" : paramsFingerprint(indexer),
+# MAGIC                                                 "features" : features,
+# MAGIC                                                 "encoder" : featureVersion["encoder"]},
+# MAGIC                              "split" : {"weights" : splitWeights, "seed" : splitSeed}})
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ## K-Means Model Training
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Training Function
+
+# COMMAND ----------
+
+# DBTITLE 1,K-Means Training Function
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml.clustering import BisectingKMeans, BisectingKMeansModel
+# MAGIC from pyspark.ml.evaluation import ClusteringEvaluator
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC import mlflow
+# MAGIC import numpy as np
+# MAGIC from typing import Dict, List, Optional, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Setup K-Means modeling
+# MAGIC """
+# MAGIC 
+# MAGIC def silhouetteEstimate(points : np.ndarray,
+# MAGIC                        labels : np.ndarray,
+# MAGIC                        strata : np.ndarray,
+# MAGIC                        strataSizes : Dict[int, int]) -> Tuple[float, float]:
+# MAGIC   """
+# MAGIC     Estimate the squared euclidean silhouette from a stratified sample
+# MAGIC     
+# MAGIC     @return Estimated silhouette
+# MAGIC     @return 95% error bound of the estimate
+# MAGIC     
+# MAGIC     @param points        | sampled feature vectors, one row per point
+# MAGIC     @param labels        | cluster of every sampled point
+# MAGIC     @param strata        | stratum the point was sampled from, every stratum lies within one cluster
+# MAGIC     @param strataSizes   | number of rows per stratum in the full dataset
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## every sampled point stands for size / sampled rows of its stratum
+# MAGIC   sampled = {s : int((strata == s).sum()) for s in np.unique(strata)}
+# MAGIC   weights = np.array([strataSizes[s] / sampled[s] for s in strata])
+# MAGIC   clusters = np.unique(labels)
+# MAGIC   
+# MAGIC   if len(clusters) < 2:
+# MAGIC     return (0.0, 0.0)
+# MAGIC   
+# MAGIC   ## pairwise squared euclidean distances, the same measure ClusteringEvaluator uses by default
+# MAGIC   norms = (points ** 2).sum(axis = 1)
+# MAGIC   distances = np.maximum(norms[:, None] + norms[None, :] - 2 * points @ points.T, 0)
+# MAGIC   
+# MAGIC   ## weighted mean distance from every point to every cluster
+# MAGIC   members = np.stack([labels == c for c in clusters], axis = 1)
+# MAGIC   weightedSums = distances @ (members * weights[:, None])
+# MAGIC   clusterWeights = (members * weights[:, None]).sum(axis = 0)
+# MAGIC   rows = np.arange(len(labels))
+# MAGIC   ownCluster = np.searchsorted(clusters, labels)
+# MAGIC   
+# MAGIC   ## exclude the point itself from its own cluster mean
+# MAGIC   ownWeight = clusterWeights[ownCluster] - weights
+# MAGIC   a = weightedSums[rows, ownCluster] / np.maximum(ownWeight, 1e-12)
+# MAGIC   meanDistances = weightedSums / clusterWeights
+# MAGIC   meanDistances[rows, ownCluster] = np.inf
+# MAGIC   b = meanDistances.min(axis = 1)
+# MAGIC   
+# MAGIC   ## points alone in their sampled cluster score zero, as in ClusteringEvaluator
+# MAGIC   alone = members.sum(axis = 0)[ownCluster] < 2
+# MAGIC   silhouettes = np.where(alone, 0.0, (b - a) / np.maximum(np.maximum(a, b), 1e-12))
+# MAGIC   
+# MAGIC   ## weight every stratum by its share of the full dataset
+# MAGIC   total = float(sum(strataSizes[s] for s in sampled))
+# MAGIC   estimate, variance = 0.0, 0.0
+# MAGIC   for s, n in sampled.items():
+# MAGIC     stratum = silhouettes[strata == s]
+# MAGIC     share = strataSizes[s] / total
+# MAGIC     estimate += share * stratum.mean()
+# MAGIC     variance += share ** 2 * stratum.var(ddof = 1) / n if n > 1 else 0.0
+# MAGIC   
+# MAGIC   return (float(estimate), float(1.96 * np.sqrt(variance)))
+# MAGIC 
+# MAGIC def sampledSilhouette(predictions : DataFrame,
+# MAGIC                       clusterSizes : List[int],
+# MAGIC                       samplesPerCluster : int,
+# MAGIC                       seed : int,
+# MAGIC                       featuresCol : str = "features",
+# MAGIC                       predictionCol : str = "predictions") -> Tuple[float, int, float]:
+# MAGIC   """
+# MAGIC     Estimate the squared euclidean silhouette from a stratified sample per cluster
+# MAGIC     
+# MAGIC     @return Estimated silhouette
+# MAGIC     @return Number of sampled rows
+# MAGIC     @return 95% error bound of the estimate
+# MAGIC     
+# MAGIC     @param predictions       | Spark DataFrame with features and cluster predictions
+# MAGIC     @param clusterSizes      | number of rows per cluster, indexed by cluster
+# MAGIC     @param samplesPerCluster | number of rows to sample from every cluster
+# MAGIC     @param seed              | random number seed
+# MAGIC     @param featuresCol       | Name of the vectorized column
+# MAGIC     @param predictionCol     | Name of the cluster prediction column
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## sample roughly the same number of rows from every cluster
+# MAGIC   fractions = {c : min(1.0, samplesPerCluster / size) for c, size in enumerate(clusterSizes) if size > 0}
+# MAGIC   rows = predictions.select(featuresCol, predictionCol)\
+# MAGIC                     .sampleBy(predictionCol, fractions, seed)\
+# MAGIC                     .collect()
+# MAGIC   
+# MAGIC   if len(rows) < 2:
+# MAGIC     return (0.0, len(rows), 1.0)
+# MAGIC   
+# MAGIC   points = np.array([r[0].toArray() for r in rows])
+# MAGIC   labels = np.array([r[1] for r in rows])
+# MAGIC   
+# MAGIC   silhouette, errorBound = silhouetteEstimate(points = points,
+# MAGIC                                               labels = labels,
+# MAGIC                                               strata = labels,
+# MAGIC                                               strataSizes = dict(enumerate(clusterSizes)))
+# MAGIC   
+# MAGIC   return (silhouette, len(rows), errorBound)
+# MAGIC 
+# MAGIC def kMeansTrain(nCentroids : int,
+# MAGIC                 seed : int,
+# MAGIC                 dataset : DataFrame,
+# MAGIC                 featuresCol : str = "features",
+# MAGIC                 parentRunId : Optional[str] = None,
+# MAGIC                 silhouetteMode : str = "full",
+# MAGIC                 samplesPerCluster : int = 200) -> Tuple[BisectingKMeansModel,float]:
+# MAGIC   """
+# MAGIC     Setup K-Means modeling
+# MAGIC     
+# MAGIC     @return Trained model
+# MAGIC     @return Silhouete with squared euclidean distance, NaN when silhouetteMode is "none"
+# MAGIC     
+# MAGIC     @param nCentroids        | number of centroids to cluster around
+# MAGIC     @param seed              | random number seed
+# MAGIC     @param dataset           | Spark DataFrame containing features
+# MAGIC     @param featuresCol       | Name of the vectorized column
+# MAGIC     @param parentRunId       | MLflow run to nest this run under
+# MAGIC     @param silhouetteMode    | "full" evaluates every row, "sampled" a stratified sample per cluster, "none" skips it
+# MAGIC     @param samplesPerCluster | number of rows sampled per cluster in "sampled" mode
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## runs started from worker threads don't see the parent run, so link it explicitly
+# MAGIC   with mlflow.start_run(nested = parentRunId is not None,
+# MAGIC                         tags = {"mlflow.parentRunId" : parentRunId} if parentRunId else None) as run:
+# MAGIC   
+# MAGIC     mlflow.log_param("Number_Centroids", str(nCentroids))
+# MAGIC     mlflow.log_param("seed", str(seed))
+# MAGIC     mlflow.log_param("Silhouette_Mode", silhouetteMode)
+# MAGIC 
+# MAGIC     ## Start up the bisecting k-means model
+# MAGIC     bkm = BisectingKMeans()\
+# MAGIC                       .setFeaturesCol(featuresCol)\
+# MAGIC                       .setK(nCentroids)\
+# MAGIC                       .setSeed(seed)\
+# MAGIC                       .setPredictionCol("predictions")
+# MAGIC 
+# MAGIC     ## Reuse an identical earlier training run
+# MAGIC     cacheKey = trainingCacheKey(bkm, {"silhouetteMode" : silhouetteMode, "samplesPerCluster" : samplesPerCluster})
+# MAGIC     cached = cachedTraining(cacheKey)
+# MAGIC     recordTrainingCache(hit = cached is not None)
+# MAGIC 
+# MAGIC     if cached is not None:
+# MAGIC       model, cachedRun = cached
+# MAGIC       silhouette = cachedRun.get("metrics.Silhouette", float("nan"))
+# MAGIC       cachedTrainingCosts[model.uid] = cachedRun["metrics.Within Cluster Cost"]
+# MAGIC       mlflow.set_tag("training_cache_source_run", cachedRun["run_id"])
+# MAGIC       mlflow.log_metric("Within Cluster Cost", cachedRun["metrics.Within Cluster Cost"])
+# MAGIC       if silhouetteMode != "none":
+# MAGIC         mlflow.log_metric("Silhouette", silhouette)
+# MAGIC       return (model, silhouette)
+# MAGIC 
+# MAGIC     ## Train a model
+# MAGIC     model = bkm.fit(dataset)
+# MAGIC 
+# MAGIC     ## The training summary already holds the cost and cluster sizes, no extra pass needed
+# MAGIC     summary = model.summary
+# MAGIC     mlflow.log_metric("Training Data Rows", sum(summary.clusterSizes))
+# MAGIC     mlflow.log_metric("Within Cluster Cost", summary.trainingCost)
+# MAGIC     mlflow.log_param("Cluster Sizes", str(summary.clusterSizes))
+# MAGIC 
+# MAGIC     ## Evaluate the clusters
+# MAGIC     if silhouetteMode == "full":
+# MAGIC       evaluator = ClusteringEvaluator()\
+# MAGIC                         .setPredictionCol("predictions")
+# MAGIC       silhouette = evaluator.evaluate(model.transform(dataset))
+# MAGIC     elif silhouetteMode == "sampled":
+# MAGIC       silhouette, sampleSize, errorBound = sampledSilhouette(predictions = summary.predictions,
+# MAGIC                                                              clusterSizes = summary.clusterSizes,
+# MAGIC                                                              samplesPerCluster = samplesPerCluster,
+# MAGIC                                                              seed = seed,
+# MAGIC                                                              featuresCol = featuresCol)
+# MAGIC       mlflow.log_metric("Silhouette Sample Size", sampleSize)
+# MAGIC       mlflow.log_metric("Silhouette Error Bound", errorBound)
+# MAGIC     elif silhouetteMode == "none":
+# MAGIC       silhouette = float("nan")
+# MAGIC     else:
+# MAGIC       raise ValueError(f"Unknown silhouette mode {silhouetteMode}")
+# MAGIC 
+# MAGIC     ## Log some modeling metrics
+# MAGIC     if silhouetteMode != "none":
+# MAGIC       mlflow.log_metric("Silhouette", silhouette)
+# MAGIC     mlflow.spark.log_model(model, f"K-Means_{nCentroids}")
+# MAGIC     mlflow.set_tags({"training_cache_key" : cacheKey, "training_cache_artifact" : f"K-Means_{nCentroids}"})
+# MAGIC 
+# MAGIC   
+# MAGIC     ## Return the class and silhouette
+# MAGIC     return (model, silhouette)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Sweep Runner
+# MAGIC 
+# MAGIC Each BisectingKMeans fit only occupies a fraction of the executors, so the sweep submits the fits concurrently from a bounded driver-side thread pool. Every fit is logged as a nested run under one parent sweep run. Every fit also submits its jobs to its own scheduler pool, so with `spark.scheduler.mode` set to `FAIR` in the cluster's Spark config the concurrent fits share the executors evenly instead of queueing behind each other. The XGBoost and decision tree sweeps use the same pools when the stage pipeline runs them together.
+
+# COMMAND ----------
+
+# DBTITLE 1,K-Means Sweep Runner
+# MAGIC %python
+# MAGIC 
+# MAGIC from concurrent.futures import ThreadPoolExecutor
+# MAGIC from contextlib import contextmanager
+# MAGIC from pyspark import StorageLevel
+# MAGIC from pyspark.ml.clustering import BisectingKMeansModel
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC import mlflow
+# MAGIC import time
+# MAGIC from typing import Iterable, Iterator, List, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Run the K-Means centroid sweep concurrently
+# MAGIC """
+# MAGIC 
+# MAGIC @contextmanager
+# MAGIC def schedulerPool(name : str) -> Iterator[None]:
+# MAGIC   """
+# MAGIC     Submit the spark jobs of the current thread to a FAIR scheduler pool
+# MAGIC     
+# MAGIC     @param name          | pool name, pools are created on first use
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## local properties are per python thread with pinned thread mode, the default since spark 3.2
+# MAGIC   sc.setLocalProperty("spark.scheduler.pool", name)
+# MAGIC   try:
+# MAGIC     yield
+# MAGIC   finally:
+# MAGIC     sc.setLocalProperty("spark.scheduler.pool", None)
+# MAGIC 
+# MAGIC def kMeansSweep(centroids : Iterable[int],
+# MAGIC                 seed : int,
+# MAGIC                 dataset : DataFrame,
+# MAGIC                 featuresCol : str = "features",
+# MAGIC                 maxWorkers : int = 4,
+# MAGIC                 silhouetteMode : str = "full",
+# MAGIC                 samplesPerCluster : int = 200) -> List[Tuple[int, Tuple[BisectingKMeansModel, float]]]:
+# MAGIC   """
+# MAGIC     Train a K-Means model for every number of centroids concurrently
+# MAGIC     
+# MAGIC     @return List of (number of centroids, (trained model, silhouette)) in the order of centroids
+# MAGIC     
+# MAGIC     @param centroids         | numbers of centroids to train
+# MAGIC     @param seed              | random number seed
+# MAGIC     @param dataset           | Spark DataFrame containing features
+# MAGIC     @param featuresCol       | Name of the vectorized column
+# MAGIC     @param maxWorkers        | maximum number of fits running at the same time
+# MAGIC     @param silhouetteMode    | silhouette mode passed to kMeansTrain
+# MAGIC     @param samplesPerCluster | number of rows sampled per cluster in "sampled" mode
+# MAGIC   """
+# MAGIC   
+# MAGIC   centroids = list(centroids)
+# MAGIC   
+# MAGIC   ## share one cached copy of the dataset between all the fits
+# MAGIC   ownsCache = dataset.storageLevel == StorageLevel(False, False, False, False)
+# MAGIC   if ownsCache:
+# MAGIC     dataset.cache().count()
+# MAGIC   
+# MAGIC   try:
+# MAGIC     with mlflow.start_run(run_name = "K-Means Sweep") as sweepRun:
+# MAGIC       mlflow.log_param("Centroids", str(centroids))
+# MAGIC       mlflow.log_param("Max_Workers", str(maxWorkers))
+# MAGIC       mlflow.log_param("seed", str(seed))
+# MAGIC       
+# MAGIC       start = time.time()
+# MAGIC       
+# MAGIC       def fit(k : int) -> Tuple[BisectingKMeansModel, float]:
+# MAGIC         with schedulerPool(f"kmeans_{k}"):
+# MAGIC           return kMeansTrain(nCentroids = k,
+# MAGIC                              seed = seed,
+# MAGIC                              dataset = dataset,
+# MAGIC                              featuresCol = featuresCol,
+# MAGIC                              parentRunId = sweepRun.info.run_id,
+# MAGIC                              silhouetteMode = silhouetteMode,
+# MAGIC                              samplesPerCluster = samplesPerCluster)
+# MAGIC       
+# MAGIC       with ThreadPoolExecutor(max_workers = maxWorkers) as pool:
+# MAGIC         futures = [(k, pool.submit(fit, k)) for k in centroids]
+# MAGIC         results = [(k, future.result()) for k, future in futures]
+# MAGIC       
+# MAGIC       mlflow.log_metric("Sweep Seconds", time.time() - start)
+# MAGIC   finally:
+# MAGIC     if ownsCache:
+# MAGIC       dataset.unpersist()
+# MAGIC   
+# MAGIC   return results
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Hierarchical Sweep
+# MAGIC 
+# MAGIC BisectingKMeans is divisive, so the fit at the largest number of centroids already contains every split of the smaller fits. The hierarchical sweep fits once, keeps the bisection tree and derives a model for every smaller number of centroids by cutting the tree. The cut replays Spark's split order, level by level and largest cluster first when a level has more divisible clusters than centroids left, so it keeps the clusters a direct fit with the same seed would make. Only the clusters split on the last level can end up with slightly different centers, because a direct fit starts their split from different random centers. Costs per cut come from the tree itself and the silhouettes from one stratified sample of the leaves. The cut model lives in `carparts.clustering`, so the logged models load wherever the carparts library is installed.
+
+# COMMAND ----------
+
+# DBTITLE 1,Import the Cut Model
+"""
+Bisection tree cuts, from the carparts cluster library
+"""
+
+from carparts.clustering import BisectingKMeansCutModel, bisectionTree, cutBisectionTree
+
+# COMMAND ----------
+
+# DBTITLE 1,Hierarchical K-Means Sweep
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml import Model
+# MAGIC from pyspark.ml.clustering import BisectingKMeans
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC import mlflow
+# MAGIC import numpy as np
+# MAGIC import time
+# MAGIC from typing import Iterable, List, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Derive every number of centroids from a single bisecting k-means fit
+# MAGIC """
+# MAGIC 
+# MAGIC def clusteringCost(model : Model) -> float:
+# MAGIC   """
+# MAGIC     Sum of squared distances to the cluster centers of a fitted clustering model
+# MAGIC     
+# MAGIC     @return Training cost
+# MAGIC     
+# MAGIC     @param model         | fitted bisecting k-means or cut model
+# MAGIC   """
+# MAGIC   
+# MAGIC   if isinstance(model, BisectingKMeansCutModel):
+# MAGIC     return model.getTrainingCost()
+# MAGIC   ## models loaded from the training cache have no summary
+# MAGIC   if model.uid in cachedTrainingCosts:
+# MAGIC     return cachedTrainingCosts[model.uid]
+# MAGIC   return model.summary.trainingCost
+# MAGIC 
+# MAGIC def kMeansHierarchicalSweep(centroids : Iterable[int],
+# MAGIC                             seed : int,
+# MAGIC                             dataset : DataFrame,
+# MAGIC                             featuresCol : str = "features",
+# MAGIC                             samplesPerCluster : int = 200) -> List[Tuple[int, Tuple[Model, float]]]:
+# MAGIC   """
+# MAGIC     Fit bisecting k-means once at the largest number of centroids and cut the tree for the others
+# MAGIC     
+# MAGIC     @return List of (number of centroids, (model, silhouette)) in the order of centroids
+# MAGIC     
+# MAGIC     @param centroids         | numbers of centroids to derive
+# MAGIC     @param seed              | random number seed
+# MAGIC     @param dataset           | Spark DataFrame containing features
+# MAGIC     @param featuresCol       | Name of the vectorized column
+# MAGIC     @param samplesPerCluster | number of rows sampled per leaf for the silhouettes
+# MAGIC   """
+# MAGIC   
+# MAGIC   centroids = list(centroids)
+# MAGIC   
+# MAGIC   with mlflow.start_run(run_name = "K-Means Hierarchical Sweep") as sweepRun:
+# MAGIC     mlflow.log_param("Centroids", str(centroids))
+# MAGIC     mlflow.log_param("seed", str(seed))
+# MAGIC     
+# MAGIC     start = time.time()
+# MAGIC     
+# MAGIC     ## the only fit of the sweep
+# MAGIC     fullModel = BisectingKMeans()\
+# MAGIC                       .setFeaturesCol(featuresCol)\
+# MAGIC                       .setK(max(centroids))\
+# MAGIC                       .setSeed(seed)\
+# MAGIC                       .setPredictionCol("predictions")\
+# MAGIC                       .fit(dataset)
+# MAGIC     
+# MAGIC     tree = bisectionTree(fullModel)
+# MAGIC     isLeaf = tree["children"][:, 0] < 0
+# MAGIC     leafSizes = dict(zip(tree["leaves"][isLeaf], tree["sizes"][isLeaf]))
+# MAGIC     
+# MAGIC     ## one stratified sample of the leaves serves every cut
+# MAGIC     fractions = {int(leaf) : min(1.0, samplesPerCluster / size) for leaf, size in leafSizes.items() if size > 0}
+# MAGIC     rows = fullModel.summary.predictions\
+# MAGIC                     .select(featuresCol, "predictions")\
+# MAGIC                     .sampleBy("predictions", fractions, seed)\
+# MAGIC                     .collect()
+# MAGIC     points = np.array([r[0].toArray() for r in rows])
+# MAGIC     sampledLeaves = np.array([r[1] for r in rows])
+# MAGIC     
+# MAGIC     results = []
+# MAGIC     
+# MAGIC     for k in centroids:
+# MAGIC       clusters = cutBisectionTree(tree, k)
+# MAGIC       
+# MAGIC       ## every leaf belongs to the cut node above it
+# MAGIC       leafCluster = {}
+# MAGIC       for node in np.where(clusters >= 0)[0]:
+# MAGIC         stack = [node]
+# MAGIC         while stack:
+# MAGIC           current = stack.pop()
+# MAGIC           if isLeaf[current]:
+# MAGIC             leafCluster[tree["leaves"][current]] = clusters[node]
+# MAGIC           else:
+# MAGIC             stack.extend(tree["children"][current])
+# MAGIC       
+# MAGIC       cost = float(tree["costs"][clusters >= 0].sum())
+# MAGIC       silhouette, errorBound = silhouetteEstimate(points = points,
+# MAGIC                                                   labels = np.array([leafCluster[leaf] for leaf in sampledLeaves]),
+# MAGIC                                                   strata = sampledLeaves,
+# MAGIC                                                   strataSizes = leafSizes)
+# MAGIC       
+# MAGIC       model = BisectingKMeansCutModel(featuresCol = featuresCol, predictionCol = "predictions")
+# MAGIC       model.set(model.centers, tree["centers"].tolist())
+# MAGIC       model.set(model.children, tree["children"].tolist())
+# MAGIC       model.set(model.clusters, clusters.tolist())
+# MAGIC       model.set(model.trainingCost, cost)
+# MAGIC       
+# MAGIC       with mlflow.start_run(nested = True) as run:
+# MAGIC         mlflow.log_param("Number_Centroids", str(k))
+# MAGIC         mlflow.log_param("seed", str(seed))
+# MAGIC         mlflow.log_param("Silhouette_Mode", "sampled")
+# MAGIC         mlflow.log_metric("Within Cluster Cost", cost)
+# MAGIC         mlflow.log_metric("Silhouette", silhouette)
+# MAGIC         mlflow.log_metric("Silhouette Sample Size", len(rows))
+# MAGIC         mlflow.log_metric("Silhouette Error Bound", errorBound)
+# MAGIC         mlflow.spark.log_model(model, f"K-Means_{k}")
+# MAGIC       
+# MAGIC       results.append((k, (model, silhouette)))
+# MAGIC     
+# MAGIC     mlflow.log_metric("Sweep Seconds", time.time() - start)
+# MAGIC   
+# MAGIC   return results
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Choosing the Number of Centroids
+# MAGIC 
+# MAGIC The number of centroids is picked from the data, either at the silhouette peak or at the knee of the cost curve (the point furthest below the chord between the smallest and largest number of centroids). The adaptive search fits a coarse grid of centroids in increasing order, stops as soon as further centroids stop improving the score, then refines around the best candidate by halving the step.
+
+# COMMAND ----------
+
+# DBTITLE 1,K Selection
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml import Model
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC import mlflow
+# MAGIC import numpy as np
+# MAGIC from typing import Dict, Iterable, List, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Pick the number of centroids from the silhouette peak or the knee of the cost curve
+# MAGIC """
+# MAGIC 
+# MAGIC def kSelectionScores(evaluated : Dict[int, Tuple[Model, float, float]],
+# MAGIC                      criterion : str = "silhouette") -> Dict[int, float]:
+# MAGIC   """
+# MAGIC     Score every evaluated number of centroids, higher is better
+# MAGIC     
+# MAGIC     @return Dictionary of number of centroids to score
+# MAGIC     
+# MAGIC     @param evaluated     | Dictionary of number of centroids to (model, silhouette, cost)
+# MAGIC     @param criterion     | "silhouette" for the silhouette peak, "knee" for the knee of the cost curve
+# MAGIC   """
+# MAGIC   
+# MAGIC   if criterion == "silhouette":
+# MAGIC     ## max over NaN picks an arbitrary k
+# MAGIC     if any(np.isnan(silhouette) for model, silhouette, cost in evaluated.values()):
+# MAGIC       raise ValueError("The silhouette criterion needs silhouettes, use silhouetteMode \"full\" or \"sampled\" or the knee criterion")
+# MAGIC     return {k : silhouette for k, (model, silhouette, cost) in evaluated.items()}
+# MAGIC   
+# MAGIC   if criterion == "knee":
+# MAGIC     ks = sorted(evaluated)
+# MAGIC     firstK, lastK = ks[0], ks[-1]
+# MAGIC     firstCost, lastCost = evaluated[firstK][2], evaluated[lastK][2]
+# MAGIC     
+# MAGIC     ## distance below the chord between the first and last point of the normalized cost curve
+# MAGIC     return {k : 1 - (k - firstK) / max(lastK - firstK, 1) - (evaluated[k][2] - lastCost) / max(firstCost - lastCost, 1e-12)
+# MAGIC             for k in ks}
+# MAGIC   
+# MAGIC   raise ValueError(f"Unknown k selection criterion {criterion}")
+# MAGIC 
+# MAGIC def selectClusterModel(kMeansTuning : List[Tuple[int, Tuple[Model, float]]],
+# MAGIC                        criterion : str = "silhouette") -> Tuple[int, Model, Dict]:
+# MAGIC   """
+# MAGIC     Choose the best model out of a centroid sweep
+# MAGIC     
+# MAGIC     @return Chosen number of centroids
+# MAGIC     @return Chosen model
+# MAGIC     @return Evidence for the choice
+# MAGIC     
+# MAGIC     @param kMeansTuning  | List of (number of centroids, (model, silhouette)) from a sweep or search
+# MAGIC     @param criterion     | "silhouette" for the silhouette peak, "knee" for the knee of the cost curve
+# MAGIC   """
+# MAGIC   
+# MAGIC   evaluated = {k : (model, silhouette, clusteringCost(model)) for k, (model, silhouette) in kMeansTuning}
+# MAGIC   
+# MAGIC   ## sweeps run with silhouetteMode "none" only have costs
+# MAGIC   if criterion == "silhouette" and any(np.isnan(silhouette) for model, silhouette, cost in evaluated.values()):
+# MAGIC     print("Silhouettes were skipped, choosing the number of centroids at the knee of the cost curve")
+# MAGIC     criterion = "knee"
+# MAGIC   
+# MAGIC   scores = kSelectionScores(evaluated, criterion)
+# MAGIC   chosen = max(scores, key = scores.get)
+# MAGIC   
+# MAGIC   evidence = {"criterion" : criterion,
+# MAGIC               "chosen" : chosen,
+# MAGIC               "candidates" : {k : {"silhouette" : float(evaluated[k][1]),
+# MAGIC                                    "cost" : float(evaluated[k][2]),
+# MAGIC                                    "score" : float(scores[k])}
+# MAGIC                               for k in sorted(evaluated)}}
+# MAGIC   
+# MAGIC   return (chosen, evaluated[chosen][0], evidence)
+# MAGIC 
+# MAGIC def kMeansSearch(centroids : Iterable[int],
+# MAGIC                  seed : int,
+# MAGIC                  dataset : DataFrame,
+# MAGIC                  featuresCol : str = "features",
+# MAGIC                  criterion : str = "silhouette",
+# MAGIC                  coarseStep : int = 4,
+# MAGIC                  patience : int = 1,
+# MAGIC                  kneeTolerance : float = 0.1,
+# MAGIC                  silhouetteMode : str = "sampled") -> Tuple[List[Tuple[int, Tuple[Model, float]]], Dict]:
+# MAGIC   """
+# MAGIC     Adaptive coarse-to-fine search over the number of centroids
+# MAGIC     
+# MAGIC     @return List of (number of centroids, (model, silhouette)) for the fitted candidates
+# MAGIC     @return Evidence for the choice, including the stop reason and number of fits
+# MAGIC     
+# MAGIC     @param centroids     | candidate numbers of centroids
+# MAGIC     @param seed          | random number seed
+# MAGIC     @param dataset       | Spark DataFrame containing features
+# MAGIC     @param featuresCol   | Name of the vectorized column
+# MAGIC     @param criterion     | "silhouette" for the silhouette peak, "knee" for the knee of the cost curve
+# MAGIC     @param coarseStep    | step between the candidates of the coarse pass
+# MAGIC     @param patience      | coarse candidates without improvement before the silhouette search stops
+# MAGIC     @param kneeTolerance | the knee search stops once the cost gain per centroid drops below this share of the first gain
+# MAGIC     @param silhouetteMode | silhouette mode passed to kMeansTrain
+# MAGIC   """
+# MAGIC   
+# MAGIC   candidates = sorted(centroids)
+# MAGIC   evaluated = {}
+# MAGIC   
+# MAGIC   if criterion == "silhouette" and silhouetteMode == "none":
+# MAGIC     print("Silhouettes are skipped, searching for the knee of the cost curve instead")
+# MAGIC     criterion = "knee"
+# MAGIC   
+# MAGIC   with mlflow.start_run(run_name = "K-Means Search") as searchRun:
+# MAGIC     mlflow.log_param("Criterion", criterion)
+# MAGIC     mlflow.log_param("Centroids", str(candidates))
+# MAGIC     
+# MAGIC     def evaluate(k : int) -> None:
+# MAGIC       if k not in evaluated:
+# MAGIC         model, silhouette = kMeansTrain(nCentroids = k,
+# MAGIC                                         seed = seed,
+# MAGIC                                         dataset = dataset,
+# MAGIC                                         featuresCol = featuresCol,
+# MAGIC                                         parentRunId = searchRun.info.run_id,
+# MAGIC                                         silhouetteMode = silhouetteMode)
+# MAGIC         evaluated[k] = (model, silhouette, clusteringCost(model))
+# MAGIC     
+# MAGIC     ## coarse pass in increasing order, stop once larger k can't improve the score
+# MAGIC     stopReason = "exhausted candidates"
+# MAGIC     coarse = candidates[::coarseStep]
+# MAGIC     best, stale, firstGain = None, 0, None
+# MAGIC     
+# MAGIC     for previous, k in zip([None] + coarse, coarse):
+# MAGIC       evaluate(k)
+# MAGIC       
+# MAGIC       if criterion == "silhouette":
+# MAGIC         if best is None or evaluated[k][1] > evaluated[best][1]:
+# MAGIC           best, stale = k, 0
+# MAGIC         else:
+# MAGIC           stale += 1
+# MAGIC         if stale >= patience:
+# MAGIC           stopReason = f"silhouette did not improve for {stale} coarse candidates"
+# MAGIC           break
+# MAGIC       elif previous is not None:
+# MAGIC         gain = (evaluated[previous][2] - evaluated[k][2]) / (k - previous)
+# MAGIC         firstGain = gain if firstGain is None else firstGain
+# MAGIC         if firstGain <= 0 or gain < kneeTolerance * firstGain:
+# MAGIC           stopReason = "cost gain per centroid fell below the knee tolerance"
+# MAGIC           break
+# MAGIC     
+# MAGIC     ## fine pass, halve the step around the best candidate
+# MAGIC     step = coarseStep // 2
+# MAGIC     while step >= 1:
+# MAGIC       scores = kSelectionScores(evaluated, criterion)
+# MAGIC       best = max(scores, key = scores.get)
+# MAGIC       lastK = max(evaluated)
+# MAGIC       for k in (best - step, best + step):
+# MAGIC         ## the knee scores are relative to the coarse end points, stay inside them
+# MAGIC         if k in candidates and (criterion == "silhouette" or k < lastK):
+# MAGIC           evaluate(k)
+# MAGIC       step //= 2
+# MAGIC     
+# MAGIC     results = [(k, (evaluated[k][0], evaluated[k][1])) for k in sorted(evaluated)]
+# MAGIC     chosen, model, evidence = selectClusterModel(results, criterion)
+# MAGIC     evidence["stopReason"] = stopReason
+# MAGIC     evidence["fits"] = len(evaluated)
+# MAGIC     
+# MAGIC     mlflow.log_param("Chosen_Number_Centroids", str(chosen))
+# MAGIC     mlflow.log_metric("Fits", len(evaluated))
+# MAGIC     mlflow.log_dict(evidence, "k_selection.json")
+# MAGIC   
+# MAGIC   return (results, evidence)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Train the K-Means Model
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC #### Hyperparameter Tuning for Number of Centroids
+
+# COMMAND ----------
+
+# DBTITLE 1,Tune the Number of Centroids
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from typing import Dict, List
+# MAGIC 
+# MAGIC """
+# MAGIC   Tune a K-Means Model
+# MAGIC """
+# MAGIC 
+# MAGIC kMeansSweepMode = "hierarchical" ## "hierarchical" fits once and cuts the tree, "adaptive" searches for the best k, "concurrent" fits every number of centroids
+# MAGIC kSelectionCriterion = "silhouette" ## "silhouette" picks the silhouette peak, "knee" the knee of the cost curve
+# MAGIC 
+# MAGIC def clusterSweepStage(split : Dict[str, DataFrame],
+# MAGIC                       mode : str,
+# MAGIC                       criterion : str,
+# MAGIC                       centroids : List[int],
+# MAGIC                       seed : int) -> Dict:
+# MAGIC   """
+# MAGIC     Sweep the number of centroids and choose the clustering model
+# MAGIC     
+# MAGIC     @return Dictionary with the costs per number of centroids, the chosen number of centroids, its model and the evidence for the choice
+# MAGIC     
+# MAGIC     @param split         | dataset, training and testing dataframes
+# MAGIC     @param mode          | hierarchical, adaptive or concurrent sweep
+# MAGIC     @param criterion     | silhouette or knee
+# MAGIC     @param centroids     | numbers of centroids to sweep
+# MAGIC     @param seed          | random number seed
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## Tune the K Means model by optimizing the number of centroids (hyperparameter tuning)
+# MAGIC   if mode == "hierarchical":
+# MAGIC     kMeansTuning = kMeansHierarchicalSweep(centroids = centroids, dataset = split["dataset"], featuresCol = "features", seed = seed)
+# MAGIC   elif mode == "adaptive":
+# MAGIC     kMeansTuning, kMeansSearchEvidence = kMeansSearch(centroids = centroids, dataset = split["dataset"], featuresCol = "features", seed = seed, criterion = criterion)
+# MAGIC   else:
+# MAGIC     kMeansTuning = kMeansSweep(centroids = centroids, dataset = split["dataset"], featuresCol = "features", seed = seed, maxWorkers = 4, silhouetteMode = "sampled")
+# MAGIC   
+# MAGIC   ## pick the number of centroids from the sweep instead of a fixed index
+# MAGIC   k, model, evidence = selectClusterModel(kMeansTuning, criterion = criterion)
+# MAGIC   
+# MAGIC   ## the costs come for free from the training summary or the tree, a reloaded model has no summary so keep them here
+# MAGIC   return {"costs" : [(a[0], float(clusteringCost(a[1][0])), float(a[1][1])) for a in kMeansTuning],
+# MAGIC           "k" : k,
+# MAGIC           "model" : model,
+# MAGIC           "evidence" : evidence}
+# MAGIC 
+# MAGIC stagePipeline.add(Stage("cluster_sweep", clusterSweepStage, ["split"],
+# MAGIC                         params = {"mode" : kMeansSweepMode, "criterion" : kSelectionCriterion, "centroids" : list(range(2 ,15, 1)), "seed" : 1}))
+# MAGIC 
+# MAGIC clusterSweep = stagePipeline.run(["cluster_sweep"])["cluster_sweep"]
+# MAGIC 
+# MAGIC ## Return the results into a series of arrays
+# MAGIC kMeansCosts = clusterSweep["costs"]
+# MAGIC optimalK, optimalClusterModel, kSelectionEvidence = clusterSweep["k"], clusterSweep["model"], clusterSweep["evidence"]
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Elbow Plot
+
+# COMMAND ----------
+
+# DBTITLE 1,Hierarchical Bisecting K-Means Cluster Tuning
+# MAGIC %python
+# MAGIC 
+# MAGIC """
+# MAGIC   Show the efffect of increasing the number of centroids
+# MAGIC   for a K Means cluster
+# MAGIC """
+# MAGIC 
+# MAGIC kMeansCostsDF = sc.parallelize(kMeansCosts)\
+# MAGIC                       .toDF()\
+# MAGIC                       .withColumnRenamed("_1", "Number of Centroids")\
+# MAGIC                       .withColumnRenamed("_2", "Loss")\
+# MAGIC                       .withColumnRenamed("_3", "Silhouette")
+# MAGIC 
+# MAGIC display(kMeansCostsDF)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ## Label Dataset with Clusters
+
+# COMMAND ----------
+
+# DBTITLE 1,Augment Data with Cluster Label
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from typing import Dict
+# MAGIC 
+# MAGIC """
+# MAGIC   Label the testing and training dataframes with the optimal clustering model
+# MAGIC """
+# MAGIC 
+# MAGIC print(f"Chosen number of centroids: {optimalK}")
+# MAGIC 
+# MAGIC ## the tree trainers learn these labels, cache their runs per cluster model
+# MAGIC trainingCacheContext["cluster_model"] = modelFingerprint(optimalClusterModel)
+# MAGIC 
+# MAGIC def labelStage(split : Dict[str, DataFrame],
+# MAGIC                cluster_sweep : Dict) -> Dict[str, DataFrame]:
+# MAGIC   """
+# MAGIC     Label the training and testing dataframes with the chosen clusters
+# MAGIC     
+# MAGIC     @return Dictionary with the cached labeled training and testing dataframes
+# MAGIC     
+# MAGIC     @param split         | dataset, training and testing dataframes
+# MAGIC     @param cluster_sweep | chosen clustering model
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## label the training and testing dataframes
+# MAGIC   clustered = {f"clustered_{name}_df" : cluster_sweep["model"].transform(split[name]).withColumnRenamed("predictions", "cluster")
+# MAGIC                for name in ["training", "testing"]}
+# MAGIC   
+# MAGIC   ## binned frames of earlier labels are stale, even when a run stopped before releasing them
+# MAGIC   releaseBinnedFeatures()
+# MAGIC   
+# MAGIC   ## materialize the labeled dataframes for the tree sweeps
+# MAGIC   clusteredFrames = materializeFrames(clustered)
+# MAGIC   return {"training" : clusteredFrames["clustered_training_df"], "testing" : clusteredFrames["clustered_testing_df"]}
+# MAGIC 
+# MAGIC stagePipeline.add(Stage("label", labelStage, ["split", "cluster_sweep"], persist = False))
+# MAGIC 
+# MAGIC clusteredFrames = stagePipeline.run(["label"])["label"]
+# MAGIC clusteredtrainingDF, clusteredTestingDF = clusteredFrames["training"], clusteredFrames["testing"]
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Visualize Class Balance Between Training and Test Datasets
+
+# COMMAND ----------
+
+# DBTITLE 1,Validation DataFrame Class Balance
+# MAGIC %sql
+# MAGIC 
+# MAGIC --
+# MAGIC -- Check for class imbalance
+# MAGIC --
+# MAGIC 
+# MAGIC SELECT "TRAINING" AS LABEL,
+# MAGIC        CLUSTER,
+# MAGIC        LOG(COUNT(*)) AS LOG_COUNT
+# MAGIC FROM clustered_training_df
+# MAGIC GROUP BY CLUSTER
+# MAGIC UNION ALL
+# MAGIC SELECT "TESTING" AS LABEL,
+# MAGIC        CLUSTER,
+# MAGIC        LOG(COUNT(*)) AS LOG_COUNT
+# MAGIC FROM clustered_testing_df
+# MAGIC GROUP BY CLUSTER
+# MAGIC ORDER BY CLUSTER ASC;
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ## Tree Model Training
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Feature Quantization Cache
+# MAGIC 
+# MAGIC Most assembled features (Year, Week_Number, the Days_Until_* counters and the indexed categories) have far fewer distinct values than the 4000 bins the trees used to be configured with. Every feature's cardinality is profiled once: indexed categories stay categorical, features with at most `maxBins` distinct values stay exact ordinal features and only the remaining ones are quantized into quantile buckets. The binned feature vectors are cached per `maxBins`, so every tree fit of a sweep reuses them, and `maxBins` is derived from the data. The cache only holds bins of the current labels, the label stage releases it every time it runs.
+
+# COMMAND ----------
+
+# DBTITLE 1,Feature Quantization Cache
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml.feature import Bucketizer, VectorAssembler
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.functions import approx_count_distinct
+# MAGIC from typing import Dict, List, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Profile, quantize and cache the tree features
+# MAGIC """
+# MAGIC 
+# MAGIC def featureProfile(dataset : DataFrame,
+# MAGIC                    columns : List[str]) -> Dict[str, Dict]:
+# MAGIC   """
+# MAGIC     Profile the cardinality of every feature in a single pass
+# MAGIC     
+# MAGIC     @return Dictionary of column to its kind ("categorical" or "ordinal") and number of distinct values
+# MAGIC     
+# MAGIC     @param dataset       | Spark DataFrame containing the feature columns
+# MAGIC     @param columns       | feature columns in assembly order
+# MAGIC   """
+# MAGIC   
+# MAGIC   distinct = dataset.agg(*[approx_count_distinct(c, rsd = 0.01).alias(c) for c in columns]).first()
+# MAGIC   profile = {}
+# MAGIC   
+# MAGIC   for c in columns:
+# MAGIC     ## StringIndexer outputs carry nominal metadata with their labels
+# MAGIC     attributes = dataset.schema[c].metadata.get("ml_attr", {})
+# MAGIC     if attributes.get("type") == "nominal":
+# MAGIC       profile[c] = {"kind" : "categorical", "distinct" : len(attributes.get("vals", [])) or distinct[c]}
+# MAGIC     else:
+# MAGIC       profile[c] = {"kind" : "ordinal", "distinct" : distinct[c]}
+# MAGIC   
+# MAGIC   return profile
+# MAGIC 
+# MAGIC def dataDrivenMaxBins(profile : Dict[str, Dict],
+# MAGIC                       cap : int = 256) -> int:
+# MAGIC   """
+# MAGIC     Smallest number of bins that keeps every ordinal feature exact, up to a cap
+# MAGIC     
+# MAGIC     @return Number of bins for the tree trainers
+# MAGIC     
+# MAGIC     @param profile       | feature profile from featureProfile
+# MAGIC     @param cap           | largest number of bins for ordinal features
+# MAGIC   """
+# MAGIC   
+# MAGIC   ordinal = [p["distinct"] for p in profile.values() if p["kind"] == "ordinal"]
+# MAGIC   categorical = [p["distinct"] for p in profile.values() if p["kind"] == "categorical"]
+# MAGIC   
+# MAGIC   ## categorical features need a bin per category whatever the cap
+# MAGIC   return max([min(max(ordinal + [2]), cap)] + categorical)
+# MAGIC 
+# MAGIC def binnedFeatures(frames : Dict[str, DataFrame],
+# MAGIC                    profile : Dict[str, Dict],
+# MAGIC                    maxBins : int,
+# MAGIC                    outputCol : str = "binned_features") -> Dict[str, DataFrame]:
+# MAGIC   """
+# MAGIC     Quantize the features with more distinct values than maxBins and cache the assembled result
+# MAGIC     
+# MAGIC     @return Dictionary of view name to the cached binned frame, the first frame defines the bucket splits
+# MAGIC     
+# MAGIC     @param frames        | Dictionary of view name to Spark DataFrame with the feature columns
+# MAGIC     @param profile       | feature profile from featureProfile, in assembly order
+# MAGIC     @param maxBins       | number of bins the trees will use
+# MAGIC     @param outputCol     | Name of the binned vector column
+# MAGIC   """
+# MAGIC   
+# MAGIC   names = list(frames)
+# MAGIC   if all((name, maxBins) in featureBinningCache for name in names):
+# MAGIC     return {name : featureBinningCache[(name, maxBins)] for name in names}
+# MAGIC   
+# MAGIC   quantized = [c for c, p in profile.items() if p["kind"] == "ordinal" and p["distinct"] > maxBins]
+# MAGIC   inputCols = [f"{c}_BIN" if c in quantized else c for c in profile]
+# MAGIC   
+# MAGIC   stages = []
+# MAGIC   if quantized:
+# MAGIC     ## quantile bucket boundaries from the first (training) frame
+# MAGIC     quantiles = frames[names[0]].approxQuantile(quantized, [i / maxBins for i in range(1, maxBins)], 0.001)
+# MAGIC     splits = [[-float("inf")] + sorted(set(q)) + [float("inf")] for q in quantiles]
+# MAGIC     stages.append(Bucketizer(splitsArray = splits,
+# MAGIC                              inputCols = quantized,
+# MAGIC                              outputCols = [f"{c}_BIN" for c in quantized],
+# MAGIC                              handleInvalid = "keep"))
+# MAGIC   stages.append(VectorAssembler(inputCols = inputCols, outputCol = outputCol))
+# MAGIC   
+# MAGIC   binned = {}
+# MAGIC   for name in names:
+# MAGIC     frame = frames[name]
+# MAGIC     for stage in stages:
+# MAGIC       frame = stage.transform(frame)
+# MAGIC     binned[f"{name}_bins_{maxBins}"] = frame
+# MAGIC   
+# MAGIC   ## cache every binned frame once, later fits with the same maxBins reuse it
+# MAGIC   cached = materializeFrames(binned)
+# MAGIC   for name in names:
+# MAGIC     featureBinningCache[(name, maxBins)] = cached[f"{name}_bins_{maxBins}"]
+# MAGIC   
+# MAGIC   return {name : featureBinningCache[(name, maxBins)] for name in names}
+
+
+# COMMAND ----------
+
+# DBTITLE 1,Quantize the Tree Features
+# MAGIC %python
+# MAGIC 
+# MAGIC """
+# MAGIC   Profile the features once and pick maxBins from the data
+# MAGIC """
+# MAGIC 
+# MAGIC treeFeatureProfile = featureProfile(clusteredtrainingDF, features)
+# MAGIC treeMaxBins = dataDrivenMaxBins(treeFeatureProfile)
+# MAGIC 
+# MAGIC binnedFrames = binnedFeatures({"clustered_training_df" : clusteredtrainingDF,
+# MAGIC                                "clustered_testing_df" : clusteredTestingDF},
+# MAGIC                               profile = treeFeatureProfile,
+# MAGIC                               maxBins = treeMaxBins)
+# MAGIC binnedTrainingDF, binnedTestingDF = binnedFrames["clustered_training_df"], binnedFrames["clustered_testing_df"]
+# MAGIC 
+# MAGIC print(f"Data driven maxBins: {treeMaxBins}")
+# MAGIC display(spark.createDataFrame([(c, p["kind"], p["distinct"]) for c, p in treeFeatureProfile.items()],
+# MAGIC                               "feature STRING, kind STRING, distinct_values LONG"))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Decision Training Function
+
+# COMMAND ----------
+
+import mlflow
+from pyspark.ml.classification import DecisionTreeClassifier
+from pyspark.ml.evaluation import MulticlassClassificationEvaluator
+from pyspark.sql import DataFrame
+from typing import Dict, Optional, Tuple
+
+def dtcTrain(p_max_depth : int,
+             training_data : DataFrame,
+             test_data : DataFrame,
+             seed : int,
+             featuresCol : str,
+             labelCol : str,
+             maxBins : int = 4000,
+             parentRunId : Optional[str] = None,
+             cacheExtra : Optional[Dict] = None) -> Tuple[int, float]:
+  # runs started from worker threads don't see the parent run, so link it explicitly
+  with mlflow.start_run(nested = parentRunId is not None,
+                        tags = {"mlflow.parentRunId" : parentRunId} if parentRunId else None) as run:
+    # log some parameters
+    mlflow.log_param("Maximum_depth", p_max_depth)
+    mlflow.log_param("Maximum_bins", maxBins)
+    mlflow.log_metric("Training Data Rows", training_data.count())
+    mlflow.log_metric("Test Data Rows", test_data.count())
+    
+    # start the decision tree classifier
+    dtc = DecisionTreeClassifier()\
+                          .setFeaturesCol(featuresCol)\
+                          .setLabelCol(labelCol)\
+                          .setMaxDepth(p_max_depth)\
+                          .setSeed(seed)\
+                          .setPredictionCol("predictions")\
+                          .setMaxBins(maxBins)
+    
+    # Reuse an identical earlier training run
+    cacheKey = trainingCacheKey(dtc, {"labelCol" : labelCol, **(cacheExtra or {})})
+    cached = cachedTraining(cacheKey)
+    recordTrainingCache(hit = cached is not None)
+    
+    if cached is not None:
+      model, cachedRun = cached
+      mlflow.set_tag("training_cache_source_run", cachedRun["run_id"])
+      mlflow.log_metric("F1", cachedRun["metrics.F1"])
+      return (model, cachedRun["metrics.F1"])
+    
+    # Start up the evaluator
+    evaluator = MulticlassClassificationEvaluator()\
+                      .setLabelCol("cluster")\
+                      .setPredictionCol("predictions")
+
+    # Train a model
+    model = dtc.fit(training_data)
+
+    # Make some predictions
+    predictions = model.transform(test_data)
+
+    # Evaluate the tree
+    silhouette = evaluator.evaluate(predictions)
+    
+    # Log the accuracy
+    mlflow.log_metric("F1", silhouette)
+    
+    # Log the feature importances
+    mlflow.log_param("Feature Importances", model.featureImportances)
+    
+    # Log the model
+    mlflow.spark.log_model(model, f"Decision_tree_{p_max_depth}")
+    mlflow.set_tags({"training_cache_key" : cacheKey, "training_cache_artifact" : f"Decision_tree_{p_max_depth}"})
+    
+    ## Return the class and silhouette
+    return (model, silhouette)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Truncated Decision Tree Sweep
+# MAGIC 
+# MAGIC Greedy tree growth at depth d is a prefix of the tree grown at depth d+1, so the sweep grows the deepest tree once and derives every shallower depth by truncating it. All truncated trees are scored against the test data in one shared pass.
+
+# COMMAND ----------
+
+# DBTITLE 1,Truncated Decision Tree Sweep
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml import Model
+# MAGIC from pyspark.ml.classification import DecisionTreeClassifier, DecisionTreeClassificationModel
+# MAGIC from pyspark.ml.functions import vector_to_array
+# MAGIC from pyspark.ml.param import Param, Params, TypeConverters
+# MAGIC from pyspark.ml.param.shared import HasFeaturesCol, HasPredictionCol
+# MAGIC from pyspark.ml.util import DefaultParamsReadable, DefaultParamsWritable
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.functions import pandas_udf, posexplode
+# MAGIC import mlflow
+# MAGIC import numpy as np
+# MAGIC import pandas as pd
+# MAGIC import time
+# MAGIC from typing import Dict, Iterable, List, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Derive every decision tree depth from a single fit
+# MAGIC """
+# MAGIC 
+# MAGIC def decisionTreeNodes(model : DecisionTreeClassificationModel) -> Dict[str, list]:
+# MAGIC   """
+# MAGIC     Read the nodes of a fitted decision tree, root first
+# MAGIC     
+# MAGIC     @return Dictionary of per node split feature, threshold, categorical flag, left categories, children and prediction
+# MAGIC     
+# MAGIC     @param model         | fitted decision tree model
+# MAGIC   """
+# MAGIC   
+# MAGIC   nodes = {"feature" : [], "threshold" : [], "categorical" : [], "leftCategories" : [],
+# MAGIC            "left" : [], "right" : [], "prediction" : []}
+# MAGIC   
+# MAGIC   def visit(node) -> int:
+# MAGIC     index = len(nodes["prediction"])
+# MAGIC     for key in nodes:
+# MAGIC       nodes[key].append(-1 if key in ("feature", "left", "right") else None)
+# MAGIC     nodes["prediction"][index] = node.prediction()
+# MAGIC     nodes["threshold"][index] = 0.0
+# MAGIC     nodes["categorical"][index] = False
+# MAGIC     nodes["leftCategories"][index] = []
+# MAGIC     
+# MAGIC     if node.getClass().getSimpleName() == "InternalNode":
+# MAGIC       split = node.split()
+# MAGIC       nodes["feature"][index] = split.featureIndex()
+# MAGIC       if split.getClass().getSimpleName() == "CategoricalSplit":
+# MAGIC         nodes["categorical"][index] = True
+# MAGIC         nodes["leftCategories"][index] = [int(c) for c in split.leftCategories()]
+# MAGIC       else:
+# MAGIC         nodes["threshold"][index] = split.threshold()
+# MAGIC       nodes["left"][index] = visit(node.leftChild())
+# MAGIC       nodes["right"][index] = visit(node.rightChild())
+# MAGIC     
+# MAGIC     return index
+# MAGIC   
+# MAGIC   visit(model._java_obj.rootNode())
+# MAGIC   return nodes
+# MAGIC 
+# MAGIC def walkDecisionTree(points : np.ndarray,
+# MAGIC                      nodes : Dict[str, list],
+# MAGIC                      maxDepth : int) -> np.ndarray:
+# MAGIC   """
+# MAGIC     Walk points down a decision tree one level at a time
+# MAGIC     
+# MAGIC     @return Node reached by every point at every depth, shape (maxDepth + 1, number of points)
+# MAGIC     
+# MAGIC     @param points        | feature vectors, one row per point
+# MAGIC     @param nodes         | tree nodes from decisionTreeNodes
+# MAGIC     @param maxDepth      | deepest level to walk to
+# MAGIC   """
+# MAGIC   
+# MAGIC   feature = np.array(nodes["feature"])
+# MAGIC   threshold = np.array(nodes["threshold"])
+# MAGIC   categorical = np.array(nodes["categorical"])
+# MAGIC   left, right = np.array(nodes["left"]), np.array(nodes["right"])
+# MAGIC   
+# MAGIC   ## dense lookup of the categories sent left by every categorical split
+# MAGIC   categoryCount = max([max(c) + 1 for c in nodes["leftCategories"] if c] + [1])
+# MAGIC   goesLeft = np.zeros((len(feature), categoryCount), dtype = bool)
+# MAGIC   for index, categories in enumerate(nodes["leftCategories"]):
+# MAGIC     goesLeft[index, categories] = True
+# MAGIC   
+# MAGIC   current = np.zeros(len(points), dtype = int)
+# MAGIC   reached = [current.copy()]
+# MAGIC   rows = np.arange(len(points))
+# MAGIC   
+# MAGIC   for depth in range(maxDepth):
+# MAGIC     internal = left[current] >= 0
+# MAGIC     values = points[rows, np.maximum(feature[current], 0)]
+# MAGIC     
+# MAGIC     ## categories no split sends left, like the unseen index of handleInvalid keep, go right as in spark
+# MAGIC     known = (values >= 0) & (values < categoryCount)
+# MAGIC     categories = np.where(known, values, 0).astype(int)
+# MAGIC     toLeft = np.where(categorical[current], known & goesLeft[current, categories], values <= threshold[current])
+# MAGIC     current = np.where(internal, np.where(toLeft, left[current], right[current]), current)
+# MAGIC     reached.append(current.copy())
+# MAGIC   
+# MAGIC   return np.stack(reached)
+# MAGIC 
+# MAGIC class DecisionTreeTruncatedModel(Model, HasFeaturesCol, HasPredictionCol, DefaultParamsReadable, DefaultParamsWritable):
+# MAGIC   """
+# MAGIC     Decision tree classification model cut off at a maximum depth,
+# MAGIC     nodes at the cut predict their majority class like a leaf
+# MAGIC   """
+# MAGIC   
+# MAGIC   nodes = Param(Params._dummy(), "nodes", "nodes of the full decision tree", typeConverter = TypeConverters.identity)
+# MAGIC   maxDepth = Param(Params._dummy(), "maxDepth", "depth the tree is truncated at", typeConverter = TypeConverters.toInt)
+# MAGIC   
+# MAGIC   def __init__(self, featuresCol : str = "features", predictionCol : str = "predictions"):
+# MAGIC     super(DecisionTreeTruncatedModel, self).__init__()
+# MAGIC     self._setDefault(featuresCol = featuresCol, predictionCol = predictionCol)
+# MAGIC   
+# MAGIC   @property
+# MAGIC   def toDebugString(self) -> str:
+# MAGIC     """
+# MAGIC       Full description of the truncated tree in the format of DecisionTreeClassificationModel
+# MAGIC     """
+# MAGIC     nodes = self.getOrDefault(self.nodes)
+# MAGIC     maxDepth = self.getOrDefault(self.maxDepth)
+# MAGIC     lines = [f"DecisionTreeTruncatedModel: uid={self.uid}, depth={maxDepth}"]
+# MAGIC     
+# MAGIC     def describe(index : int, depth : int) -> None:
+# MAGIC       indent = " " * (depth + 1)
+# MAGIC       if nodes["left"][index] < 0 or depth == maxDepth:
+# MAGIC         lines.append(f"{indent}Predict: {nodes['prediction'][index]}")
+# MAGIC         return
+# MAGIC       feature = nodes["feature"][index]
+# MAGIC       if nodes["categorical"][index]:
+# MAGIC         categories = "{" + ",".join(str(float(c)) for c in nodes["leftCategories"][index]) + "}"
+# MAGIC         conditions = (f"feature {feature} in {categories}", f"feature {feature} not in {categories}")
+# MAGIC       else:
+# MAGIC         conditions = (f"feature {feature} <= {nodes['threshold'][index]}", f"feature {feature} > {nodes['threshold'][index]}")
+# MAGIC       lines.append(f"{indent}If ({conditions[0]})")
+# MAGIC       describe(nodes["left"][index], depth + 1)
+# MAGIC       lines.append(f"{indent}Else ({conditions[1]})")
+# MAGIC       describe(nodes["right"][index], depth + 1)
+# MAGIC     
+# MAGIC     describe(0, 0)
+# MAGIC     return "\n".join(lines)
+# MAGIC   
+# MAGIC   def _transform(self, dataset : DataFrame) -> DataFrame:
+# MAGIC     nodes = self.getOrDefault(self.nodes)
+# MAGIC     maxDepth = self.getOrDefault(self.maxDepth)
+# MAGIC     prediction = np.array(nodes["prediction"])
+# MAGIC     
+# MAGIC     @pandas_udf("double")
+# MAGIC     def predict(features : pd.Series) -> pd.Series:
+# MAGIC       reached = walkDecisionTree(np.stack(features.values), nodes, maxDepth)
+# MAGIC       return pd.Series(prediction[reached[-1]])
+# MAGIC     
+# MAGIC     return dataset.withColumn(self.getPredictionCol(), predict(vector_to_array(self.getFeaturesCol())))
+# MAGIC 
+# MAGIC def weightedF1(counts : Dict[Tuple[float, float], int]) -> float:
+# MAGIC   """
+# MAGIC     Weighted F1 over the labels, the default metric of MulticlassClassificationEvaluator
+# MAGIC     
+# MAGIC     @return Weighted F1 score
+# MAGIC     
+# MAGIC     @param counts        | Dictionary of (label, prediction) to number of rows
+# MAGIC   """
+# MAGIC   
+# MAGIC   labels = {label for label, prediction in counts}
+# MAGIC   total = sum(counts.values())
+# MAGIC   score = 0.0
+# MAGIC   
+# MAGIC   for label in labels:
+# MAGIC     truePositives = counts.get((label, label), 0)
+# MAGIC     actual = sum(n for (l, p), n in counts.items() if l == label)
+# MAGIC     predicted = sum(n for (l, p), n in counts.items() if p == label)
+# MAGIC     precision = truePositives / predicted if predicted else 0.0
+# MAGIC     recall = truePositives / actual if actual else 0.0
+# MAGIC     f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+# MAGIC     score += actual / total * f1
+# MAGIC   
+# MAGIC   return score
+# MAGIC 
+# MAGIC def dtcTruncatedSweep(depths : Iterable[int],
+# MAGIC                       training_data : DataFrame,
+# MAGIC                       test_data : DataFrame,
+# MAGIC                       seed : int,
+# MAGIC                       featuresCol : str,
+# MAGIC                       labelCol : str,
+# MAGIC                       maxBins : int = 4000) -> List[Tuple[int, Tuple[Model, float]]]:
+# MAGIC   """
+# MAGIC     Grow the deepest decision tree once and truncate it for every other depth
+# MAGIC     
+# MAGIC     @return List of (max depth, (model, F1)) in the order of depths
+# MAGIC     
+# MAGIC     @param depths        | maximum depths to derive
+# MAGIC     @param training_data | Spark DataFrame to train on
+# MAGIC     @param test_data     | Spark DataFrame to score the truncated trees on
+# MAGIC     @param seed          | random number seed
+# MAGIC     @param featuresCol   | Name of the vectorized column
+# MAGIC     @param labelCol      | Name of the label column
+# MAGIC     @param maxBins       | maximum number of bins per feature
+# MAGIC   """
+# MAGIC   
+# MAGIC   depths = list(depths)
+# MAGIC   deepest = max(depths)
+# MAGIC   
+# MAGIC   with mlflow.start_run(run_name = "Decision Tree Truncated Sweep") as sweepRun:
+# MAGIC     mlflow.log_param("Depths", str(depths))
+# MAGIC     mlflow.log_param("Maximum_bins", maxBins)
+# MAGIC     mlflow.log_param("seed", str(seed))
+# MAGIC     
+# MAGIC     start = time.time()
+# MAGIC     
+# MAGIC     ## the only fit of the sweep
+# MAGIC     fullModel = DecisionTreeClassifier()\
+# MAGIC                           .setFeaturesCol(featuresCol)\
+# MAGIC                           .setLabelCol(labelCol)\
+# MAGIC                           .setMaxDepth(deepest)\
+# MAGIC                           .setSeed(seed)\
+# MAGIC                           .setPredictionCol("predictions")\
+# MAGIC                           .setMaxBins(maxBins)\
+# MAGIC                           .fit(training_data)
+# MAGIC     
+# MAGIC     nodes = decisionTreeNodes(fullModel)
+# MAGIC     prediction = np.array(nodes["prediction"])
+# MAGIC     
+# MAGIC     @pandas_udf("array<double>")
+# MAGIC     def predictAllDepths(features : pd.Series) -> pd.Series:
+# MAGIC       reached = walkDecisionTree(np.stack(features.values), nodes, deepest)
+# MAGIC       return pd.Series(list(prediction[reached[depths]].T))
+# MAGIC     
+# MAGIC     ## one pass over the test data scores every depth
+# MAGIC     counts = test_data.select(labelCol, predictAllDepths(vector_to_array(featuresCol)).alias("depth_predictions"))\
+# MAGIC                       .select(labelCol, posexplode("depth_predictions"))\
+# MAGIC                       .groupBy("pos", labelCol, "col")\
+# MAGIC                       .count()\
+# MAGIC                       .collect()
+# MAGIC     
+# MAGIC     depthCounts = {}
+# MAGIC     for row in counts:
+# MAGIC       depthCounts.setdefault(row["pos"], {})[(row[labelCol], row["col"])] = row["count"]
+# MAGIC     
+# MAGIC     results = []
+# MAGIC     
+# MAGIC     for position, depth in enumerate(depths):
+# MAGIC       f1 = weightedF1(depthCounts.get(position, {}))
+# MAGIC       
+# MAGIC       model = DecisionTreeTruncatedModel(featuresCol = featuresCol, predictionCol = "predictions")
+# MAGIC       model.set(model.nodes, nodes)
+# MAGIC       model.set(model.maxDepth, depth)
+# MAGIC       
+# MAGIC       with mlflow.start_run(nested = True) as run:
+# MAGIC         mlflow.log_param("Maximum_depth", depth)
+# MAGIC         mlflow.log_metric("F1", f1)
+# MAGIC         mlflow.spark.log_model(model, f"Decision_tree_{depth}")
+# MAGIC       
+# MAGIC       results.append((depth, (model, f1)))
+# MAGIC     
+# MAGIC     mlflow.log_metric("Sweep Seconds", time.time() - start)
+# MAGIC   
+# MAGIC   return results
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### XGBoost Training Function
+
+# COMMAND ----------
+
+# DBTITLE 1,XGBoost Training Function
+# MAGIC %python
+# MAGIC 
+# MAGIC """
+# MAGIC XGBoost Trainer
+# MAGIC """
+# MAGIC 
+# MAGIC import mlflow
+# MAGIC from sparkxgb import XGBoostClassifier
+# MAGIC from pyspark.ml.evaluation import MulticlassClassificationEvaluator
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from typing import Dict, Optional, Tuple
+# MAGIC 
+# MAGIC def xgbTrain(p_max_depth : int,
+# MAGIC              training_data : DataFrame,
+# MAGIC              test_data : DataFrame,
+# MAGIC              seed : int,
+# MAGIC              featuresCol : str,
+# MAGIC              labelCol : str,
+# MAGIC              parentRunId : Optional[str] = None,
+# MAGIC              cacheExtra : Optional[Dict] = None) -> Tuple[int, float]:
+# MAGIC   # runs started from worker threads don't see the parent run, so link it explicitly
+# MAGIC   with mlflow.start_run(nested = parentRunId is not None,
+# MAGIC                         tags = {"mlflow.parentRunId" : parentRunId} if parentRunId else None) as run:
+# MAGIC     # log some parameters
+# MAGIC     mlflow.log_param("Maximum_depth", p_max_depth)
+# MAGIC     mlflow.log_metric("Training Data Rows", training_data.count())
+# MAGIC     mlflow.log_metric("Test Data Rows", test_data.count())
+# MAGIC     
+# MAGIC     # start the decision tree classifier
+# MAGIC     dtc = XGBoostClassifier()\
+# MAGIC               .setFeaturesCol(featuresCol)\
+# MAGIC               .setLabelCol(labelCol)\
+# MAGIC               .setMaxDepth(p_max_depth)\
+# MAGIC               .setSeed(seed)\
+# MAGIC               .setPredictionCol("predictions")
+# MAGIC     
+# MAGIC     # Reuse an identical earlier training run
+# MAGIC     cacheKey = trainingCacheKey(dtc, {"labelCol" : labelCol, **(cacheExtra or {})})
+# MAGIC     cached = cachedTraining(cacheKey)
+# MAGIC     recordTrainingCache(hit = cached is not None)
+# MAGIC     
+# MAGIC     if cached is not None:
+# MAGIC       model, cachedRun = cached
+# MAGIC       mlflow.set_tag("training_cache_source_run", cachedRun["run_id"])
+# MAGIC       mlflow.log_metric("F1", cachedRun["metrics.F1"])
+# MAGIC       return (model, cachedRun["metrics.F1"])
+# MAGIC     
+# MAGIC     # Start up the evaluator
+# MAGIC     evaluator = MulticlassClassificationEvaluator()\
+# MAGIC                       .setLabelCol("cluster")\
+# MAGIC                       .setPredictionCol("predictions")
+# MAGIC 
+# MAGIC     # Train a model
+# MAGIC     model = dtc.fit(training_data)
+# MAGIC 
+# MAGIC     # Make some predictions
+# MAGIC     predictions = model.transform(test_data)
+# MAGIC 
+# MAGIC     # Evaluate the tree
+# MAGIC     silhouette = evaluator.evaluate(predictions)
+# MAGIC     
+# MAGIC     # Log the accuracy
+# MAGIC     mlflow.log_metric("F1", silhouette)
+# MAGIC     
+# MAGIC #     # Log the feature importances
+# MAGIC #     mlflow.log_param("Feature Importances", model.featureImportances)
+# MAGIC     
+# MAGIC     # Log the model
+# MAGIC     mlflow.spark.log_model(model, f"XGBoost_Tree{p_max_depth}")
+# MAGIC     mlflow.set_tags({"training_cache_key" : cacheKey, "training_cache_artifact" : f"XGBoost_Tree{p_max_depth}"})
+# MAGIC     
+# MAGIC     ## Return the class and silhouette
+# MAGIC     return (model, silhouette)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Successive Halving Tuner
+# MAGIC 
+# MAGIC Rather than training every depth on the full training data, the successive halving tuner trains every candidate on a small sample first. Only the best `1 / eta` of the candidates move on to the next rung, which trains on `eta` times more data, until the last rung trains on all of it. Every rung is logged as an MLflow run with the fits nested under it. Each depth keeps the model and F1 of the last rung it reached, together with the share of the data that rung trained on. Only depths trained on all the data compete for the optimal model, `bestFullDataModel` picks the best F1 among them.
+
+# COMMAND ----------
+
+# DBTITLE 1,Successive Halving Tuner
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml import Model
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC import math
+# MAGIC import mlflow
+# MAGIC from typing import Callable, Dict, Iterable, List, Optional, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Budget aware successive halving over the tree depths
+# MAGIC """
+# MAGIC 
+# MAGIC def successiveHalving(trainFn : Callable[..., Tuple[Model, float]],
+# MAGIC                       depths : Iterable[int],
+# MAGIC                       training_data : DataFrame,
+# MAGIC                       test_data : DataFrame,
+# MAGIC                       seed : int,
+# MAGIC                       featuresCol : str,
+# MAGIC                       labelCol : str,
+# MAGIC                       eta : int = 3,
+# MAGIC                       minFraction : Optional[float] = None,
+# MAGIC                       **trainArgs) -> List[Tuple[int, Tuple[Model, float]]]:
+# MAGIC   """
+# MAGIC     Tune the maximum depth with successive halving
+# MAGIC     
+# MAGIC     @return List of (max depth, (model, F1), data fraction) in the order of depths, every depth from the last rung it reached
+# MAGIC     
+# MAGIC     @param trainFn       | trainer with the dtcTrain / xgbTrain signature
+# MAGIC     @param depths        | candidate maximum depths
+# MAGIC     @param training_data | Spark DataFrame to train on
+# MAGIC     @param test_data     | Spark DataFrame to score on
+# MAGIC     @param seed          | random number seed
+# MAGIC     @param featuresCol   | Name of the vectorized column
+# MAGIC     @param labelCol      | Name of the label column
+# MAGIC     @param eta           | share of candidates dropped per rung and data growth factor
+# MAGIC     @param minFraction   | share of the training data used by the first rung, by default enough rungs to end on all the data
+# MAGIC     @param trainArgs     | extra arguments passed to trainFn
+# MAGIC   """
+# MAGIC   
+# MAGIC   depths = list(depths)
+# MAGIC   
+# MAGIC   ## number of rungs until a single candidate is left
+# MAGIC   rungs, survivors = 1, len(depths)
+# MAGIC   while survivors > 1:
+# MAGIC     survivors = math.ceil(survivors / eta)
+# MAGIC     rungs += 1
+# MAGIC   if minFraction is None:
+# MAGIC     minFraction = float(eta) ** -(rungs - 1)
+# MAGIC   
+# MAGIC   results, fractions = {}, {}
+# MAGIC   candidates = depths
+# MAGIC   
+# MAGIC   with mlflow.start_run(run_name = f"{trainFn.__name__} Successive Halving") as tunerRun:
+# MAGIC     mlflow.log_param("Depths", str(depths))
+# MAGIC     mlflow.log_param("eta", eta)
+# MAGIC     mlflow.log_param("Minimum_fraction", minFraction)
+# MAGIC     
+# MAGIC     for rung in range(rungs):
+# MAGIC       fraction = min(1.0, minFraction * eta ** rung)
+# MAGIC       rungData = training_data if fraction >= 1.0 else training_data.sample(fraction = fraction, seed = seed)
+# MAGIC       
+# MAGIC       with mlflow.start_run(run_name = f"Rung {rung}",
+# MAGIC                             nested = True,
+# MAGIC                             tags = {"mlflow.parentRunId" : tunerRun.info.run_id}) as rungRun:
+# MAGIC         mlflow.log_param("Rung", rung)
+# MAGIC         mlflow.log_param("Data_fraction", fraction)
+# MAGIC         mlflow.log_param("Candidates", str(candidates))
+# MAGIC         
+# MAGIC         for depth in candidates:
+# MAGIC           results[depth] = trainFn(p_max_depth = depth,
+# MAGIC                                    training_data = rungData,
+# MAGIC                                    test_data = test_data,
+# MAGIC                                    seed = seed,
+# MAGIC                                    featuresCol = featuresCol,
+# MAGIC                                    labelCol = labelCol,
+# MAGIC                                    parentRunId = rungRun.info.run_id,
+# MAGIC                                    cacheExtra = {"data_fraction" : fraction, "sample_seed" : seed},
+# MAGIC                                    **trainArgs)
+# MAGIC           fractions[depth] = fraction
+# MAGIC           mlflow.log_metric("F1", results[depth][1], step = depth)
+# MAGIC       
+# MAGIC       if fraction >= 1.0:
+# MAGIC         break
+# MAGIC       
+# MAGIC       ## keep the best 1 / eta of the candidates for the next rung
+# MAGIC       keep = max(1, math.ceil(len(candidates) / eta))
+# MAGIC       candidates = sorted(candidates, key = lambda d : results[d][1], reverse = True)[:keep]
+# MAGIC     
+# MAGIC     best = max(candidates, key = lambda d : results[d][1])
+# MAGIC     
+# MAGIC     ## a small minFraction can run out of rungs before all the data, the winner is always refit on all of it
+# MAGIC     if fractions[best] < 1.0:
+# MAGIC       results[best] = trainFn(p_max_depth = best,
+# MAGIC                               training_data = training_data,
+# MAGIC                               test_data = test_data,
+# MAGIC                               seed = seed,
+# MAGIC                               featuresCol = featuresCol,
+# MAGIC                               labelCol = labelCol,
+# MAGIC                               parentRunId = tunerRun.info.run_id,
+# MAGIC                               cacheExtra = {"data_fraction" : 1.0, "sample_seed" : seed},
+# MAGIC                               **trainArgs)
+# MAGIC       fractions[best] = 1.0
+# MAGIC     
+# MAGIC     mlflow.log_param("Best_Maximum_depth", best)
+# MAGIC   
+# MAGIC   return [(depth, results[depth], fractions[depth]) for depth in depths]
+# MAGIC 
+# MAGIC def sweepFraction(entry : Tuple) -> float:
+# MAGIC   """
+# MAGIC     @return Share of the training data a sweep entry was trained on
+# MAGIC     
+# MAGIC     @param entry         | (max depth, (model, F1)) from a full sweep or (max depth, (model, F1), data fraction) from successiveHalving
+# MAGIC   """
+# MAGIC   
+# MAGIC   return entry[2] if len(entry) > 2 else 1.0
+# MAGIC 
+# MAGIC def bestFullDataModel(tuning : List[Tuple]) -> Tuple[int, Model]:
+# MAGIC   """
+# MAGIC     Choose the depth with the best F1 among the sweep entries trained on all the training data
+# MAGIC     
+# MAGIC     @return Chosen max depth
+# MAGIC     @return Its model
+# MAGIC     
+# MAGIC     @param tuning        | sweep from successiveHalving, dtcTruncatedSweep or a full sweep
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## F1 measured on a sample isn't comparable and a model fit on a sample shouldn't ship
+# MAGIC   full = [entry for entry in tuning if sweepFraction(entry) >= 1.0]
+# MAGIC   if not full:
+# MAGIC     raise ValueError("No sweep entry was trained on all the training data")
+# MAGIC   
+# MAGIC   depth, (model, f1) = max(full, key = lambda entry : entry[1][1])[:2]
+# MAGIC   return (depth, model)
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC 
-# MAGIC #### Hyperparameter Tuning for Number of Centroids
+# MAGIC ### Train the XGBoost Tree
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Hyperparameter tuning for Max Depth
 
 # COMMAND ----------
 
-# DBTITLE 1,Tune the Number of Centroids
 # MAGIC %python
 # MAGIC 
+# MAGIC from pyspark.ml import Model
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from typing import Dict, List, Tuple
+# MAGIC 
 # MAGIC """
-# MAGIC   Tune a K-Means Model
+# MAGIC Tune the max depth of the Boost tree
 # MAGIC """
 # MAGIC 
-# MAGIC ## Tune the K Means model by optimizing the number of centroids (hyperparameter tuning)
-# MAGIC kMeansTuning = [(i, kMeansTrain(nCentroids = i, dataset = dfDataset, featuresCol = "features", seed = 1)) for i in range(2 ,15, 1)]
+# MAGIC xgbSweepMode = "halving" ## "halving" runs successive halving, "full" trains every depth on all the data
 # MAGIC 
-# MAGIC ## Return the results into a series of arrays
-# MAGIC kMeansCosts = [(a[0], a[1][1]) for a in kMeansTuning]
+# MAGIC def xgbTuningStage(label : Dict[str, DataFrame],
+# MAGIC                    mode : str,
+# MAGIC                    depths : List[int],
+# MAGIC                    seed : int) -> List[Tuple[int, Tuple[Model, float]]]:
+# MAGIC   """
+# MAGIC     Sweep the max depth of the XGBoost tree
+# MAGIC     
+# MAGIC     @return List of (max depth, (model, F1))
+# MAGIC     
+# MAGIC     @param label         | labeled training and testing dataframes
+# MAGIC     @param mode          | halving or full
+# MAGIC     @param depths        | max depths to sweep
+# MAGIC     @param seed          | random number seed
+# MAGIC   """
+# MAGIC   
+# MAGIC   with schedulerPool("xgb_tuning"):
+# MAGIC     if mode == "halving":
+# MAGIC       return successiveHalving(trainFn = xgbTrain,
+# MAGIC                                depths = depths,
+# MAGIC                                training_data = label["training"],
+# MAGIC                                test_data = label["testing"],
+# MAGIC                                seed = seed,
+# MAGIC                                featuresCol = "features",
+# MAGIC                                labelCol = "cluster")
+# MAGIC     
+# MAGIC     return [(i, xgbTrain(p_max_depth = i,
+# MAGIC                          training_data = label["training"],
+# MAGIC                          test_data = label["testing"],
+# MAGIC                          seed = seed,
+# MAGIC                          featuresCol = "features",
+# MAGIC                          labelCol = "cluster"))
+# MAGIC             for i in depths]
+# MAGIC 
+# MAGIC ## runs together with the decision tree sweep below, they don't depend on each other
+# MAGIC stagePipeline.add(Stage("xgb_tuning", xgbTuningStage, ["label"], params = {"mode" : xgbSweepMode, "depths" : list(range(2, 15, 1)), "seed" : 1}))
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC #### Elbow Plot
+# MAGIC ### Train the Decision Tree
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Hyperparameter tuning for Max Depth
 
 # COMMAND ----------
 
-# DBTITLE 1,Hierarchical Bisecting K-Means Cluster Tuning
 # MAGIC %python
 # MAGIC 
+# MAGIC from pyspark.ml import Model
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from typing import Dict, List, Tuple
+# MAGIC 
 # MAGIC """
-# MAGIC   Show the efffect of increasing the number of centroids
-# MAGIC   for a K Means cluster
+# MAGIC Tune the max depth of the Decision tree and run both tree sweeps
 # MAGIC """
 # MAGIC 
-# MAGIC kMeansCostsDF = sc.parallelize(kMeansCosts)\
-# MAGIC                       .toDF()\
-# MAGIC                       .withColumnRenamed("_1", "Number of Centroids")\
-# MAGIC                       .withColumnRenamed("_2", "Loss")
+# MAGIC dtcSweepMode = "truncated" ## "truncated" grows the deepest tree once, "halving" runs successive halving, "independent" fits every depth
 # MAGIC 
-# MAGIC display(kMeansCostsDF)
+# MAGIC def dtcTuningStage(label : Dict[str, DataFrame],
+# MAGIC                    mode : str,
+# MAGIC                    depths : List[int],
+# MAGIC                    seed : int,
+# MAGIC                    maxBins : int,
+# MAGIC                    profile : Dict) -> List[Tuple[int, Tuple[Model, float]]]:
+# MAGIC   """
+# MAGIC     Sweep the max depth of the decision tree on the binned features
+# MAGIC     
+# MAGIC     @return List of (max depth, (model, F1))
+# MAGIC     
+# MAGIC     @param label         | labeled training and testing dataframes
+# MAGIC     @param mode          | truncated, halving or independent
+# MAGIC     @param depths        | max depths to sweep
+# MAGIC     @param seed          | random number seed
+# MAGIC     @param maxBins       | data driven number of bins
+# MAGIC     @param profile       | feature profile the bins are cut from
+# MAGIC   """
+# MAGIC   
+# MAGIC   ## already cached by the quantization above
+# MAGIC   binned = binnedFeatures({"clustered_training_df" : label["training"], "clustered_testing_df" : label["testing"]},
+# MAGIC                           profile = profile,
+# MAGIC                           maxBins = maxBins)
+# MAGIC   training, testing = binned["clustered_training_df"], binned["clustered_testing_df"]
+# MAGIC   
+# MAGIC   with schedulerPool("dtc_tuning"):
+# MAGIC     if mode == "truncated":
+# MAGIC       return dtcTruncatedSweep(depths = depths,
+# MAGIC                                training_data = training,
+# MAGIC                                test_data = testing,
+# MAGIC                                seed = seed,
+# MAGIC                                featuresCol = "binned_features",
+# MAGIC                                labelCol = "cluster",
+# MAGIC                                maxBins = maxBins)
+# MAGIC     elif mode == "halving":
+# MAGIC       return successiveHalving(trainFn = dtcTrain,
+# MAGIC                                depths = depths,
+# MAGIC                                training_data = training,
+# MAGIC                                test_data = testing,
+# MAGIC                                seed = seed,
+# MAGIC                                featuresCol = "binned_features",
+# MAGIC                                labelCol = "cluster",
+# MAGIC                                maxBins = maxBins)
+# MAGIC     
+# MAGIC     return [(i, dtcTrain(p_max_depth = i,
+# MAGIC                          training_data = training,
+# MAGIC                          test_data = testing,
+# MAGIC                          seed = seed,
+# MAGIC                          featuresCol = "binned_features",
+# MAGIC                          labelCol = "cluster",
+# MAGIC                          maxBins = maxBins))
+# MAGIC             for i in depths]
+# MAGIC 
+# MAGIC stagePipeline.add(Stage("dtc_tuning", dtcTuningStage, ["label"],
+# MAGIC                         params = {"mode" : dtcSweepMode, "depths" : list(range(2, 15, 1)), "seed" : 1, "maxBins" : treeMaxBins},
+# MAGIC                         inputs = {"profile" : lambda : treeFeatureProfile}))
+# MAGIC 
+# MAGIC ## the two sweeps only share the labeled frames, fit them concurrently
+# MAGIC treeSweeps = stagePipeline.run(["xgb_tuning", "dtc_tuning"])
+# MAGIC xgbTuning, dtcTuning = treeSweeps["xgb_tuning"], treeSweeps["dtc_tuning"]
+# MAGIC 
+# MAGIC ## Return the results into a series of arrays
+# MAGIC xgbF1 = [(a[0], float(a[1][1]), float(sweepFraction(a))) for a in xgbTuning]
+# MAGIC dtcF1 = [(a[0], float(a[1][1]), float(sweepFraction(a))) for a in dtcTuning]
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC 
-# MAGIC ## Label Dataset with Clusters
+# MAGIC #### Elbow Plot
 
 # COMMAND ----------
 
-# DBTITLE 1,Augment Data with Cluster Label
+# DBTITLE 1,XGBoost Tuning
 # MAGIC %python
 # MAGIC 
 # MAGIC """
-# MAGIC   Label the testing and training dataframes with the optimal clustering model
+# MAGIC   Show the efffect of increasing the max depth
+# MAGIC   for a XGBoost Tree
 # MAGIC """
 # MAGIC 
+# MAGIC ## successive halving scores most depths on a sample, the fraction tells the points apart
+# MAGIC xgbF1DF = sc.parallelize(xgbF1)\
+# MAGIC                       .toDF()\
+# MAGIC                       .withColumnRenamed("_1", "Max Depth")\
+# MAGIC                       .withColumnRenamed("_2", "F1")\
+# MAGIC                       .withColumnRenamed("_3", "Data Fraction")
 # MAGIC 
-# MAGIC optimalClusterModel = kMeansTuning[3][1][0]
-# MAGIC 
-# MAGIC ## label the training and testing dataframes
-# MAGIC clusteredtrainingDF = optimalClusterModel.transform(trainingDF)\
-# MAGIC                             .withColumnRenamed("predictions", "cluster")
-# MAGIC clusteredTestingDF = optimalClusterModel.transform(testingDF)\
-# MAGIC                             .withColumnRenamed("predictions", "cluster")
-# MAGIC 
-# MAGIC clusteredtrainingDF.createOrReplaceTempView("clustered_training_df")
-# MAGIC clusteredTestingDF.createOrReplaceTempView("clustered_testing_df")
+# MAGIC display(xgbF1DF)
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Visualize Class Balance Between Training and Test Datasets
+# MAGIC #### Elbow Plot
 
 # COMMAND ----------
 
-# DBTITLE 1,Validation DataFrame Class Balance
-# MAGIC %sql
+# MAGIC %python
 # MAGIC 
-# MAGIC --
-# MAGIC -- Check for class imbalance
-# MAGIC --
+# MAGIC """
+# MAGIC   Show the efffect of increasing the max depth
+# MAGIC   for a Decision Tree
+# MAGIC """
 # MAGIC 
-# MAGIC SELECT "TRAINING" AS LABEL,
-# MAGIC        CLUSTER,
-# MAGIC        LOG(COUNT(*)) AS LOG_COUNT
-# MAGIC FROM clustered_training_df
-# MAGIC GROUP BY CLUSTER
-# MAGIC UNION ALL
-# MAGIC SELECT "TESTING" AS LABEL,
-# MAGIC        CLUSTER,
-# MAGIC        LOG(COUNT(*)) AS LOG_COUNT
-# MAGIC FROM clustered_testing_df
-# MAGIC GROUP BY CLUSTER
-# MAGIC ORDER BY CLUSTER ASC;
+# MAGIC ## successive halving scores most depths on a sample, the fraction tells the points apart
+# MAGIC dtcF1DF = sc.parallelize(dtcF1)\
+# MAGIC                       .toDF()\
+# MAGIC                       .withColumnRenamed("_1", "Max Depth")\
+# MAGIC                       .withColumnRenamed("_2", "F1")\
+# MAGIC                       .withColumnRenamed("_3", "Data Fraction")
+# MAGIC 
+# MAGIC display(dtcF1DF)
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC 
-# MAGIC ## Tree Model Training
+# MAGIC #### Multi-Dimensional Cross Validation
+# MAGIC 
+# MAGIC The cross validation assigns every row of the binned training data to a fold once and caches each fold's train and validation partitions. Grid points that share `maxBins` share the same binned features. The fold fits run concurrently on a bounded thread pool, and every fit's F1 and wall-clock time are reported.
 
 # COMMAND ----------
 
-# MAGIC %md
-# MAGIC ### Decision Training Function
+# DBTITLE 1,Cross Validation Runner
+# MAGIC %python
+# MAGIC 
+# MAGIC from concurrent.futures import ThreadPoolExecutor
+# MAGIC from pyspark.ml.classification import DecisionTreeClassifier, DecisionTreeClassificationModel
+# MAGIC from pyspark.ml.evaluation import MulticlassClassificationEvaluator
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.functions import col, floor, rand
+# MAGIC import itertools
+# MAGIC import mlflow
+# MAGIC import pandas as pd
+# MAGIC import time
+# MAGIC from typing import Dict, List, Tuple
+# MAGIC 
+# MAGIC """
+# MAGIC   Cross validate the decision tree over a maxDepth x maxBins grid
+# MAGIC """
+# MAGIC 
+# MAGIC def treeCrossValidation(training_data : DataFrame,
+# MAGIC                         trainingView : str,
+# MAGIC                         profile : Dict[str, Dict],
+# MAGIC                         maxDepths : List[int],
+# MAGIC                         maxBinsList : List[int],
+# MAGIC                         numFolds : int = 3,
+# MAGIC                         parallelism : int = 4,
+# MAGIC                         seed : int = 1,
+# MAGIC                         labelCol : str = "cluster") -> Tuple[DecisionTreeClassificationModel, pd.DataFrame]:
+# MAGIC   """
+# MAGIC     Cross validate a decision tree with cached folds and concurrent fits
+# MAGIC     
+# MAGIC     @return Decision tree refit on all the training data with the best params
+# MAGIC     @return Report with the F1 and fit seconds of every grid point and fold
+# MAGIC     
+# MAGIC     @param training_data | Spark DataFrame with the feature columns and labels
+# MAGIC     @param trainingView  | view name of the training data, used to cache its binned features
+# MAGIC     @param profile       | feature profile from featureProfile
+# MAGIC     @param maxDepths     | maximum depths to try
+# MAGIC     @param maxBinsList   | maximum bins to try, values with the same effective number of bins are tried once
+# MAGIC     @param numFolds      | number of folds
+# MAGIC     @param parallelism   | maximum number of fits running at the same time
+# MAGIC     @param seed          | random number seed
+# MAGIC     @param labelCol      | Name of the label column
+# MAGIC   """
+# MAGIC   
+# MAGIC   evaluator = MulticlassClassificationEvaluator()\
+# MAGIC                     .setLabelCol(labelCol)\
+# MAGIC                     .setPredictionCol("predictions")
+# MAGIC   
+# MAGIC   ## bins beyond the most distinct values of any feature change neither the binned features nor the trees
+# MAGIC   exactBins = dataDrivenMaxBins(profile, cap = max(maxBinsList))
+# MAGIC   requestedBins = maxBinsList
+# MAGIC   maxBinsList = sorted({min(maxBins, exactBins) for maxBins in maxBinsList})
+# MAGIC   
+# MAGIC   ## binned features are shared by every grid point with the same maxBins
+# MAGIC   binned = {maxBins : binnedFeatures({trainingView : training_data}, profile, maxBins)[trainingView]
+# MAGIC             for maxBins in maxBinsList}
+# MAGIC   
+# MAGIC   ## materialize every fold's partitions once
+# MAGIC   foldViews = []
+# MAGIC   folds = {}
+# MAGIC   for maxBins, frame in binned.items():
+# MAGIC     withFolds = frame.withColumn("fold", floor(rand(seed) * numFolds))
+# MAGIC     for fold in range(numFolds):
+# MAGIC       names = (f"cv_bins_{maxBins}_fold_{fold}_train", f"cv_bins_{maxBins}_fold_{fold}_validation")
+# MAGIC       cached = materializeFrames({names[0] : withFolds.filter(col("fold") != fold),
+# MAGIC                                   names[1] : withFolds.filter(col("fold") == fold)})
+# MAGIC       folds[(maxBins, fold)] = (cached[names[0]], cached[names[1]])
+# MAGIC       foldViews.extend(names)
+# MAGIC   
+# MAGIC   def fitFold(maxDepth : int, maxBins : int, fold : int) -> Dict:
+# MAGIC     train, validation = folds[(maxBins, fold)]
+# MAGIC     start = time.time()
+# MAGIC     model = DecisionTreeClassifier()\
+# MAGIC                   .setFeaturesCol("binned_features")\
+# MAGIC                   .setLabelCol(labelCol)\
+# MAGIC                   .setMaxDepth(maxDepth)\
+# MAGIC                   .setMaxBins(maxBins)\
+# MAGIC                   .setSeed(seed)\
+# MAGIC                   .setPredictionCol("predictions")\
+# MAGIC                   .fit(train)
+# MAGIC     fitSeconds = time.time() - start
+# MAGIC     f1 = evaluator.evaluate(model.transform(validation))
+# MAGIC     return {"maxDepth" : maxDepth, "maxBins" : maxBins, "fold" : fold, "F1" : f1,
+# MAGIC             "fit_seconds" : fitSeconds, "seconds" : time.time() - start}
+# MAGIC   
+# MAGIC   try:
+# MAGIC     with mlflow.start_run(run_name = "Decision Tree Cross Validation") as run:
+# MAGIC       mlflow.log_param("Maximum_depths", str(maxDepths))
+# MAGIC       mlflow.log_param("Maximum_bins", str(maxBinsList))
+# MAGIC       mlflow.log_param("Requested_maximum_bins", str(requestedBins))
+# MAGIC       mlflow.log_param("Folds", numFolds)
+# MAGIC       mlflow.log_param("Parallelism", parallelism)
+# MAGIC       
+# MAGIC       start = time.time()
+# MAGIC       with ThreadPoolExecutor(max_workers = parallelism) as pool:
+# MAGIC         futures = [pool.submit(fitFold, maxDepth, maxBins, fold)
+# MAGIC                    for maxDepth, maxBins, fold in itertools.product(maxDepths, maxBinsList, range(numFolds))]
+# MAGIC         report = pd.DataFrame([future.result() for future in futures])
+# MAGIC       
+# MAGIC       averages = report.groupby(["maxDepth", "maxBins"])["F1"].mean()
+# MAGIC       bestDepth, bestBins = averages.idxmax()
+# MAGIC       
+# MAGIC       ## refit the best params on all the training data
+# MAGIC       bestModel = DecisionTreeClassifier()\
+# MAGIC                         .setFeaturesCol("binned_features")\
+# MAGIC                         .setLabelCol(labelCol)\
+# MAGIC                         .setMaxDepth(int(bestDepth))\
+# MAGIC                         .setMaxBins(int(bestBins))\
+# MAGIC                         .setSeed(seed)\
+# MAGIC                         .setPredictionCol("predictions")\
+# MAGIC                         .fit(binned[bestBins])
+# MAGIC       
+# MAGIC       mlflow.log_metric("Cross Validation Seconds", time.time() - start)
+# MAGIC       mlflow.log_metric("Best Average F1", float(averages.max()))
+# MAGIC       mlflow.log_param("Best_Maximum_depth", int(bestDepth))
+# MAGIC       mlflow.log_param("Best_Maximum_bins", int(bestBins))
+# MAGIC       mlflow.log_text(report.to_csv(index = False), "cross_validation.csv")
+# MAGIC       mlflow.spark.log_model(bestModel, "Decision_tree_cross_validated")
+# MAGIC   finally:
+# MAGIC     releaseFrames(foldViews)
+# MAGIC   
+# MAGIC   return (bestModel, report)
 
 # COMMAND ----------
 
-import mlflow
-from pyspark.ml.classification import DecisionTreeClassifier
-from pyspark.ml.evaluation import MulticlassClassificationEvaluator
-from pyspark.sql import DataFrame
-from typing import Tuple
+# DBTITLE 1,Cross Validate the Decision Tree
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml import Model
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from typing import Dict, Tuple
+# MAGIC import pandas as pd
+# MAGIC 
+# MAGIC """
+# MAGIC Do a cross validation of the decision tree model
+# MAGIC """
+# MAGIC 
+# MAGIC def cvStage(label : Dict[str, DataFrame], profile : Dict, **params) -> Tuple[Model, pd.DataFrame]:
+# MAGIC   """
+# MAGIC     Cross validate the decision tree on the labeled training data
+# MAGIC     
+# MAGIC     @return best refitted model and the per fold report
+# MAGIC     
+# MAGIC     @param label         | labeled training and testing dataframes
+# MAGIC     @param profile       | feature profile the bins are cut from
+# MAGIC     @param params        | treeCrossValidation arguments
+# MAGIC   """
+# MAGIC   
+# MAGIC   return treeCrossValidation(training_data = label["training"],
+# MAGIC                              trainingView = "clustered_training_df",
+# MAGIC                              profile = profile,
+# MAGIC                              **params)
+# MAGIC 
+# MAGIC stagePipeline.add(Stage("cv", cvStage, ["label"],
+# MAGIC                         params = {"maxDepths" : [5, 10, 15],
+# MAGIC                                   "maxBinsList" : [treeMaxBins, treeMaxBins * 2, treeMaxBins * 4],
+# MAGIC                                   "numFolds" : 3,
+# MAGIC                                   "parallelism" : 4,
+# MAGIC                                   "seed" : 1,
+# MAGIC                                   "labelCol" : "cluster"},
+# MAGIC                         inputs = {"profile" : lambda : treeFeatureProfile}))
+# MAGIC 
+# MAGIC cvModel_u, cvReport = stagePipeline.run(["cv"])["cv"]
+# MAGIC 
+# MAGIC ## per fold metrics and timings
+# MAGIC display(cvReport)
 
-def dtcTrain(p_max_depth : int,
-             training_data : DataFrame,
-             test_data : DataFrame,
-             seed : int,
-             featuresCol : str,
-             labelCol : str) -> Tuple[int, float]:
-  with mlflow.start_run() as run:
-    # log some parameters
-    mlflow.log_param("Maximum_depth", p_max_depth)
-    mlflow.log_metric("Training Data Rows", training_data.count())
-    mlflow.log_metric("Test Data Rows", test_data.count())
-    
-    # start the decision tree classifier
-    dtc = DecisionTreeClassifier()\
-                          .setFeaturesCol(featuresCol)\
-                          .setLabelCol(labelCol)\
-                          .setMaxDepth(p_max_depth)\
-                          .setSeed(seed)\
-                          .setPredictionCol("predictions")\
-                          .setMaxBins(4000)
-    
-    # Start up the evaluator
-    evaluator = MulticlassClassificationEvaluator()\
-                      .setLabelCol("cluster")\
-                      .setPredictionCol("predictions")
+# COMMAND ----------
 
-    # Train a model
-    model = dtc.fit(training_data)
+# MAGIC %md
+# MAGIC 
+# MAGIC ## Visualize the Optimal Decision Tree
 
-    # Make some predictions
-    predictions = model.transform(test_data)
+# COMMAND ----------
 
-    # Evaluate the tree
-    silhouette = evaluator.evaluate(predictions)
-    
-    # Log the accuracy
-    mlflow.log_metric("F1", silhouette)
-    
-    # Log the feature importances
-    mlflow.log_param("Feature Importances", model.featureImportances)
-    
-    # Log the model
-    mlflow.spark.log_model(model, f"Decision_tree_{p_max_depth}")
-    
-    ## Return the class and silhouette
-    return (model, silhouette)
+# DBTITLE 1,Visualize Optimal Decision Tree
+# MAGIC %python
+# MAGIC 
+# MAGIC """
+# MAGIC Visualize the optimal decision tree
+# MAGIC """
+# MAGIC 
+# MAGIC optimalDecisionTreeDepth, optimalDecisionTree = bestFullDataModel(dtcTuning)
+# MAGIC print(f"Best max depth trained on all the data: {optimalDecisionTreeDepth}")
+# MAGIC 
+# MAGIC ## truncated trees aren't spark models, print their splits instead
+# MAGIC if isinstance(optimalDecisionTree, DecisionTreeTruncatedModel):
+# MAGIC   print(optimalDecisionTree.toDebugString)
+# MAGIC else:
+# MAGIC   display(optimalDecisionTree)
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### XGBoost Training Function
+# MAGIC 
+# MAGIC ## Fine-Grained Training
+# MAGIC 
+# MAGIC Besides the global models, one clustering and one classifier are trained per warehouse and/or order type. Every group is trained, evaluated and summarized independently with its own seed derived from the group key. The groups run in parallel on the executors with `applyInPandas`, or in a process pool on the driver when the data is small. A failing group is reported with its error and does not stop the others. The models are stored per group in `carparts_group_models`, and the run logs the number of series trained per minute.
 
 # COMMAND ----------
 
-# DBTITLE 1,XGBoost Training Function
+# DBTITLE 1,Grouped Model Training
 # MAGIC %python
 # MAGIC 
+# MAGIC from concurrent.futures import ProcessPoolExecutor
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.types import BinaryType, DoubleType, IntegerType, LongType, StringType, StructField, StructType
+# MAGIC from sklearn.cluster import BisectingKMeans
+# MAGIC from sklearn.metrics import f1_score, silhouette_score
+# MAGIC from sklearn.model_selection import train_test_split
+# MAGIC from sklearn.tree import DecisionTreeClassifier
+# MAGIC from typing import List, Tuple
+# MAGIC import mlflow
+# MAGIC import numpy as np
+# MAGIC import pandas as pd
+# MAGIC import pickle
+# MAGIC import time
+# MAGIC import zlib
+# MAGIC 
 # MAGIC """
-# MAGIC XGBoost Trainer
+# MAGIC   Train a clustering and a classifier per warehouse and/or order type
 # MAGIC """
 # MAGIC 
-# MAGIC import mlflow
-# MAGIC from sparkxgb import XGBoostClassifier
-# MAGIC from pyspark.ml.evaluation import MulticlassClassificationEvaluator
-# MAGIC from pyspark.sql import DataFrame
-# MAGIC from typing import Tuple
-# MAGIC 
-# MAGIC def xgbTrain(p_max_depth : int,
-# MAGIC              training_data : DataFrame,
-# MAGIC              test_data : DataFrame,
-# MAGIC              seed : int,
-# MAGIC              featuresCol : str,
-# MAGIC              labelCol : str) -> Tuple[int, float]:
-# MAGIC   with mlflow.start_run() as run:
-# MAGIC     # log some parameters
-# MAGIC     mlflow.log_param("Maximum_depth", p_max_depth)
-# MAGIC     mlflow.log_metric("Training Data Rows", training_data.count())
-# MAGIC     mlflow.log_metric("Test Data Rows", test_data.count())
+# MAGIC groupNumericFeatures = ["Count_Of_Order_Number", "Year", "Week_Number", "Days_Until_IRS_Refund", "Days_Until_Stimulus_check"]
+# MAGIC groupCategoricalFeatures = ["WH_ID", "Order_Type"] ## encoded per group when they are not grouped on
+# MAGIC 
+# MAGIC groupResultFields = [StructField("seed", LongType()),
+# MAGIC                      StructField("rows", LongType()),
+# MAGIC                      StructField("status", StringType()),
+# MAGIC                      StructField("error", StringType()),
+# MAGIC                      StructField("k", IntegerType()),
+# MAGIC                      StructField("silhouette", DoubleType()),
+# MAGIC                      StructField("f1", DoubleType()),
+# MAGIC                      StructField("seconds", DoubleType()),
+# MAGIC                      StructField("model", BinaryType())]
+# MAGIC 
+# MAGIC def groupSeed(key : Tuple,
+# MAGIC               seed : int) -> int:
+# MAGIC   """
+# MAGIC     @return Seed of a group, stable across runs and executors
 # MAGIC     
-# MAGIC     # start the decision tree classifier
-# MAGIC     dtc = XGBoostClassifier()\
-# MAGIC               .setFeaturesCol(featuresCol)\
-# MAGIC               .setLabelCol(labelCol)\
-# MAGIC               .setMaxDepth(10)\
-# MAGIC               .setSeed(1)\
-# MAGIC               .setPredictionCol("predictions")
+# MAGIC     @param key           | values of the group columns
+# MAGIC     @param seed          | seed of the whole run
+# MAGIC   """
+# MAGIC   
+# MAGIC   return (zlib.crc32("|".join(map(str, key)).encode()) + seed) % (2 ** 31 - 1)
+# MAGIC 
+# MAGIC def trainGroup(key : Tuple,
+# MAGIC                rows : pd.DataFrame,
+# MAGIC                keys : List[str],
+# MAGIC                seed : int,
+# MAGIC                centroids : range = range(2, 8),
+# MAGIC                maxDepth : int = 5,
+# MAGIC                minRows : int = 50,
+# MAGIC                silhouetteSamples : int = 2000) -> pd.DataFrame:
+# MAGIC   """
+# MAGIC     Cluster the rows of one group, pick k on the silhouette and fit a decision tree on the clusters
 # MAGIC     
-# MAGIC     # Start up the evaluator
-# MAGIC     evaluator = MulticlassClassificationEvaluator()\
-# MAGIC                       .setLabelCol("cluster")\
-# MAGIC                       .setPredictionCol("predictions")
-# MAGIC 
-# MAGIC     # Train a model
-# MAGIC     model = dtc.fit(training_data)
-# MAGIC 
-# MAGIC     # Make some predictions
-# MAGIC     predictions = model.transform(test_data)
+# MAGIC     @return pandas DataFrame with a single row: the group, its seed, metrics, status and the pickled models
+# MAGIC     
+# MAGIC     @param key               | values of the group columns
+# MAGIC     @param rows              | carparts rows of the group
+# MAGIC     @param keys              | group columns
+# MAGIC     @param seed              | seed of the whole run
+# MAGIC     @param centroids         | candidate numbers of clusters
+# MAGIC     @param maxDepth          | depth of the decision tree
+# MAGIC     @param minRows           | smallest group worth training
+# MAGIC     @param silhouetteSamples | rows sampled for the silhouette
+# MAGIC   """
+# MAGIC   
+# MAGIC   start = time.time()
+# MAGIC   groupSeedValue = groupSeed(key, seed)
+# MAGIC   result = {**dict(zip(keys, key)),
+# MAGIC             "seed" : groupSeedValue, "rows" : len(rows), "status" : "ok", "error" : None,
+# MAGIC             "k" : None, "silhouette" : None, "f1" : None, "model" : None}
+# MAGIC   
+# MAGIC   ## a failing group is reported, the other groups carry on
+# MAGIC   try:
+# MAGIC     if len(rows) < minRows:
+# MAGIC       raise ValueError(f"{len(rows)} rows, fewer than {minRows}")
+# MAGIC     
+# MAGIC     categorical = [c for c in groupCategoricalFeatures if c not in keys]
+# MAGIC     categories = {c : sorted(rows[c].astype(str).unique()) for c in categorical}
+# MAGIC     features = np.column_stack([rows[c].to_numpy(dtype = np.float64) for c in groupNumericFeatures]
+# MAGIC                                + [pd.Categorical(rows[c].astype(str), categories = categories[c]).codes.astype(np.float64) for c in categorical])
+# MAGIC     
+# MAGIC     best = None
+# MAGIC     for k in centroids:
+# MAGIC       if k >= len(rows):
+# MAGIC         break
+# MAGIC       clusters = BisectingKMeans(n_clusters = k, random_state = groupSeedValue).fit(features)
+# MAGIC       if len(np.unique(clusters.labels_)) < 2:
+# MAGIC         continue
+# MAGIC       silhouette = silhouette_score(features, clusters.labels_,
+# MAGIC                                     sample_size = min(len(rows), silhouetteSamples),
+# MAGIC                                     random_state = groupSeedValue)
+# MAGIC       if best is None or silhouette > best[1]:
+# MAGIC         best = (k, silhouette, clusters)
+# MAGIC     
+# MAGIC     if best is None:
+# MAGIC       raise ValueError("no clustering with at least two clusters")
+# MAGIC     
+# MAGIC     k, silhouette, clusters = best
+# MAGIC     trainX, testX, trainY, testY = train_test_split(features, clusters.labels_, test_size = 0.3, random_state = groupSeedValue)
+# MAGIC     classifier = DecisionTreeClassifier(max_depth = maxDepth, random_state = groupSeedValue).fit(trainX, trainY)
+# MAGIC     
+# MAGIC     result.update({"k" : k,
+# MAGIC                    "silhouette" : float(silhouette),
+# MAGIC                    "f1" : float(f1_score(testY, classifier.predict(testX), average = "weighted")),
+# MAGIC                    "model" : pickle.dumps({"features" : groupNumericFeatures + categorical,
+# MAGIC                                            "categories" : categories,
+# MAGIC                                            "clusters" : clusters,
+# MAGIC                                            "classifier" : classifier})})
+# MAGIC   except Exception as error:
+# MAGIC     result.update({"status" : "failed", "error" : f"{type(error).__name__}: {error}"})
+# MAGIC   
+# MAGIC   result["seconds"] = time.time() - start
+# MAGIC   return pd.DataFrame([result])
 # MAGIC 
-# MAGIC     # Evaluate the tree
-# MAGIC     silhouette = evaluator.evaluate(predictions)
+# MAGIC def trainGroups(dataset : DataFrame,
+# MAGIC                 keys : List[str],
+# MAGIC                 seed : int,
+# MAGIC                 mode : str = "spark",
+# MAGIC                 outputTable : str = "carparts_group_models",
+# MAGIC                 maxWorkers : int = 8,
+# MAGIC                 **trainArgs) -> pd.DataFrame:
+# MAGIC   """
+# MAGIC     Train every group in parallel and log the run to MLflow
 # MAGIC     
-# MAGIC     # Log the accuracy
-# MAGIC     mlflow.log_metric("F1", silhouette)
+# MAGIC     @return pandas DataFrame with the metrics and status of every group
+# MAGIC     
+# MAGIC     @param dataset       | cleaned carparts rows
+# MAGIC     @param keys          | group columns, WH_ID and/or Order_Type
+# MAGIC     @param seed          | seed of the whole run, every group derives its own
+# MAGIC     @param mode          | spark trains with applyInPandas on the executors, local with a process pool on the driver
+# MAGIC     @param outputTable   | delta table receiving the models and metrics per group
+# MAGIC     @param maxWorkers    | processes of the local mode
+# MAGIC     @param trainArgs     | forwarded to trainGroup
+# MAGIC   """
+# MAGIC   
+# MAGIC   rows = dataset.select(*dict.fromkeys(keys + groupNumericFeatures + groupCategoricalFeatures))
+# MAGIC   schema = StructType([rows.schema[k] for k in keys] + groupResultFields)
+# MAGIC   
+# MAGIC   with mlflow.start_run(run_name = "Fine-Grained Training"):
+# MAGIC     start = time.time()
+# MAGIC     
+# MAGIC     if mode == "spark":
+# MAGIC       rows.groupBy(*keys)\
+# MAGIC           .applyInPandas(lambda key, group : trainGroup(key, group, keys, seed, **trainArgs), schema)\
+# MAGIC           .write\
+# MAGIC           .format("delta")\
+# MAGIC           .mode("overwrite")\
+# MAGIC           .option("overwriteSchema", "true")\
+# MAGIC           .saveAsTable(outputTable)
+# MAGIC     else:
+# MAGIC       with ProcessPoolExecutor(max_workers = maxWorkers) as pool:
+# MAGIC         futures = [pool.submit(trainGroup, key, group, keys, seed, **trainArgs)
+# MAGIC                    for key, group in rows.toPandas().groupby(keys)]
+# MAGIC         results = pd.concat([future.result() for future in futures], ignore_index = True)
+# MAGIC       
+# MAGIC       spark.createDataFrame(results[schema.fieldNames()], schema)\
+# MAGIC            .write\
+# MAGIC            .format("delta")\
+# MAGIC            .mode("overwrite")\
+# MAGIC            .option("overwriteSchema", "true")\
+# MAGIC            .saveAsTable(outputTable)
 # MAGIC     
-# MAGIC #     # Log the feature importances
-# MAGIC #     mlflow.log_param("Feature Importances", model.featureImportances)
+# MAGIC     seconds = time.time() - start
+# MAGIC     report = spark.table(outputTable).drop("model").toPandas()
+# MAGIC     trained = int((report["status"] == "ok").sum())
 # MAGIC     
-# MAGIC     # Log the model
-# MAGIC     mlflow.spark.log_model(model, f"XGBoost_Tree{p_max_depth}")
+# MAGIC     mlflow.log_params({"Group Columns" : ",".join(keys), "Mode" : mode, "Seed" : seed})
+# MAGIC     mlflow.log_metrics({"Groups" : len(report),
+# MAGIC                         "Groups Failed" : len(report) - trained,
+# MAGIC                         "Series Per Minute" : trained / seconds * 60})
 # MAGIC     
-# MAGIC     ## Return the class and silhouette
-# MAGIC     return (model, silhouette)
-
-# COMMAND ----------
-
-# MAGIC %md
-# MAGIC ### Train the XGBoost Tree
-
-# COMMAND ----------
-
-# MAGIC %md
-# MAGIC #### Hyperparameter tuning for Max Depth
+# MAGIC     ## a mean over no trained group is no score, leave the metrics out rather than logging 0
+# MAGIC     if trained:
+# MAGIC       mlflow.log_metrics({"Mean Silhouette" : float(report["silhouette"].mean()),
+# MAGIC                           "Mean F1" : float(report["f1"].mean())})
+# MAGIC     mlflow.log_text(report.to_csv(index = False), "group_metrics.csv")
+# MAGIC   
+# MAGIC   return report
 
 # COMMAND ----------
 
+# DBTITLE 1,Train the Warehouse and Order Type Models
 # MAGIC %python
 # MAGIC 
 # MAGIC """
-# MAGIC Tune the max depth of the Boost tree
+# MAGIC Train one model per group, failures are listed with their error
 # MAGIC """
 # MAGIC 
-# MAGIC xgbTuning = [(i, xgbTrain(p_max_depth = i,
-# MAGIC                           training_data = clusteredtrainingDF,
-# MAGIC                           test_data = clusteredTestingDF,
-# MAGIC                           seed = 1,
-# MAGIC                           featuresCol = "features",
-# MAGIC                           labelCol = "cluster"))
-# MAGIC               for i in range(2, 15, 1)]
+# MAGIC groupTrainingKeys = ["WH_ID", "Order_Type"] # options: ["WH_ID"], ["Order_Type"], ["WH_ID", "Order_Type"]
+# MAGIC groupTrainingMode = "spark" # options: spark, local
 # MAGIC 
-# MAGIC ## Return the results into a series of arrays
-# MAGIC xgbF1 = [(a[0], a[1][1]) for a in xgbTuning]
+# MAGIC groupReport = trainGroups(df_cleaned, keys = groupTrainingKeys, seed = 1, mode = groupTrainingMode)
+# MAGIC 
+# MAGIC display(groupReport.sort_values("status"))
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC #### Elbow Plot
+# MAGIC 
+# MAGIC # Forecasts
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Forecast the tier/bracket a covid case will belong to
 
 # COMMAND ----------
 
-# DBTITLE 1,XGBoost Tuning
 # MAGIC %python
 # MAGIC 
 # MAGIC """
-# MAGIC   Show the efffect of increasing the max depth
-# MAGIC   for a XGBoost Tree
+# MAGIC   Label the clustered predictions 
 # MAGIC """
 # MAGIC 
-# MAGIC xgbF1DF = sc.parallelize(xgbF1)\
-# MAGIC                       .toDF()\
-# MAGIC                       .withColumnRenamed("_1", "Max Depth")\
-# MAGIC                       .withColumnRenamed("_2", "F1")
+# MAGIC # choose the best depth trained on all the training data
+# MAGIC optimalXGBDepth, optimalXGBModel = bestFullDataModel(xgbTuning)
+# MAGIC print(f"Best max depth trained on all the data: {optimalXGBDepth}")
 # MAGIC 
-# MAGIC display(xgbF1DF)
+# MAGIC # create the segmentation DF
+# MAGIC segmentationDF = optimalXGBModel.transform(testingDF)
+# MAGIC 
+# MAGIC display(segmentationDF);
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Train the Decision Tree
+# MAGIC 
+# MAGIC # Deploy Model
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC #### Hyperparameter tuning for Max Depth
+# MAGIC ## Setup a pipeline with an assembler and decision tree
 
 # COMMAND ----------
 
+# DBTITLE 1,Create Deployment Model Pipeline
 # MAGIC %python
 # MAGIC 
+# MAGIC from pyspark.ml import PipelineModel, Transformer
+# MAGIC from pyspark.ml.feature import VectorAssembler
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.types import StructType
+# MAGIC from typing import Dict, List
+# MAGIC 
 # MAGIC """
-# MAGIC Tune the max depth of the Decision tree
+# MAGIC   Combine the fitted dataframe indexer and assembler with the decision tree
 # MAGIC """
 # MAGIC 
-# MAGIC dtcTuning = [(i, dtcTrain(p_max_depth = i,
-# MAGIC                           training_data = clusteredtrainingDF,
-# MAGIC                           test_data = clusteredTestingDF,
-# MAGIC                           seed = 1,
-# MAGIC                           featuresCol = "features",
-# MAGIC                           labelCol = "cluster"))
-# MAGIC               for i in range(2, 15, 1)]
+# MAGIC def assemblePipelineModel(stages : List[Transformer],
+# MAGIC                           inputSchema : StructType) -> PipelineModel:
+# MAGIC   """
+# MAGIC     Build a PipelineModel from already fitted stages without a data pass
+# MAGIC     
+# MAGIC     @return PipelineModel running the stages in order
+# MAGIC     
+# MAGIC     @param stages        | fitted transformers in pipeline order
+# MAGIC     @param inputSchema   | schema of the data the pipeline will be applied to
+# MAGIC   """
+# MAGIC   
+# MAGIC   columns = set(inputSchema.fieldNames())
+# MAGIC   assembledSize = None
+# MAGIC   
+# MAGIC   for stage in stages:
+# MAGIC     ## every column the stage reads has to exist by the time it runs
+# MAGIC     required = []
+# MAGIC     for param in ("inputCol", "featuresCol"):
+# MAGIC       if stage.hasParam(param) and stage.isDefined(stage.getParam(param)):
+# MAGIC         required.append(stage.getOrDefault(stage.getParam(param)))
+# MAGIC     if stage.hasParam("inputCols") and stage.isDefined(stage.getParam("inputCols")):
+# MAGIC       required.extend(stage.getOrDefault(stage.getParam("inputCols")))
+# MAGIC     
+# MAGIC     missing = [c for c in required if c not in columns]
+# MAGIC     if missing:
+# MAGIC       raise ValueError(f"{type(stage).__name__} reads columns {missing} that no earlier stage or the input provides")
+# MAGIC     
+# MAGIC     ## the assembled vector has to match the number of features the model was trained on
+# MAGIC     if isinstance(stage, VectorAssembler):
+# MAGIC       assembledSize = len(stage.getInputCols())
+# MAGIC     elif assembledSize is not None and hasattr(stage, "numFeatures") and stage.hasParam("featuresCol"):
+# MAGIC       if stage.numFeatures != assembledSize:
+# MAGIC         raise ValueError(f"{type(stage).__name__} expects {stage.numFeatures} features but the assembler produces {assembledSize}")
+# MAGIC     
+# MAGIC     for param in ("outputCol", "predictionCol", "rawPredictionCol", "probabilityCol"):
+# MAGIC       if stage.hasParam(param) and stage.isDefined(stage.getParam(param)):
+# MAGIC         columns.add(stage.getOrDefault(stage.getParam(param)))
+# MAGIC     if stage.hasParam("outputCols") and stage.isDefined(stage.getParam("outputCols")):
+# MAGIC       columns.update(stage.getOrDefault(stage.getParam("outputCols")))
+# MAGIC   
+# MAGIC   return PipelineModel(stages = stages)
 # MAGIC 
-# MAGIC ## Return the results into a series of arrays
-# MAGIC dtcF1 = [(a[0], a[1][1]) for a in dtcTuning]
+# MAGIC def deploymentModelStage(clean : DataFrame,
+# MAGIC                          featurize : Dict,
+# MAGIC                          xgb_tuning : List,
+# MAGIC                          calendarFeatureMode : str) -> PipelineModel:
+# MAGIC   """
+# MAGIC     Deployment pipeline of the fitted indexer, the assembler and the best XGBoost model trained on all the data
+# MAGIC     
+# MAGIC     @return PipelineModel scoring cleaned rows
+# MAGIC     
+# MAGIC     @param clean         | cleaned dataframe the pipeline will be applied to
+# MAGIC     @param featurize     | fitted indexer and feature columns
+# MAGIC     @param xgb_tuning    | XGBoost sweep
+# MAGIC     @param calendarFeatureMode | source keeps the csv columns, computed derives them
+# MAGIC   """
+# MAGIC   
+# MAGIC   checkDeployable(calendarFeatureMode)
+# MAGIC   
+# MAGIC   ## combine the existing fitted models into a pipeline, no refit on the cleaned data
+# MAGIC   return assemblePipelineModel(stages = [featurize["indexerModel"],
+# MAGIC                                          VectorAssembler(inputCols = featurize["features"], outputCol = "features"),
+# MAGIC                                          bestFullDataModel(xgb_tuning)[1]],
+# MAGIC                                inputSchema = clean.schema)
+# MAGIC 
+# MAGIC ## the export, the registration and the forecast below all use this one pipeline
+# MAGIC stagePipeline.add(Stage("deployment_model", deploymentModelStage, ["clean", "featurize", "xgb_tuning"],
+# MAGIC                         params = {"calendarFeatureMode" : calendarFeatureMode}))
+# MAGIC 
+# MAGIC deployment_ml_pipeline_model : PipelineModel = stagePipeline.run(["deployment_model"])["deployment_model"]
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC #### Elbow Plot
+# MAGIC ## Use model to predict on an example dataframe
 
 # COMMAND ----------
 
+# DBTITLE 1,Forecast Using Deployment Model Pipeline
 # MAGIC %python
 # MAGIC 
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC 
 # MAGIC """
-# MAGIC   Show the efffect of increasing the max depth
-# MAGIC   for a Decision Tree
+# MAGIC Forecast some results on the Carparts dataset
 # MAGIC """
 # MAGIC 
-# MAGIC dtcF1DF = sc.parallelize(dtcF1)\
-# MAGIC                       .toDF()\
-# MAGIC                       .withColumnRenamed("_1", "Max Depth")\
-# MAGIC                       .withColumnRenamed("_2", "F1")
+# MAGIC # classify the raw dataframe
+# MAGIC df_deployed_pipeline_classification : DataFrame = deployment_ml_pipeline_model.transform(df_cleaned)
 # MAGIC 
-# MAGIC display(dtcF1DF)
+# MAGIC # visualize the results
+# MAGIC display(df_deployed_pipeline_classification)
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC 
-# MAGIC #### Multi-Dimensional Cross Validation
+# MAGIC ## Export a Vectorized Scoring Artifact
+# MAGIC 
+# MAGIC The deployment pipeline is exported into a compact artifact: the string indexer dictionaries, the feature order and the tree or boosted ensemble node arrays. The JVM-free scorer in `carparts.scoring` evaluates it on pandas or Arrow batches, and the export is checked against the Spark predictions.
+
+# COMMAND ----------
+
+# DBTITLE 1,Import the Vectorized Scorer
+"""
+JVM-free scoring of exported deployment pipelines, from the carparts cluster library
+"""
+
+from carparts.scoring import assembleFeatures, boostedTreesMargins, loadScoringArtifact, scoreBatch
 
 # COMMAND ----------
 
+# DBTITLE 1,Export Scoring Artifact
 # MAGIC %python
 # MAGIC 
-# MAGIC from pyspark.ml import Pipeline
-# MAGIC from pyspark.ml.tuning import CrossValidator, ParamGridBuilder
+# MAGIC from pyspark.ml import PipelineModel
+# MAGIC from pyspark.ml.classification import DecisionTreeClassificationModel
+# MAGIC from pyspark.ml.feature import StringIndexerModel, VectorAssembler
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.types import LongType, StructField, StructType
+# MAGIC import json
+# MAGIC import numpy as np
+# MAGIC import os
+# MAGIC from typing import Dict, List
 # MAGIC 
 # MAGIC """
-# MAGIC Do a cross validation of the decision tree model
+# MAGIC   Export the deployment pipeline for the vectorized scorer
+# MAGIC """
+# MAGIC 
+# MAGIC def xgboostTreeArrays(dumps : List[str]) -> Dict:
+# MAGIC   """
+# MAGIC     Flatten XGBoost JSON tree dumps into node arrays
+# MAGIC     
+# MAGIC     @return Dictionary of node arrays, tree roots and the depth of the deepest tree
+# MAGIC     
+# MAGIC     @param dumps         | JSON dump of every tree, in booster order
+# MAGIC   """
+# MAGIC   
+# MAGIC   arrays = {"feature" : [], "threshold" : [], "yes" : [], "no" : [], "missing" : [], "leaf" : [], "roots" : []}
+# MAGIC   maxDepth = 0
+# MAGIC   
+# MAGIC   for dump in dumps:
+# MAGIC     ## number the nodes of this tree after the nodes of the previous trees
+# MAGIC     nodes, stack = [], [(json.loads(dump), 0)]
+# MAGIC     while stack:
+# MAGIC       node, depth = stack.pop()
+# MAGIC       nodes.append(node)
+# MAGIC       maxDepth = max(maxDepth, depth)
+# MAGIC       stack.extend((child, depth + 1) for child in node.get("children", []))
+# MAGIC     ids = {node["nodeid"] : len(arrays["feature"]) + i for i, node in enumerate(nodes)}
+# MAGIC     arrays["roots"].append(ids[nodes[0]["nodeid"]])
+# MAGIC     
+# MAGIC     for node in nodes:
+# MAGIC       leaf = "leaf" in node
+# MAGIC       arrays["feature"].append(-1 if leaf else int(node["split"].lstrip("f")))
+# MAGIC       arrays["threshold"].append(0.0 if leaf else node["split_condition"])
+# MAGIC       arrays["yes"].append(-1 if leaf else ids[node["yes"]])
+# MAGIC       arrays["no"].append(-1 if leaf else ids[node["no"]])
+# MAGIC       arrays["missing"].append(-1 if leaf else ids[node["missing"]])
+# MAGIC       arrays["leaf"].append(node["leaf"] if leaf else 0.0)
+# MAGIC   
+# MAGIC   return {"feature" : np.array(arrays["feature"], dtype = np.int64),
+# MAGIC           "threshold" : np.array(arrays["threshold"], dtype = np.float32),
+# MAGIC           "yes" : np.array(arrays["yes"], dtype = np.int64),
+# MAGIC           "no" : np.array(arrays["no"], dtype = np.int64),
+# MAGIC           "missing" : np.array(arrays["missing"], dtype = np.int64),
+# MAGIC           "leaf" : np.array(arrays["leaf"], dtype = np.float32),
+# MAGIC           "roots" : np.array(arrays["roots"], dtype = np.int64),
+# MAGIC           "maxDepth" : maxDepth + 1}
+# MAGIC 
+# MAGIC def exportScoringArtifact(pipelineModel : PipelineModel,
+# MAGIC                           path : str,
+# MAGIC                           calibrationData : DataFrame,
+# MAGIC                           calibrationRows : int = 100) -> Dict:
+# MAGIC   """
+# MAGIC     Write the deployment pipeline into a self-contained scoring artifact
+# MAGIC     
+# MAGIC     @return Metadata of the artifact
+# MAGIC     
+# MAGIC     @param pipelineModel   | fitted StringIndexer, VectorAssembler and tree model pipeline
+# MAGIC     @param path            | local path of the .npz artifact, e.g. on /dbfs
+# MAGIC     @param calibrationData | raw rows used to read the XGBoost base margin off the Spark predictions
+# MAGIC     @param calibrationRows | number of calibration rows
+# MAGIC   """
+# MAGIC   
+# MAGIC   metadata = {"indexers" : [], "features" : None, "assemblerHandleInvalid" : "error"}
+# MAGIC   arrays = {}
+# MAGIC   
+# MAGIC   for stage in pipelineModel.stages:
+# MAGIC     if isinstance(stage, StringIndexerModel):
+# MAGIC       inputCols = stage.getInputCols() if stage.isSet("inputCols") else [stage.getInputCol()]
+# MAGIC       outputCols = stage.getOutputCols() if stage.isSet("outputCols") else [stage.getOutputCol()]
+# MAGIC       for inputCol, outputCol, labels in zip(inputCols, outputCols, stage.labelsArray):
+# MAGIC         metadata["indexers"].append({"inputCol" : inputCol,
+# MAGIC                                      "outputCol" : outputCol,
+# MAGIC                                      "handleInvalid" : stage.getHandleInvalid(),
+# MAGIC                                      "labels" : list(labels)})
+# MAGIC     elif isinstance(stage, VectorAssembler):
+# MAGIC       metadata["features"] = stage.getInputCols()
+# MAGIC       metadata["assemblerHandleInvalid"] = stage.getHandleInvalid()
+# MAGIC     else:
+# MAGIC       model = stage
+# MAGIC   
+# MAGIC   metadata["predictionCol"] = model.getPredictionCol()
+# MAGIC   
+# MAGIC   if isinstance(model, (DecisionTreeClassificationModel, DecisionTreeTruncatedModel)):
+# MAGIC     truncated = isinstance(model, DecisionTreeTruncatedModel)
+# MAGIC     nodes = model.getOrDefault(model.nodes) if truncated else decisionTreeNodes(model)
+# MAGIC     categoryCount = max([max(c) + 1 for c in nodes["leftCategories"] if c] + [1])
+# MAGIC     goesLeft = np.zeros((len(nodes["feature"]), categoryCount), dtype = bool)
+# MAGIC     for index, categories in enumerate(nodes["leftCategories"]):
+# MAGIC       goesLeft[index, categories] = True
+# MAGIC     
+# MAGIC     metadata["model"] = "decision_tree"
+# MAGIC     metadata["maxDepth"] = model.getOrDefault(model.maxDepth) if truncated else model.depth
+# MAGIC     arrays = {"feature" : np.array(nodes["feature"], dtype = np.int64),
+# MAGIC               "threshold" : np.array(nodes["threshold"], dtype = np.float64),
+# MAGIC               "categorical" : np.array(nodes["categorical"], dtype = bool),
+# MAGIC               "goesLeft" : goesLeft,
+# MAGIC               "left" : np.array(nodes["left"], dtype = np.int64),
+# MAGIC               "right" : np.array(nodes["right"], dtype = np.int64),
+# MAGIC               "prediction" : np.array(nodes["prediction"], dtype = np.float64)}
+# MAGIC   else:
+# MAGIC     ## XGBoost, read the trees off the native booster
+# MAGIC     trees = xgboostTreeArrays(list(model._java_obj.nativeBooster().getModelDump(None, False, "json")))
+# MAGIC     numClasses = model._java_obj.numClasses()
+# MAGIC     
+# MAGIC     metadata["model"] = "xgboost"
+# MAGIC     metadata["maxDepth"] = trees.pop("maxDepth")
+# MAGIC     metadata["numGroups"] = numClasses if numClasses > 2 else 1
+# MAGIC     metadata["baseMargin"] = [0.0] * metadata["numGroups"]
+# MAGIC     arrays = trees
+# MAGIC   
+# MAGIC   os.makedirs(os.path.dirname(path), exist_ok = True)
+# MAGIC   np.savez_compressed(path, metadata = np.array(json.dumps(metadata)), **arrays)
+# MAGIC   
+# MAGIC   if metadata["model"] == "xgboost":
+# MAGIC     ## the base margin of every class isn't in the tree dumps, read it off the spark margins
+# MAGIC     ## collect one sample and score exactly those rows, limit isn't deterministic between two evaluations
+# MAGIC     sample = calibrationData.limit(calibrationRows).toPandas()
+# MAGIC     numbered = spark.createDataFrame(sample.assign(calibration_row = np.arange(len(sample))),
+# MAGIC                                      StructType(calibrationData.schema.fields + [StructField("calibration_row", LongType())]))
+# MAGIC     scored = pipelineModel.transform(numbered)\
+# MAGIC                           .select("calibration_row", "rawPrediction")\
+# MAGIC                           .toPandas()\
+# MAGIC                           .sort_values("calibration_row")
+# MAGIC     if not np.array_equal(scored["calibration_row"].to_numpy(), np.arange(len(sample))):
+# MAGIC       raise ValueError("The deployment pipeline dropped calibration rows")
+# MAGIC     rawPredictions = np.array([v.toArray() for v in scored["rawPrediction"]])
+# MAGIC     leafSums = boostedTreesMargins(loadScoringArtifact(path), assembleFeatures(loadScoringArtifact(path), sample))
+# MAGIC     sparkMargins = rawPredictions[:, 1:2] if metadata["numGroups"] == 1 else rawPredictions
+# MAGIC     metadata["baseMargin"] = np.median(sparkMargins - leafSums, axis = 0).tolist()
+# MAGIC     np.savez_compressed(path, metadata = np.array(json.dumps(metadata)), **arrays)
+# MAGIC   
+# MAGIC   return metadata
+# MAGIC 
+# MAGIC def verifyScoringArtifact(pipelineModel : PipelineModel,
+# MAGIC                           path : str,
+# MAGIC                           data : DataFrame,
+# MAGIC                           keyCol : str = "ID",
+# MAGIC                           rows : int = 10000) -> Dict:
+# MAGIC   """
+# MAGIC     Compare the vectorized scorer with the Spark pipeline
+# MAGIC     
+# MAGIC     @return Number of compared rows and prediction mismatches
+# MAGIC     
+# MAGIC     @param pipelineModel | fitted deployment pipeline
+# MAGIC     @param path          | path of the .npz artifact
+# MAGIC     @param data          | raw rows to score
+# MAGIC     @param keyCol        | column identifying every row
+# MAGIC     @param rows          | number of rows to compare
+# MAGIC   """
+# MAGIC   
+# MAGIC   sample = data.limit(rows).cache()
+# MAGIC   artifact = loadScoringArtifact(path)
+# MAGIC   predictionCol = artifact["metadata"]["predictionCol"]
+# MAGIC   
+# MAGIC   sparkPredictions = pipelineModel.transform(sample).select(keyCol, predictionCol).toPandas()
+# MAGIC   raw = sample.toPandas()
+# MAGIC   localPredictions = scoreBatch(artifact, raw)
+# MAGIC   localPredictions[keyCol] = raw.loc[localPredictions.index, keyCol]
+# MAGIC   sample.unpersist()
+# MAGIC   
+# MAGIC   compared = sparkPredictions.merge(localPredictions[[keyCol, predictionCol]], on = keyCol, suffixes = ("_spark", "_local"))
+# MAGIC   mismatches = int((compared[f"{predictionCol}_spark"] != compared[f"{predictionCol}_local"]).sum())
+# MAGIC   
+# MAGIC   return {"rows" : len(compared), "mismatches" : mismatches}
+
+# COMMAND ----------
+
+# DBTITLE 1,Export and Verify the Deployment Model
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.ml import PipelineModel
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from typing import Dict
+# MAGIC import os
+# MAGIC 
+# MAGIC """
+# MAGIC   Export the deployment pipeline and check it against spark
 # MAGIC """
 # MAGIC 
-# MAGIC # Set the decision tree that will be optimized
-# MAGIC dt = DecisionTreeClassifier()\
-# MAGIC             .setFeaturesCol("features")\
-# MAGIC             .setLabelCol("cluster")\
-# MAGIC             .setMaxDepth(5)\
-# MAGIC             .setSeed(1)\
-# MAGIC             .setPredictionCol("predictions")\
-# MAGIC             .setMaxBins(4000)
+# MAGIC scoring_artifact_path = "/dbfs/tmp/carparts_scoring/deployment_pipeline.npz"
 # MAGIC 
-# MAGIC # Build the grid of different parameters
-# MAGIC paramGrid = ParamGridBuilder() \
-# MAGIC     .addGrid(dt.maxDepth, [5, 10, 15]) \
-# MAGIC     .addGrid(dt.maxBins, [4000, 5000, 6000]) \
-# MAGIC     .build()
+# MAGIC def deployStage(clean : DataFrame,
+# MAGIC                 deployment_model : PipelineModel,
+# MAGIC                 path : str) -> Dict:
+# MAGIC   """
+# MAGIC     Export the deployment pipeline and check it against spark
+# MAGIC     
+# MAGIC     @return Dictionary with the artifact metadata, the parity check, the artifact bytes and the verified pipeline model
+# MAGIC     
+# MAGIC     @param clean            | cleaned dataframe, the calibration and parity data
+# MAGIC     @param deployment_model | deployment pipeline model
+# MAGIC     @param path             | where the artifact is exported
+# MAGIC   """
+# MAGIC   
+# MAGIC   metadata = exportScoringArtifact(pipelineModel = deployment_model,
+# MAGIC                                    path = path,
+# MAGIC                                    calibrationData = clean)
+# MAGIC   
+# MAGIC   parity = verifyScoringArtifact(deployment_model, path, clean)
+# MAGIC   if parity["mismatches"]:
+# MAGIC     raise RuntimeError(f"The vectorized scorer disagrees with the spark pipeline on {parity['mismatches']} of {parity['rows']} rows")
+# MAGIC   
+# MAGIC   with open(path, "rb") as artifact:
+# MAGIC     return {"metadata" : metadata, "parity" : parity, "artifact" : artifact.read(), "pipelineModel" : deployment_model}
 # MAGIC 
-# MAGIC # Generate an average F1 score for each prediction
-# MAGIC evaluator = MulticlassClassificationEvaluator()\
-# MAGIC                   .setLabelCol("cluster")\
-# MAGIC                   .setPredictionCol("predictions")
+# MAGIC stagePipeline.add(Stage("deploy", deployStage, ["clean", "deployment_model"], params = {"path" : scoring_artifact_path}))
 # MAGIC 
-# MAGIC # Build out the cross validation
-# MAGIC crossval = CrossValidator(estimator = dt,
-# MAGIC                           estimatorParamMaps = paramGrid,
-# MAGIC                           evaluator = evaluator,
-# MAGIC                           numFolds = 3)  
-# MAGIC pipelineCV = Pipeline(stages=[crossval])
+# MAGIC deployment = stagePipeline.run(["deploy"])["deploy"]
+# MAGIC scoring_artifact_metadata, scoring_parity = deployment["metadata"], deployment["parity"]
+# MAGIC print(scoring_parity)
 # MAGIC 
-# MAGIC # Train the model using the pipeline, parameter grid, and preceding BinaryClassificationEvaluator
-# MAGIC cvModel_u = pipelineCV.fit(clusteredtrainingDF)
+# MAGIC ## a stored result restores the artifact the stage exported
+# MAGIC os.makedirs(os.path.dirname(scoring_artifact_path), exist_ok = True)
+# MAGIC with open(scoring_artifact_path, "wb") as artifact:
+# MAGIC   artifact.write(deployment["artifact"])
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC 
-# MAGIC ## Visualize the Optimal Decision Tree
+# MAGIC ### Release the Materialized Dataframes
 
 # COMMAND ----------
 
-# DBTITLE 1,Visualize Optimal Decision Tree
+# DBTITLE 1,Cached Dataframe Memory Usage
 # MAGIC %python
 # MAGIC 
 # MAGIC """
-# MAGIC Visualize the optimal decision tree
+# MAGIC   Report the storage used by the materialized dataframes
 # MAGIC """
 # MAGIC 
-# MAGIC display(dtcTuning[5][1][0])
+# MAGIC materializedViews = ["ml_dataset", "training_df", "testing_df", "clustered_training_df", "clustered_testing_df"]
+# MAGIC 
+# MAGIC display(materializedFramesReport(materializedViews))
 
 # COMMAND ----------
 
-# MAGIC %md
+# DBTITLE 1,Unpersist Materialized Dataframes
+# MAGIC %python
 # MAGIC 
-# MAGIC # Forecasts
+# MAGIC """
+# MAGIC   The forecast and the deployment export were the last to read the split, free the cached dataframes
+# MAGIC """
+# MAGIC 
+# MAGIC releaseFrames(materializedViews)
+# MAGIC releaseBinnedFeatures()
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ## Forecast the tier/bracket a covid case will belong to
+# MAGIC 
+# MAGIC ## Bulk Scoring
+# MAGIC 
+# MAGIC `bulkScore` runs the exported scoring artifact over the current version of the feature table with `mapInPandas`, so the rows aren't cleaned and indexed again. The executors score Arrow record batches of `batchSize` rows, and the predictions are written straight to a partitioned Delta table without going through the driver. The segmentation table has the same columns as the `carparts_segmentation_stream` sink: the order keys, the prediction, the probability for models that have one, and `segmented_time`. The returned report gives rows per second per executor core, so a nightly re-segmentation of the full history can be sized against the cluster.
 
 # COMMAND ----------
 
+# DBTITLE 1,Bulk Scoring
 # MAGIC %python
 # MAGIC 
+# MAGIC from pyspark.sql import DataFrame
+# MAGIC from pyspark.sql.functions import current_timestamp
+# MAGIC from pyspark.sql.types import ArrayType, DoubleType, StructField, StructType
+# MAGIC from delta.tables import DeltaTable
+# MAGIC from typing import Dict, Iterator, List
+# MAGIC import pandas as pd
+# MAGIC import time
+# MAGIC 
 # MAGIC """
-# MAGIC   Label the clustered predictions 
+# MAGIC   Distributed scoring of Arrow record batches with the vectorized scorer
 # MAGIC """
 # MAGIC 
-# MAGIC # choose the third decision tree model
-# MAGIC optimalXGBModel = xgbTuning[5][1][0]
+# MAGIC ## collect to pandas through arrow as well
+# MAGIC spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
 # MAGIC 
-# MAGIC # create the segmentation DF
-# MAGIC segmentationDF = optimalXGBModel.transform(testingDF)
+# MAGIC def bulkScore(featureVersion : Dict,
+# MAGIC               artifactPath : str,
+# MAGIC               outputTable : str,
+# MAGIC               keyCols : List[str] = ["ID", "Date", "WH_ID", "Order_Type", "Year"],
+# MAGIC               partitionCols : List[str] = ["Year"],
+# MAGIC               batchSize : int = 10000) -> Dict:
+# MAGIC   """
+# MAGIC     Score the feature table on the executors and write the predictions to a partitioned Delta table
 # MAGIC 
-# MAGIC display(segmentationDF);
+# MAGIC     @return Dictionary with the scored rows, seconds, executor cores and rows per second per core
+# MAGIC 
+# MAGIC     @param featureVersion | result of writeFeatureTable
+# MAGIC     @param artifactPath  | path of the .npz artifact written by exportScoringArtifact
+# MAGIC     @param outputTable   | delta table receiving the predictions, overwritten
+# MAGIC     @param keyCols       | feature table columns copied next to the predictions, the stream sink keys by default
+# MAGIC     @param partitionCols | feature table columns partitioning the output table
+# MAGIC     @param batchSize     | rows per arrow record batch handed to the scorer
+# MAGIC   """
+# MAGIC 
+# MAGIC   ## ship the node arrays once per executor instead of reading the artifact in every task
+# MAGIC   artifact = loadScoringArtifact(artifactPath)
+# MAGIC   broadcastArtifact = spark.sparkContext.broadcast(artifact)
+# MAGIC 
+# MAGIC   metadata = artifact["metadata"]
+# MAGIC   predictionCol = metadata["predictionCol"]
+# MAGIC   
+# MAGIC   ## the stored indices are only valid for the encoder the artifact was exported with
+# MAGIC   encoder = {"indexer" : {indexer["outputCol"] : indexer["labels"] for indexer in metadata["indexers"]}, "features" : metadata["features"]}
+# MAGIC   if encoderFingerprint(encoder) != featureVersion["encoder"]:
+# MAGIC     raise ValueError(f"{artifactPath} wasn't exported with the encoder of feature table version {featureVersion}")
+# MAGIC   
+# MAGIC   dataset = readFeatureTable(featureVersion, [c for c in dict.fromkeys(metadata["features"] + keyCols + partitionCols) if c != "ID"])
+# MAGIC   passThrough = list(dict.fromkeys(c for c in keyCols + partitionCols if c in dataset.columns))
+# MAGIC 
+# MAGIC   outputFields = [dataset.schema[c] for c in passThrough] + [StructField(predictionCol, DoubleType())]
+# MAGIC   if metadata["model"] != "decision_tree":
+# MAGIC     outputFields.append(StructField("probability", ArrayType(DoubleType())))
+# MAGIC   outputSchema = StructType(outputFields)
+# MAGIC 
+# MAGIC   def scorePartition(batches : Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+# MAGIC     scoringArtifact = broadcastArtifact.value
+# MAGIC     for batch in batches:
+# MAGIC       scored = scoreBatch(scoringArtifact, batch, indexed = True)
+# MAGIC       yield pd.concat([batch.loc[scored.index, passThrough], scored], axis = 1)[outputSchema.fieldNames()]
+# MAGIC 
+# MAGIC   previousBatchSize = spark.conf.get("spark.sql.execution.arrow.maxRecordsPerBatch")
+# MAGIC   spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", str(batchSize))
+# MAGIC 
+# MAGIC   try:
+# MAGIC     start = time.time()
+# MAGIC     dataset.mapInPandas(scorePartition, outputSchema)\
+# MAGIC            .withColumn("segmented_time", current_timestamp())\
+# MAGIC            .write\
+# MAGIC            .format("delta")\
+# MAGIC            .mode("overwrite")\
+# MAGIC            .option("overwriteSchema", "true")\
+# MAGIC            .partitionBy(*partitionCols)\
+# MAGIC            .saveAsTable(outputTable)
+# MAGIC     seconds = time.time() - start
+# MAGIC   finally:
+# MAGIC     spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", previousBatchSize)
+# MAGIC     broadcastArtifact.unpersist()
+# MAGIC 
+# MAGIC   ## the write already counted the rows
+# MAGIC   rows = int(DeltaTable.forName(spark, outputTable).history(1).first()["operationMetrics"]["numOutputRows"])
+# MAGIC   cores = spark.sparkContext.defaultParallelism
+# MAGIC 
+# MAGIC   return {"table" : outputTable,
+# MAGIC           "rows" : rows,
+# MAGIC           "seconds" : seconds,
+# MAGIC           "cores" : cores,
+# MAGIC           "batch_size" : batchSize,
+# MAGIC           "rows_per_second" : rows / seconds,
+# MAGIC           "rows_per_second_per_core" : rows / seconds / cores}
 
 # COMMAND ----------
 
-# MAGIC %md
+# DBTITLE 1,Re-Segment the Full History
+# MAGIC %python
 # MAGIC 
-# MAGIC # Deploy Model
+# MAGIC """
+# MAGIC   Score every cleaned order into the segmentation table
+# MAGIC """
+# MAGIC 
+# MAGIC segmentation_table = "carparts_segmentation"
+# MAGIC 
+# MAGIC bulk_scoring_report = bulkScore(featureVersion = featureVersion,
+# MAGIC                                 artifactPath = scoring_artifact_path,
+# MAGIC                                 outputTable = segmentation_table,
+# MAGIC                                 partitionCols = ["Year"],
+# MAGIC                                 batchSize = 10000)
+# MAGIC print(bulk_scoring_report)
+# MAGIC 
+# MAGIC display(spark.table(segmentation_table))
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ## Setup a pipeline with an assembler and decision tree
+# MAGIC 
+# MAGIC ## Register the model with MLFlow registry
 
 # COMMAND ----------
 
-# DBTITLE 1,Create Deployment Model Pipeline
+# DBTITLE 1,Register Deployment Model with MLFlow
 # MAGIC %python
 # MAGIC 
-# MAGIC from pyspark.ml import Pipeline, PipelineModel
+# MAGIC import mlflow
+# MAGIC from mlflow.models import ModelSignature
+# MAGIC from typing import Dict
 # MAGIC 
 # MAGIC """
-# MAGIC   Combine the dataframe indexer and assembler with the decision tree
+# MAGIC Log the mlflow model to the registry
 # MAGIC """
 # MAGIC 
-# MAGIC # Combine the existing models into a pipeline
-# MAGIC deployment_ml_pipeline : Pipeline = Pipeline(stages = [indexer, assembler, optimalXGBModel])
+# MAGIC model_version_major = 1
+# MAGIC model_version_minor = 1
+# MAGIC 
+# MAGIC def registerStage(clean : DataFrame,
+# MAGIC                   deploy : Dict,
+# MAGIC                   model_version_major : int,
+# MAGIC                   model_version_minor : int) -> Dict:
+# MAGIC   """
+# MAGIC     Register the verified deployment pipeline, an unchanged pipeline is not registered again
+# MAGIC     
+# MAGIC     @return Dictionary with the run id and model uri of the registered model
+# MAGIC     
+# MAGIC     @param clean               | cleaned dataframe, the signature input
+# MAGIC     @param deploy              | verified export of the deployment pipeline
+# MAGIC     @param model_version_major | major version of the artifact path
+# MAGIC     @param model_version_minor | minor version of the artifact path
+# MAGIC   """
+# MAGIC   
+# MAGIC   pipelineModel = deploy["pipelineModel"]
+# MAGIC   
+# MAGIC   with mlflow.start_run() as run:
+# MAGIC     # get the dataframe signature for the model
+# MAGIC     _signature = mlflow.models.infer_signature(clean\
+# MAGIC                                                 .drop("ingested_time")\
+# MAGIC                                                 .drop("date")\
+# MAGIC                                                 .drop("date_2"),
+# MAGIC                                               pipelineModel.transform(clean)\
+# MAGIC                                                 .drop("features")\
+# MAGIC                                                 .drop("ingested_time")\
+# MAGIC                                                 .drop("date")\
+# MAGIC                                                 .drop("date_2")\
+# MAGIC                                                 .drop("probability")\
+# MAGIC                                                 .drop("rawPrediction"))
+# MAGIC     # Log the model
+# MAGIC     modelInfo = mlflow.spark.log_model(spark_model = pipelineModel,
+# MAGIC                                        signature = _signature,
+# MAGIC                                        registered_model_name = "carparts_demo",
+# MAGIC                                        artifact_path = f"pipeline_model_v{model_version_major}.{model_version_minor}"
+# MAGIC                                       )
+# MAGIC   
+# MAGIC   return {"run_id" : run.info.run_id, "model_uri" : modelInfo.model_uri}
+# MAGIC 
+# MAGIC stagePipeline.add(Stage("register", registerStage, ["clean", "deploy"],
+# MAGIC                         params = {"model_version_major" : model_version_major, "model_version_minor" : model_version_minor}))
 # MAGIC 
-# MAGIC # Create the pipeline transformer for the model by combining existing transformers
-# MAGIC deployment_ml_pipeline_model : PipelineModel = deployment_ml_pipeline.fit(df_cleaned)
+# MAGIC print(stagePipeline.run(["register"])["register"])
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ## Use model to predict on an example dataframe
+# MAGIC 
+# MAGIC ## Stage Report
+# MAGIC 
+# MAGIC Every stage the notebook touched with its status, `ran`, `hit` for a stored result, `memory` for an output already computed in this session or `skipped` when nothing needed it, its start offset and seconds. The report is written as JSON and CSV to `pipelineStore/reports`.
 
 # COMMAND ----------
 
-# DBTITLE 1,Forecast Using Deployment Model Pipeline
+# DBTITLE 1,Stage Report
 # MAGIC %python
 # MAGIC 
-# MAGIC from pyspark.sql import DataFrame
-# MAGIC 
 # MAGIC """
-# MAGIC Forecast some results on the Carparts dataset
+# MAGIC   Write the per-stage timings and cache hits of this run
 # MAGIC """
 # MAGIC 
-# MAGIC # classify the raw dataframe
-# MAGIC df_deployed_pipeline_classification : DataFrame = deployment_ml_pipeline_model.transform(df_cleaned)
+# MAGIC stageReport = stagePipeline.writeReport()
+# MAGIC print(stageReport["totals"])
 # MAGIC 
-# MAGIC # visualize the results
-# MAGIC display(df_deployed_pipeline_classification)
+# MAGIC display(pd.DataFrame(stageReport["stages"]))
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC 
-# MAGIC ## Register the model with MLFlow registry
+# MAGIC ## Stream New Orders
+# MAGIC 
+# MAGIC New order files are segmented as they arrive instead of re-running the batch transform after every ingest. `carparts.streaming` watches the CSV landing directory, or reads `carparts_data` as a stream source. It applies the cleaning filter and the registered deployment pipeline to every micro-batch and upserts the predictions into a Delta sink keyed on `ID`, with a checkpoint per source. The notebook catches up on the files that have arrived and stops; a stream on a processing time interval runs as its own job. `localSegmentationCheck` exercises the same stream with local pyspark against a local CSV directory.
 
 # COMMAND ----------
 
-# DBTITLE 1,Register Deployment Model with MLFlow
+# DBTITLE 1,Import the Streaming Segmentation
+"""
+Structured streaming segmentation of new orders, from the carparts cluster library
+"""
+
+from carparts.streaming import localSegmentationCheck, segmentationStream
+
+# COMMAND ----------
+
+# DBTITLE 1,Start Streaming Segmentation
 # MAGIC %python
 # MAGIC 
-# MAGIC import mlflow
-# MAGIC from mlflow.models import ModelSignature
-# MAGIC 
 # MAGIC """
-# MAGIC Log the mlflow model to the registry
+# MAGIC Segment new orders from the landing directory or the carparts_data table
 # MAGIC """
 # MAGIC 
-# MAGIC model_version_major = 1
-# MAGIC model_version_minor = 1
+# MAGIC streamingSource = "landing" # options: landing, delta
+# MAGIC streamingTrigger = "availableNow" # availableNow to catch up and stop, a processing time interval only in a separate streaming job
+# MAGIC streamingMaxFiles = 10
 # MAGIC 
-# MAGIC with mlflow.start_run() as run:
-# MAGIC   # get the dataframe signature for the model
-# MAGIC   _signature = mlflow.models.infer_signature(df_cleaned\
-# MAGIC                                               .drop("ingested_time")\
-# MAGIC                                               .drop("date")\
-# MAGIC                                               .drop("date_2"),
-# MAGIC                                             df_deployed_pipeline_classification\
-# MAGIC                                               .drop("features")\
-# MAGIC                                               .drop("ingested_time")\
-# MAGIC                                               .drop("date")\
-# MAGIC                                               .drop("date_2")\
-# MAGIC                                               .drop("probability")\
-# MAGIC                                               .drop("rawPrediction"))
-# MAGIC   # Log the model
-# MAGIC   mlflow.spark.log_model(spark_model = deployment_ml_pipeline_model,
-# MAGIC                          signature = _signature,
-# MAGIC                          registered_model_name = "carparts_demo",
-# MAGIC                          artifact_path = f"pipeline_model_v{model_version_major}.{model_version_minor}"
-# MAGIC                         )
+# MAGIC segmentation_stream = segmentationStream(source = "dbfs:/tmp/data/" if streamingSource == "landing" else "carparts_data",
+# MAGIC                                          sourceFormat = "csv" if streamingSource == "landing" else "delta",
+# MAGIC                                          sink = "carparts_segmentation_stream",
+# MAGIC                                          checkpointLocation = f"dbfs:/tmp/carparts_streaming/checkpoints/segmentation_{streamingSource}",
+# MAGIC                                          modelUri = "models:/carparts_demo/latest",
+# MAGIC                                          trigger = streamingTrigger,
+# MAGIC                                          maxFilesPerTrigger = streamingMaxFiles)
+# MAGIC 
+# MAGIC ## a processing time stream never stops, don't leave one running behind Run All
+# MAGIC if streamingTrigger == "availableNow":
+# MAGIC   segmentation_stream.awaitTermination()
 
 # COMMAND ----------
 
@@ -1035,27 +4275,65 @@ pd.read_json(json_records, orient = 'split')
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Serve the model locally
+# MAGIC 
+# MAGIC `carparts.serving` loads the model once and coalesces concurrent requests into micro-batches scored in one call. It serves either the vectorized scoring artifact or the registered `carparts_demo` model, and can also run as its own process (`carparts serve --artifact <path>`).
+
+# COMMAND ----------
+
+# DBTITLE 1,Import the Model Server
+"""
+Micro-batching model server and its client, from the carparts cluster library
+"""
+
+from carparts.serving import artifactScorer, payloadBenchmark, registeredModelScorer, score_model, startServer
+
+# COMMAND ----------
+
+# DBTITLE 1,Start the Micro-Batching Server
+"""
+Serve the deployment model from a background thread of the notebook
+"""
+
+servingModel = "artifact" # options: artifact, registered
+servingPort = 5001
+
+stop_model_server = startServer(artifactScorer(scoring_artifact_path) if servingModel == "artifact" else registeredModelScorer("models:/carparts_demo/latest"),
+                                port = servingPort,
+                                maxBatchSize = 4096,
+                                maxLatency = 0.005)
+
+# COMMAND ----------
+
 # DBTITLE 1,Access Deployed Model using Python API
 # MAGIC %python
 # MAGIC 
-# MAGIC import os
-# MAGIC import requests
-# MAGIC import pandas as pd
-# MAGIC 
 # MAGIC """
-# MAGIC Example scoring model from MLFlow UI
-# MAGIC Need to specify bearer token to connect to current MLFlow deployment
+# MAGIC Score batches concurrently over pooled keep-alive connections
+# MAGIC Batches travel as Arrow IPC streams, endpoints that only accept json get the json "split" payload
+# MAGIC A remote MLFlow deployment also needs its url and bearer token, e.g.
+# MAGIC   score_model(frames, url = ".../invocations", headers = {'Authorization': f'Bearer {dbutils.secrets.get("ml-ml", "TOKEN")}'}, payloadFormat = "json")
 # MAGIC """
 # MAGIC 
-# MAGIC # define the model scoring function
-# MAGIC def score_model():
-# MAGIC   url = 'https://field-eng.cloud.databricks.com/model/jhu_covid/3/invocations'
-# MAGIC   headers = {'Authorization': f'Bearer {dbutils.secrets.get("ml-ml", "TOKEN")}'}
-# MAGIC   data_json = json_records
-# MAGIC   response = requests.request(method='POST', headers=headers, url=url, json=data_json)
-# MAGIC   if response.status_code != 200:
-# MAGIC     raise Exception(f'Request failed with status {response.status_code}, {response.text}')
-# MAGIC   return response.json()
+# MAGIC scoring_frames = [df_cleaned.limit(100).toPandas()] * 8
 # MAGIC 
 # MAGIC # score the model
-# MAGIC score_model()
\ No newline at end of file
+# MAGIC predictions = score_model(scoring_frames, url = f"http://127.0.0.1:{servingPort}/invocations", concurrency = 8, payloadFormat = "arrow")
+# MAGIC predictions[0].head()
+
+# COMMAND ----------
+
+# DBTITLE 1,Compare Payload Formats
+"""
+Bytes on the wire and serialization time of json "split" and Arrow IPC payloads
+"""
+
+payload_benchmark = payloadBenchmark(df_cleaned.limit(10000).toPandas(), sizes = [100, 10000, 1000000])
+display(payload_benchmark)
+
+# COMMAND ----------
+
+# DBTITLE 1,Stop the Micro-Batching Server
+stop_model_server()
\ No newline at end of file
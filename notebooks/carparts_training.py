@@ -0,0 +1,108 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Carparts Training
+# MAGIC 
+# MAGIC Entry point of the training jobs. Small datasets don't need Spark: job scheduling, JVM serialization and Delta overhead take minutes for data that fits in a few megabytes. With the default `trainingBackend = "auto"`, `carparts_data` with at most `localBackendMaxRows` cleaned orders trains in-process with `carparts.local`, which mirrors the Spark indexing, assembly, bisecting k-means, decision tree and evaluators, and logs to the same MLflow experiment as the Spark notebook. Larger data runs the `carparts_demo_1` Spark notebook as a child job. `"local"` and `"spark"` force a backend.
+
+# COMMAND ----------
+
+# DBTITLE 1,Import the Single-Node Backend
+"""
+In-process training for small datasets, from the carparts cluster library
+"""
+
+from carparts.local import exportLocalArtifact, localPipeline, orderColumns
+
+# COMMAND ----------
+
+# DBTITLE 1,Select the Training Backend
+# MAGIC %python
+# MAGIC 
+# MAGIC from pyspark.sql.functions import col
+# MAGIC 
+# MAGIC """
+# MAGIC   Train small datasets in-process, everything else on spark
+# MAGIC """
+# MAGIC 
+# MAGIC trainingBackend : str = "auto" ## spark, local or auto
+# MAGIC localBackendMaxRows : int = 100000 ## largest cleaned dataset auto trains locally
+# MAGIC sparkNotebook : str = "./carparts_demo_1" ## spark training, deployment and serving notebook
+# MAGIC sparkNotebookTimeout : int = 0 ## seconds, 0 waits for the spark notebook without a limit
+# MAGIC localArtifactPath : str = "/dbfs/tmp/carparts_local/model.npz" ## scoring artifact of the local run
+# MAGIC 
+# MAGIC if trainingBackend not in ("spark", "local", "auto"):
+# MAGIC   raise ValueError(f"Unknown training backend {trainingBackend}")
+# MAGIC 
+# MAGIC cleanedRows = spark.table("carparts_data").where(col("ID").isNotNull()).count()
+# MAGIC trainLocally = trainingBackend == "local" or (trainingBackend == "auto" and cleanedRows <= localBackendMaxRows)
+# MAGIC 
+# MAGIC print(f"{cleanedRows} cleaned rows, training {'in-process' if trainLocally else 'on spark'}")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Single-Node Training
+# MAGIC 
+# MAGIC The k-means and decision tree sweeps run on the driver and log their runs, tagged `backend = local`, to the experiment of the Spark notebook. The chosen tree is exported as a vectorized scoring artifact for `carparts score` and `carparts serve`.
+
+# COMMAND ----------
+
+# DBTITLE 1,Train In-Process
+# MAGIC %python
+# MAGIC 
+# MAGIC import mlflow
+# MAGIC import os
+# MAGIC 
+# MAGIC """
+# MAGIC   Run the training pipeline on pandas and export the chosen tree
+# MAGIC """
+# MAGIC 
+# MAGIC if trainLocally:
+# MAGIC   current_notebook_path = dbutils.notebook.entry_point.getDbutils().notebook().getContext().notebookPath().get()
+# MAGIC   mlflow.set_experiment(os.path.normpath(os.path.join(os.path.dirname(current_notebook_path), sparkNotebook)) + "_experiment")
+# MAGIC 
+# MAGIC   localResult = localPipeline(spark.table("carparts_data").select(*orderColumns).toPandas(), seed = 1)
+# MAGIC   exportLocalArtifact(localResult, localArtifactPath)
+# MAGIC 
+# MAGIC   trainingSummary = {"backend" : "local",
+# MAGIC                      "artifact" : localArtifactPath,
+# MAGIC                      **{key : localResult[key] for key in ["rows", "k", "cost", "silhouette", "depth", "f1", "seconds"]}}
+# MAGIC   print(trainingSummary)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC 
+# MAGIC ### Spark Training
+# MAGIC 
+# MAGIC Larger data runs every cell of the Spark notebook as a child job, from the ingest to the deployment and serving.
+
+# COMMAND ----------
+
+# DBTITLE 1,Run the Spark Notebook
+# MAGIC %python
+# MAGIC 
+# MAGIC """
+# MAGIC   Train, deploy and serve on spark
+# MAGIC """
+# MAGIC 
+# MAGIC if not trainLocally:
+# MAGIC   trainingSummary = {"backend" : "spark",
+# MAGIC                      "rows" : cleanedRows,
+# MAGIC                      "notebook" : sparkNotebook,
+# MAGIC                      "result" : dbutils.notebook.run(sparkNotebook, sparkNotebookTimeout)}
+# MAGIC   print(trainingSummary)
+
+# COMMAND ----------
+
+# DBTITLE 1,Job Result
+# MAGIC %python
+# MAGIC 
+# MAGIC import json
+# MAGIC 
+# MAGIC """
+# MAGIC   Hand the summary to the calling job
+# MAGIC """
+# MAGIC 
+# MAGIC dbutils.notebook.exit(json.dumps(trainingSummary))
\ No newline at end of file
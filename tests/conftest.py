@@ -0,0 +1,41 @@
+"""
+  Shared fixtures of the carparts tests
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from carparts.local import orderColumns
+
+def syntheticOrders(rows : int,
+                    seed : int = 0) -> pd.DataFrame:
+  """
+    Orders with the landing csv schema, three order volume levels so the clusters have structure
+
+    @return pandas DataFrame like readOrders
+
+    @param rows          | number of orders
+    @param seed          | random seed
+  """
+
+  rng = np.random.default_rng(seed)
+  dates = pd.Timestamp("2019-01-02") + pd.to_timedelta(rng.integers(0, 365, rows), unit = "D")
+  level = rng.integers(0, 3, rows)
+
+  orders = pd.DataFrame({"ID" : np.arange(1, rows + 1),
+                         "Count_Of_Order_Number" : level * 1000 + rng.integers(0, 200, rows),
+                         "Date" : dates,
+                         "Order_Type" : rng.choice(["SHELFRPK", "BULK", "PALLET"], rows, p = [0.5, 0.3, 0.2]),
+                         "WH_ID" : rng.choice(["LSL", "MRS", "KTH", "OSL"], rows, p = [0.4, 0.3, 0.2, 0.1]),
+                         "Date_2" : dates,
+                         "Year" : dates.year,
+                         "Week_Number" : dates.isocalendar().week.to_numpy(),
+                         "Days_Until_IRS_Refund" : rng.integers(0, 100, rows),
+                         "Days_Until_Stimulus_check" : rng.integers(0, 500, rows)})
+  return orders[orderColumns].astype({c : "Int64" for c in ["ID", "Count_Of_Order_Number", "Year", "Week_Number",
+                                                            "Days_Until_IRS_Refund", "Days_Until_Stimulus_check"]})
+
+@pytest.fixture
+def orders() -> pd.DataFrame:
+  return syntheticOrders(300)
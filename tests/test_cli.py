@@ -0,0 +1,81 @@
+"""
+  Tests of the command line, the scoring commands in fresh processes like a cold start
+"""
+
+import os
+import subprocess
+import sys
+import time
+from typing import List
+
+import pandas as pd
+import pytest
+
+from carparts.cli import main
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pytest.importorskip("sklearn")
+
+@pytest.fixture
+def landing(orders, tmp_path):
+  ## the landing csv files have a header row, readOrders replaces it with the schema
+  path = str(tmp_path / "orders.csv")
+  orders.to_csv(path, index = False)
+  return path
+
+@pytest.fixture
+def artifact(landing, tmp_path):
+  model, path = str(tmp_path / "model.pkl"), str(tmp_path / "model.npz")
+  assert main(["train", landing, "-o", model, "--centroids", "2:5", "--depths", "2:5"]) == 0
+  assert main(["deploy", model, "-o", path]) == 0
+  return path
+
+def carparts(arguments : List[str]) -> subprocess.CompletedProcess:
+  environment = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+  return subprocess.run([sys.executable, "-m", "carparts.cli"] + arguments, capture_output = True, text = True, check = True, env = environment)
+
+def coldStart(arguments : List[str],
+              attempts : int = 2) -> float:
+  ## best of a few fresh processes, the first one may still be reading the files from disk
+  seconds = []
+  for _ in range(attempts):
+    start = time.perf_counter()
+    carparts(arguments)
+    seconds.append(time.perf_counter() - start)
+  return min(seconds)
+
+def test_score_writes_keys_and_predictions(orders, landing, artifact, tmp_path):
+  output = str(tmp_path / "scored.csv")
+  carparts(["score", artifact, landing, "-o", output, "--batch-size", "64"])
+
+  scored = pd.read_csv(output)
+  assert list(scored.columns) == ["ID", "Date", "WH_ID", "Order_Type", "Year", "prediction"]
+  assert scored["ID"].tolist() == orders["ID"].tolist()
+
+def test_report_by_segment(orders, landing, artifact):
+  report = carparts(["report", landing, "--by", "segment", "--artifact", artifact]).stdout.split("\n")
+
+  assert report[0].split() == ["segment", "records", "total_count_orders"]
+  assert sum(int(line.split()[1]) for line in report[1:] if line) == len(orders)
+
+def test_timing_flag(landing):
+  assert "took" not in carparts(["report", landing]).stderr
+  assert "since the process started" in carparts(["report", landing, "--timing"]).stderr
+
+@pytest.mark.parametrize("command", ["score", "report"])
+def test_cold_start(command, landing, artifact, tmp_path):
+  arguments = {"score" : ["score", artifact, landing, "-o", str(tmp_path / "scored.csv")],
+               "report" : ["report", landing, "--by", "segment", "--artifact", artifact]}[command]
+
+  assert coldStart(arguments) < 1.0
+
+def test_scoring_commands_skip_heavy_imports(landing, artifact, tmp_path):
+  script = "import sys\n" \
+           "from carparts.cli import main\n" \
+           f"main(['score', {artifact!r}, {landing!r}, '-o', {str(tmp_path / 'scored.csv')!r}])\n" \
+           f"main(['report', {landing!r}, '--by', 'segment', '--artifact', {artifact!r}])\n" \
+           "print(sorted(m for m in ['sklearn', 'scipy', 'pyspark', 'mlflow'] if m in sys.modules), file = sys.stderr)\n"
+
+  loaded = subprocess.run([sys.executable, "-c", script], capture_output = True, text = True, check = True, cwd = root)
+  assert loaded.stderr.strip() == "[]"
@@ -0,0 +1,110 @@
+"""
+  Tests of the single-node backend against the Spark stages it mirrors
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import syntheticOrders
+
+from carparts.local import applyIndexer, cleanOrders, exportLocalArtifact, featureMatrix, fitIndexer, indexedColumns, \
+                           localDecisionTree, localKMeans, localPipeline
+from carparts.scoring import loadScoringArtifact, scoreBatch
+
+pytest.importorskip("sklearn")
+
+## ----------------------------------------------------------------------------
+## String Indexing
+## ----------------------------------------------------------------------------
+
+def test_indexer_orders_by_frequency_then_label():
+  orders = pd.DataFrame({"WH_ID" : ["MRS", "LSL", "KTH", "LSL", "MRS", "OSL", "LSL"],
+                         "Order_Type" : ["BULK", "PALLET", "BULK", "PALLET", "SHELFRPK", "SHELFRPK", "BULK"]})
+
+  ## like StringIndexer frequencyDesc, ties are broken alphabetically
+  labels = fitIndexer(orders, ["WH_ID", "Order_Type"])
+  assert labels == {"WH_ID" : ["LSL", "MRS", "KTH", "OSL"], "Order_Type" : ["BULK", "PALLET", "SHELFRPK"]}
+
+  indexed = applyIndexer(orders, labels, ["WH_ID_CATEGORY", "ORDER_TYPE_CATEGORY"])
+  assert indexed["WH_ID_CATEGORY"].tolist() == [1.0, 0.0, 2.0, 0.0, 1.0, 3.0, 0.0]
+  assert indexed["ORDER_TYPE_CATEGORY"].tolist() == [0.0, 1.0, 0.0, 1.0, 2.0, 2.0, 0.0]
+
+def test_indexer_rejects_unseen_labels():
+  labels = {"WH_ID" : ["LSL", "MRS"]}
+
+  with pytest.raises(ValueError, match = "Unseen labels in WH_ID"):
+    applyIndexer(pd.DataFrame({"WH_ID" : ["LSL", "NEW"]}), labels, ["WH_ID_CATEGORY"])
+
+## ----------------------------------------------------------------------------
+## Clustering and Classification
+## ----------------------------------------------------------------------------
+
+def clusteredFeatures(rows : int,
+                      seed : int = 0) -> np.ndarray:
+  rng = np.random.default_rng(seed)
+  centers = np.array([[0.0, 0.0], [10.0, 0.0], [0.0, 10.0]])
+  return centers[rng.integers(0, 3, rows)] + rng.normal(size = (rows, 2))
+
+def test_kmeans_cost_and_exact_silhouette():
+  from sklearn.metrics import silhouette_score
+
+  features = clusteredFeatures(600)
+  model, cost, silhouette = localKMeans(features, 3, seed = 1)
+
+  ## the cost is the within cluster sum of squared distances, the silhouette uses squared distances like ClusteringEvaluator
+  assert cost == pytest.approx(((features - model.cluster_centers_[model.labels_]) ** 2).sum())
+  assert silhouette == pytest.approx(silhouette_score(features, model.labels_, metric = "sqeuclidean"))
+
+def test_kmeans_sampled_silhouette():
+  features = clusteredFeatures(3000)
+
+  _, _, exact = localKMeans(features, 3, seed = 1, silhouetteSamples = len(features))
+  _, _, sampled = localKMeans(features, 3, seed = 1, silhouetteSamples = 500)
+
+  assert sampled != exact
+  assert sampled == pytest.approx(exact, abs = 0.02)
+
+def test_tree_weighted_f1():
+  rng = np.random.default_rng(0)
+  features = rng.normal(size = (400, 3))
+  labels = (features[:, 0] > 0).astype(int) + (features[:, 1] > 1).astype(int)
+
+  model, f1 = localDecisionTree(features[:300], labels[:300], features[300:], labels[300:], maxDepth = 2, seed = 1)
+
+  ## the per class F1 weighted by the class support, like MulticlassClassificationEvaluator's f1
+  predicted, actual = model.predict(features[300:]), labels[300:]
+  expected = 0.0
+  for label in np.unique(actual):
+    truePositives = np.sum((predicted == label) & (actual == label))
+    precision = truePositives / max(np.sum(predicted == label), 1)
+    recall = truePositives / np.sum(actual == label)
+    classF1 = 2 * precision * recall / (precision + recall) if truePositives else 0.0
+    expected += classF1 * np.mean(actual == label)
+
+  assert f1 == pytest.approx(expected)
+
+## ----------------------------------------------------------------------------
+## Local Pipeline and Export
+## ----------------------------------------------------------------------------
+
+def test_exported_artifact_scores_like_the_tree(orders, tmp_path):
+  result = localPipeline(orders, centroids = range(2, 5), depths = range(2, 5), logToMlflow = False)
+
+  path = str(tmp_path / "local.npz")
+  metadata = exportLocalArtifact(result, path)
+
+  assert metadata["features"] == result["features"]
+  assert [indexer["labels"] for indexer in metadata["indexers"]] == list(result["labels"].values())
+
+  cleaned = cleanOrders(orders)
+  features, _ = featureMatrix(applyIndexer(cleaned, result["labels"], list(indexedColumns.values())))
+  np.testing.assert_array_equal(scoreBatch(loadScoringArtifact(path), cleaned)["prediction"].to_numpy(), result["tree"].predict(features))
+
+def test_too_few_orders_to_cluster():
+  with pytest.raises(ValueError, match = "more cleaned orders than clusters"):
+    localPipeline(syntheticOrders(2), logToMlflow = False)
+
+def test_empty_test_split():
+  with pytest.raises(ValueError, match = "training or testing rows empty"):
+    localPipeline(syntheticOrders(50), centroids = range(2, 4), splitWeights = [1.0, 0.0], logToMlflow = False)
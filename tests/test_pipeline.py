@@ -0,0 +1,172 @@
+"""
+  Tests of the stage runner
+"""
+
+import importlib.util
+import os
+import threading
+import time
+from typing import Dict, List
+
+import pytest
+
+from carparts.pipeline import Pipeline, Stage, StageStore, codeDigest
+
+class SavedModel:
+  """
+    Stand-in for a Spark model, saved with its own writer
+  """
+
+  def __init__(self, value : int):
+    self.value = value
+
+  def write(self):
+    model = self
+
+    class Writer:
+      def overwrite(self):
+        return self
+
+      def save(self, path : str) -> None:
+        os.makedirs(path, exist_ok = True)
+        with open(os.path.join(path, "value"), "w") as valueFile:
+          valueFile.write(str(model.value))
+
+    return Writer()
+
+  @classmethod
+  def load(cls, path : str) -> "SavedModel":
+    with open(os.path.join(path, "value")) as valueFile:
+      return cls(int(valueFile.read()))
+
+def buildPipeline(root : str,
+                  calls : List[str],
+                  source : Dict[str, int],
+                  scale : int = 3,
+                  sleep : float = 0.0) -> Pipeline:
+  pipeline = Pipeline(StageStore(root), maxWorkers = 2)
+
+  def ingest(version : int) -> int:
+    calls.append("ingest")
+    return version * 10
+
+  def featurize(ingest : int, scale : int) -> Dict:
+    calls.append("featurize")
+    return {"model" : SavedModel(ingest * scale), "columns" : ["a", "b"]}
+
+  def left(featurize : Dict) -> int:
+    calls.append("left")
+    time.sleep(sleep)
+    return featurize["model"].value + 1
+
+  def right(featurize : Dict) -> tuple:
+    calls.append("right")
+    time.sleep(sleep)
+    return (SavedModel(featurize["model"].value + 2), "report")
+
+  pipeline.add(Stage("ingest", ingest, inputs = {"version" : lambda : source["version"]}, persist = False))
+  pipeline.add(Stage("featurize", featurize, ["ingest"], params = {"scale" : scale}))
+  pipeline.add(Stage("left", left, ["featurize"]))
+  pipeline.add(Stage("right", right, ["featurize"]))
+  return pipeline
+
+def statuses(pipeline : Pipeline) -> Dict[str, str]:
+  return {row["stage"] : row["status"] for row in pipeline.report}
+
+def test_plan_run_memory_and_hit(tmp_path):
+  calls, source = [], {"version" : 1}
+
+  pipeline = buildPipeline(str(tmp_path), calls, source)
+  assert pipeline.plan(["left"]) == {"left" : "run", "featurize" : "run", "ingest" : "run"}
+  assert pipeline.run(["left"]) == {"left" : 31}
+  assert pipeline.plan(["left", "right"]) == {"left" : "memory", "right" : "run", "featurize" : "memory"}
+
+  ## a new session loads the stored results, stages only feeding them aren't touched
+  calls.clear()
+  pipeline = buildPipeline(str(tmp_path), calls, source)
+  assert pipeline.plan(["left"]) == {"left" : "hit"}
+  outputs = pipeline.run(["left", "right"])
+  assert outputs["left"] == 31 and outputs["right"][0].value == 32 and outputs["right"][1] == "report"
+  assert calls == ["right"]
+  assert statuses(pipeline) == {"left" : "hit", "featurize" : "hit", "right" : "ran"}
+
+def test_changed_inputs_and_params_rerun_downstream(tmp_path):
+  calls, source = [], {"version" : 1}
+  buildPipeline(str(tmp_path), calls, source).run(["left", "right"])
+
+  calls.clear()
+  pipeline = buildPipeline(str(tmp_path), calls, source, scale = 4)
+  assert pipeline.plan(["left"]) == {"left" : "run", "featurize" : "run", "ingest" : "run"}
+
+  source["version"] = 2
+  calls.clear()
+  assert buildPipeline(str(tmp_path), calls, source).run(["left"]) == {"left" : 61}
+  assert calls == ["ingest", "featurize", "left"]
+
+def test_force_reruns_stored_stages(tmp_path):
+  calls, source = [], {"version" : 1}
+  buildPipeline(str(tmp_path), calls, source).run(["left"])
+
+  pipeline = buildPipeline(str(tmp_path), calls, source)
+  pipeline.force = True
+  assert pipeline.plan(["left"]) == {"left" : "run", "featurize" : "run", "ingest" : "run"}
+
+def test_independent_stages_run_concurrently(tmp_path):
+  pipeline = buildPipeline(str(tmp_path), [], {"version" : 1}, sleep = 0.5)
+
+  start = time.time()
+  pipeline.run(["left", "right"])
+  assert time.time() - start < 0.9
+
+  rows = {row["stage"] : row for row in pipeline.report}
+  assert abs(rows["left"]["started"] - rows["right"]["started"]) < 0.2
+
+def test_failure_cancels_dependents(tmp_path):
+  pipeline = Pipeline(StageStore(str(tmp_path)), maxWorkers = 2)
+  ran = threading.Event()
+
+  def broken() -> int:
+    raise ZeroDivisionError("broken stage")
+
+  def independent() -> int:
+    ran.set()
+    return 1
+
+  pipeline.add(Stage("broken", broken))
+  pipeline.add(Stage("dependent", lambda broken : broken + 1, ["broken"]))
+  pipeline.add(Stage("downstream", lambda dependent : dependent + 1, ["dependent"]))
+  pipeline.add(Stage("independent", independent))
+
+  with pytest.raises(RuntimeError) as error:
+    pipeline.run(["downstream", "independent"])
+
+  assert isinstance(error.value.__cause__, ZeroDivisionError)
+  assert ran.is_set()
+  assert statuses(pipeline) == {"broken" : "failed", "dependent" : "cancelled", "downstream" : "cancelled", "independent" : "ran"}
+  assert not os.path.exists(os.path.join(str(tmp_path), "broken"))
+
+def test_report_lists_skipped_stages(tmp_path):
+  pipeline = buildPipeline(str(tmp_path), [], {"version" : 1})
+  pipeline.run(["left"])
+
+  report = pipeline.writeReport("report")
+  assert report["totals"]["ran"] == 3 and report["totals"]["skipped"] == 1
+  assert all(os.path.exists(path) for path in report["paths"])
+
+def test_code_digest_follows_helpers(tmp_path):
+  def stageModule(name : str, helperBody : str):
+    path = tmp_path / f"{name}.py"
+    path.write_text("def helper(x):\n"
+                    f"  return {helperBody}\n"
+                    "\n"
+                    "def stage(x):\n"
+                    "  return [helper(v) for v in x]\n")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+  first, same, changed = stageModule("first", "x + 1"), stageModule("same", "x + 1"), stageModule("changed", "x + 2")
+
+  assert codeDigest(first.stage) == codeDigest(same.stage)
+  assert codeDigest(first.stage) != codeDigest(changed.stage)
@@ -0,0 +1,94 @@
+"""
+  Tests of the vectorized scorer against the models it was exported from
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from carparts.local import applyIndexer, cleanOrders, exportLocalArtifact, featureMatrix, fitIndexer, indexedColumns
+from carparts.scoring import loadScoringArtifact, scoreBatch
+
+pytest.importorskip("sklearn")
+
+@pytest.fixture
+def exported(orders, tmp_path):
+  from sklearn.tree import DecisionTreeClassifier
+
+  cleaned = cleanOrders(orders)
+  labels = fitIndexer(cleaned, list(indexedColumns))
+  features, featureNames = featureMatrix(applyIndexer(cleaned, labels, list(indexedColumns.values())))
+
+  ## a target that needs both the indexed and the numeric features
+  target = (cleaned["Count_Of_Order_Number"].to_numpy(dtype = float) // 1000) + 3 * (cleaned["WH_ID"] == "MRS").to_numpy()
+  tree = DecisionTreeClassifier(max_depth = 6, random_state = 1).fit(features, target)
+
+  path = str(tmp_path / "tree.npz")
+  exportLocalArtifact({"tree" : tree, "labels" : labels, "features" : featureNames}, path)
+  return {"cleaned" : cleaned, "features" : features, "tree" : tree, "artifact" : loadScoringArtifact(path)}
+
+def unseenWarehouse(cleaned : pd.DataFrame) -> pd.DataFrame:
+  batch = cleaned.head(5).copy()
+  batch.loc[batch.index[2], "WH_ID"] = "NEW"
+  return batch
+
+def test_scorer_matches_exported_tree(exported):
+  scored = scoreBatch(exported["artifact"], exported["cleaned"])
+
+  assert list(scored.columns) == ["prediction"]
+  np.testing.assert_array_equal(scored["prediction"].to_numpy(), exported["tree"].predict(exported["features"]))
+
+def test_scorer_reads_arrow_batches(exported):
+  pa = pytest.importorskip("pyarrow")
+
+  fromArrow = scoreBatch(exported["artifact"], pa.Table.from_pandas(exported["cleaned"], preserve_index = False))
+  pd.testing.assert_frame_equal(fromArrow, scoreBatch(exported["artifact"], exported["cleaned"]))
+
+def test_unseen_labels_error(exported):
+  with pytest.raises(ValueError, match = "Unseen labels in WH_ID"):
+    scoreBatch(exported["artifact"], unseenWarehouse(exported["cleaned"]))
+
+def test_unseen_labels_skip(exported):
+  artifact, batch = exported["artifact"], unseenWarehouse(exported["cleaned"])
+  artifact["indexers"][1]["handleInvalid"] = "skip"
+
+  scored = scoreBatch(artifact, batch)
+
+  ## the unseen row is dropped and the others keep their index
+  assert list(scored.index) == [0, 1, 3, 4]
+  np.testing.assert_array_equal(scored["prediction"].to_numpy(), exported["tree"].predict(exported["features"][[0, 1, 3, 4]]))
+
+def test_unseen_labels_keep(exported):
+  artifact, batch = exported["artifact"], unseenWarehouse(exported["cleaned"])
+  artifact["indexers"][1]["handleInvalid"] = "keep"
+
+  ## like StringIndexer, unseen labels get the index after the last label
+  features = exported["features"][:5].copy()
+  features[2, list(artifact["metadata"]["features"]).index("WH_ID_CATEGORY")] = artifact["indexers"][1]["size"]
+
+  np.testing.assert_array_equal(scoreBatch(artifact, batch)["prediction"].to_numpy(), exported["tree"].predict(features))
+
+def test_categorical_split_routing(tmp_path):
+  ## the root splits on the warehouse index, categories 0 and 2 go left, 1 and the unseen index 3 go right
+  metadata = {"model" : "decision_tree",
+              "maxDepth" : 1,
+              "indexers" : [{"inputCol" : "WH_ID", "outputCol" : "WH_ID_CATEGORY", "handleInvalid" : "keep", "labels" : ["A", "B", "C"]}],
+              "features" : ["WH_ID_CATEGORY"],
+              "assemblerHandleInvalid" : "error",
+              "predictionCol" : "prediction"}
+  path = str(tmp_path / "categorical.npz")
+  np.savez_compressed(path,
+                      metadata = np.array(json.dumps(metadata)),
+                      feature = np.array([0, -1, -1]),
+                      threshold = np.zeros(3),
+                      categorical = np.array([True, False, False]),
+                      goesLeft = np.array([[True, False, True], [False] * 3, [False] * 3]),
+                      left = np.array([1, -1, -1]),
+                      right = np.array([2, -1, -1]),
+                      prediction = np.array([0.0, 1.0, 2.0]))
+
+  scored = scoreBatch(loadScoringArtifact(path), pd.DataFrame({"WH_ID" : ["A", "B", "C", "D"]}))
+
+  assert scored["prediction"].tolist() == [1.0, 2.0, 1.0, 2.0]
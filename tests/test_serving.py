@@ -0,0 +1,141 @@
+"""
+  Tests of the model server payload formats and micro-batching
+"""
+
+import asyncio
+from typing import Callable, List, Optional
+
+import pandas as pd
+import pytest
+
+from carparts.serving import ARROW_STREAM, JSON, MicroBatcher, decodePredictions, formatPredictions
+
+## ----------------------------------------------------------------------------
+## Payload Formats
+## ----------------------------------------------------------------------------
+
+def roundTrip(scored : pd.DataFrame,
+              accept : str) -> pd.DataFrame:
+  return decodePredictions(*formatPredictions(scored, accept))
+
+@pytest.mark.parametrize("scored", [pd.DataFrame({"prediction" : [0.0, 1.0, 1.0]}),
+                                    pd.DataFrame({"prediction" : [2, 0, 1],
+                                                  "probability" : [0.5, 0.25, 0.75]})])
+def test_json_matches_arrow(scored : pd.DataFrame):
+  pytest.importorskip("pyarrow")
+
+  viaJson = roundTrip(scored, JSON)
+  viaArrow = roundTrip(scored, ARROW_STREAM)
+
+  assert list(viaJson.columns) == list(scored.columns)
+  pd.testing.assert_frame_equal(viaJson, viaArrow, check_dtype = False)
+  pd.testing.assert_frame_equal(viaArrow, scored)
+
+def test_json_plain_list():
+  ## MLflow model servers answer a single column as a plain list
+  decoded = decodePredictions(JSON, b'{"predictions": [1, 0]}')
+
+  assert decoded["predictions"].tolist() == [1, 0]
+
+## ----------------------------------------------------------------------------
+## Micro-Batcher
+## ----------------------------------------------------------------------------
+
+class StubScorer:
+  """
+    Doubles x, drops rows with a negative x like an indexer skipping invalid labels, records every batch
+  """
+
+  def __init__(self, error : Optional[Exception] = None):
+    self.batches : List[int] = []
+    self.error = error
+
+  def __call__(self, frame : pd.DataFrame) -> pd.DataFrame:
+    self.batches.append(len(frame))
+    if self.error is not None:
+      raise self.error
+    kept = frame[frame["x"] >= 0]
+    return pd.DataFrame({"doubled" : kept["x"] * 2}, index = kept.index)
+
+def request(start : int, rows : int) -> pd.DataFrame:
+  ## a caller's own index, the batcher shouldn't rely on it
+  return pd.DataFrame({"x" : range(start, start + rows)}, index = range(100, 100 + rows))
+
+def withBatcher(scorer : StubScorer,
+                session : Callable,
+                **options):
+  async def main():
+    batcher = MicroBatcher(scorer, **options)
+    task = asyncio.ensure_future(batcher.run())
+    try:
+      return batcher, await session(batcher)
+    finally:
+      task.cancel()
+
+  return asyncio.run(main())
+
+def test_concurrent_requests_share_a_batch():
+  scorer = StubScorer()
+  frames = [request(10 * i, i + 1) for i in range(5)]
+
+  async def session(batcher):
+    return await asyncio.gather(*[batcher.submit(frame) for frame in frames])
+
+  batcher, results = withBatcher(scorer, session, maxBatchSize = 1000, maxLatency = 0.05)
+
+  assert scorer.batches == [15] and batcher.batches == 1 and batcher.requests == 5
+  for frame, result in zip(frames, results):
+    assert result["doubled"].tolist() == (frame["x"] * 2).tolist()
+
+def test_batch_size_cuts_batches():
+  scorer = StubScorer()
+  frames = [request(10 * i, 2) for i in range(4)]
+
+  async def session(batcher):
+    return await asyncio.gather(*[batcher.submit(frame) for frame in frames])
+
+  batcher, results = withBatcher(scorer, session, maxBatchSize = 4, maxLatency = 1.0)
+
+  assert scorer.batches == [4, 4]
+  assert [result["doubled"].tolist() for result in results] == [(frame["x"] * 2).tolist() for frame in frames]
+
+def test_latency_cuts_batches():
+  scorer = StubScorer()
+
+  async def session(batcher):
+    first = asyncio.ensure_future(batcher.submit(request(0, 3)))
+    await asyncio.sleep(0.1)
+    second = await batcher.submit(request(50, 2))
+    return await first, second
+
+  batcher, (first, second) = withBatcher(scorer, session, maxBatchSize = 1000, maxLatency = 0.01)
+
+  assert scorer.batches == [3, 2]
+  assert first["doubled"].tolist() == [0, 2, 4] and second["doubled"].tolist() == [100, 102]
+
+def test_dropped_rows_stay_with_their_request():
+  scorer = StubScorer()
+  frames = [pd.DataFrame({"x" : [1, -1, 2]}), pd.DataFrame({"x" : [-5]}), pd.DataFrame({"x" : [-2, 3]})]
+
+  async def session(batcher):
+    return await asyncio.gather(*[batcher.submit(frame) for frame in frames])
+
+  batcher, results = withBatcher(scorer, session, maxBatchSize = 1000, maxLatency = 0.05)
+
+  assert batcher.batches == 1
+  assert [result["doubled"].tolist() for result in results] == [[2, 4], [], [6]]
+
+def test_scorer_error_reaches_every_request():
+  scorer = StubScorer(error = RuntimeError("model failed"))
+
+  async def session(batcher):
+    failed = await asyncio.gather(*[batcher.submit(request(i, 2)) for i in range(3)], return_exceptions = True)
+
+    ## the batcher keeps serving after a failed batch
+    scorer.error = None
+    return failed, await batcher.submit(request(7, 1))
+
+  batcher, (failed, after) = withBatcher(scorer, session, maxBatchSize = 1000, maxLatency = 0.05)
+
+  assert len(failed) == 3 and all(isinstance(error, RuntimeError) and str(error) == "model failed" for error in failed)
+  assert after["doubled"].tolist() == [14]
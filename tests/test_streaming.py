@@ -0,0 +1,48 @@
+"""
+  Tests of the streaming segmentation against a local landing directory, need pyspark and delta-spark
+"""
+
+import pytest
+
+pytest.importorskip("pyspark")
+delta = pytest.importorskip("delta")
+
+from conftest import syntheticOrders
+
+@pytest.fixture(scope = "module")
+def spark(tmp_path_factory):
+  from pyspark.sql import SparkSession
+
+  builder = SparkSession.builder\
+                        .master("local[2]")\
+                        .appName("carparts-tests")\
+                        .config("spark.sql.shuffle.partitions", "2")\
+                        .config("spark.sql.warehouse.dir", str(tmp_path_factory.mktemp("warehouse")))\
+                        .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension")\
+                        .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog")
+  session = delta.configure_spark_with_delta_pip(builder).getOrCreate()
+  yield session
+  session.stop()
+
+def test_local_segmentation_check(spark, tmp_path):
+  from pyspark.ml import Pipeline
+  from pyspark.ml.classification import DecisionTreeClassifier
+  from pyspark.ml.feature import StringIndexer, VectorAssembler
+  from pyspark.sql.functions import col
+
+  from carparts.streaming import carpartsSchema, localSegmentationCheck
+
+  ## the stream reads the csv drops with the carparts schema, build the orders with it as well
+  rows = syntheticOrders(120).astype(object)
+  orders = spark.createDataFrame([tuple(row) for row in rows.itertuples(index = False)], carpartsSchema)
+
+  numeric = ["Count_Of_Order_Number", "Year", "Week_Number", "Days_Until_IRS_Refund", "Days_Until_Stimulus_check"]
+  pipelineModel = Pipeline(stages = [StringIndexer(inputCols = ["Order_Type", "WH_ID"], outputCols = ["ORDER_TYPE_CATEGORY", "WH_ID_CATEGORY"]),
+                                     VectorAssembler(inputCols = numeric + ["ORDER_TYPE_CATEGORY", "WH_ID_CATEGORY"], outputCol = "features"),
+                                     DecisionTreeClassifier(labelCol = "label", maxDepth = 3)])\
+                    .fit(orders.withColumn("label", (col("Count_Of_Order_Number") >= 1000).cast("double")))
+
+  report = localSegmentationCheck(pipelineModel, orders, drops = 3, workDir = str(tmp_path))
+
+  assert report == {"orders" : 120, "segmented_rows" : 120, "segmented_ids" : 120}
+  assert sorted(path.name for path in (tmp_path / "landing").iterdir()) == ["drop_0.csv", "drop_1.csv", "drop_2.csv"]